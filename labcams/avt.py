@@ -220,6 +220,7 @@ class AVTCam(GenericCam):
             except:
                 display('Queue frame error while getting cam ready: '+ str(f))
                 continue                    
+        self._init_frame_pool((self.h,self.w),self.dtype)
         self.camera_ready.set()
         self.nframes.value = 0
         # Ready to wait for trigger
@@ -231,7 +232,8 @@ class AVTCam(GenericCam):
             self.cam.TriggerSelector = self.triggerSelector
             self.cam.TriggerMode = 'On'
         #tstart = time.time()
-        self.lastframeid = [-1 for i in self.frames]
+        self.lastframeid = -1
+        self.buffer_frameids = [-1 for i in self.frames] # last frame id of each buffer
 
     def _cam_loop(self):
         # run and acquire frames
@@ -245,10 +247,11 @@ class AVTCam(GenericCam):
                 #print('Frame id:{0}'.format(frameID))
                 if not frameID in self.recorded_frames:
                     self.recorded_frames.append(frameID)
-                    frame = np.ndarray(buffer = f.getBufferByteData(),
-                                       dtype = self.dtype,
-                                       shape = (f.height,
-                                                f.width)).copy()
+                    frame = self._get_pool_buffer()
+                    frame[:] = np.ndarray(buffer = f.getBufferByteData(),
+                                          dtype = self.dtype,
+                                          shape = (f.height,
+                                                   f.width))
                     #display("Time {0} - {1}:".format(str(1./(time.time()-tstart)),self.nframes.value))
                     #tstart = time.time()
                     try:
@@ -256,7 +259,7 @@ class AVTCam(GenericCam):
                     except:
                         display('Queue frame failed: '+ str(f))
                         return None,(None,None)
-                    self.lastframeid[ibuf] = frameID
+                    self.buffer_frameids[ibuf] = frameID
                     return frame,(frameID,timestamp)
             elif avterr == -12:
                 #display('VimbaException: ' +  str(avterr))        
@@ -266,30 +269,28 @@ class AVTCam(GenericCam):
         self.cam.runFeatureCommand('AcquisitionStop')
         display('[AVT] - Stopped acquisition.')
         # Check if all frames are done...
+        remaining = []
         for ibuf in range(self.nbuffers):
             f = self.frames[ibuf]
             try:
                 f.waitFrameCapture(timeout = self.frame_timeout)
                 timestamp = f._frame.timestamp/self.tickfreq
                 frameID = f._frame.frameID
+                if frameID in self.buffer_frameids:
+                    continue
                 frame = np.ndarray(buffer = f.getBufferByteData(),
                                    dtype = self.dtype,
                                    shape = (f.height,
                                             f.width)).copy()
-                if self.saving.is_set():
-                    self.was_saving = True
-                    if not frameID in self.lastframeid :
-                        self.queue.put((frame.copy(),(frameID,timestamp)))
-                elif self.was_saving:
-                    self.was_saving = False
-                    self.queue.put(['STOP'])
-
-                self.lastframeid[ibuf] = frameID
-                self.nframes.value = frameID
-                self.frame = frame
+                self.buffer_frameids[ibuf] = frameID
+                remaining.append((frameID,timestamp,frame))
             except VimbaException as err:
                 #display('VimbaException: ' + str(err))
                 pass
+        # in frame order so the dropped frames are counted like in the loop
+        for frameID,timestamp,frame in sorted(remaining,key = lambda r: r[0]):
+            self._handle_frame(frame,(frameID,timestamp))
+            self.nframes.value = frameID
         display('{4} delivered:{0},dropped:{1},queued:{4},time:{2}'.format(
             self.cam.StatFrameDelivered,
             self.cam.StatFrameDropped,
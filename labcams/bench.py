@@ -0,0 +1,424 @@
+#  labcams - https://jpcouto@bitbucket.org/jpcouto/labcams.git
+# Copyright (C) 2020 Joao Couto - jpcouto@gmail.com
+#
+#  This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Throughput benchmark of the acquisition and recording pipeline.
+# Uses simulated (or file-backed) cameras so it runs without hardware.
+import os
+import json
+import time
+import shutil
+import tempfile
+from glob import glob
+from os.path import join as pjoin
+import numpy as np
+from multiprocessing import Queue
+from queue import Empty
+from .utils import display,PipelineLatency
+from .cams import SimulatedCam
+from .io import *
+
+RECORDERS = ['binary','tiff','ffmpeg','opencv','hdf5','lossless',
+             'binary_noqueue','tiff_noqueue','ffmpeg_noqueue','hdf5_noqueue']
+
+def _start_pipeline(recorder,
+                    ncams = 1,
+                    camargs = {},
+                    datafolder = None,
+                    framesperfile = 0,
+                    sleeptime = 0.05,
+                    recording_buffer = 'queue',
+                    recording_buffer_size = 64,
+                    batch_size = 1,
+                    queue_size = 0,
+                    queue_policy = 'block',
+                    compress = 0,
+                    compress_threads = 0,
+                    log_format = 'text',
+                    checkpoint_interval = 0):
+    '''Creates the cameras and writers the same way the gui does.'''
+    cams = []
+    writers = []
+    queues = []
+    latencies = []
+    pathformat = pjoin('{datafolder}','{dataname}','{filename}',
+                       '{today}_{run}_{nfiles}')
+    for icam in range(ncams):
+        dataname = 'cam{0}'.format(icam)
+        latencies.append(PipelineLatency())
+        queues.append(Queue(maxsize = queue_size))
+        recorderpar = None
+        if 'noqueue' in recorder:
+            recorderpar = dict(recorder = recorder,
+                               datafolder = datafolder,
+                               framesperfile = framesperfile,
+                               pathformat = pathformat,
+                               compression = compress,
+                               compression_threads = compress_threads,
+                               log_format = log_format,
+                               checkpoint_interval = checkpoint_interval,
+                               filename = 'bench',
+                               dataname = dataname)
+        cam = SimulatedCam(camId = icam,
+                           outQ = queues[-1],
+                           recorderpar = recorderpar,
+                           **camargs)
+        cam.stage_latency = latencies[-1]
+        cam.queue_size = queue_size
+        cam.queue_policy = queue_policy
+        if recording_buffer == 'ring' and not 'noqueue' in recorder:
+            queues[-1] = FrameRingBuffer(cam.h,cam.w,cam.nchan,cam.dtype,
+                                         nslots = recording_buffer_size)
+            cam.queue = queues[-1]
+            cam.queue_size = recording_buffer_size
+        elif not 'noqueue' in recorder:
+            cam.batch_size = batch_size
+        cams.append(cam)
+        writer = None
+        if not 'noqueue' in recorder:
+            towriter = dict(inQ = queues[-1],
+                            datafolder = datafolder,
+                            pathformat = pathformat,
+                            framesperfile = framesperfile,
+                            sleeptime = sleeptime,
+                            filename = 'bench',
+                            dataname = dataname)
+            if recorder == 'tiff':
+                writer = TiffWriter(compression = compress,
+                                    compression_threads = compress_threads,
+                                    **towriter)
+            elif recorder == 'binary':
+                writer = BinaryWriter(**towriter)
+            elif recorder == 'ffmpeg':
+                writer = FFMPEGWriter(compression = compress,**towriter)
+            elif recorder == 'opencv':
+                writer = OpenCVWriter(compression = compress,**towriter)
+            elif recorder == 'lossless':
+                writer = LosslessWriter(compression = max(compress,1),
+                                        workers = compress_threads,
+                                        **towriter)
+            elif recorder == 'hdf5':
+                writer = HDF5Writer(compression = compress,
+                                    compression_threads = compress_threads,
+                                    **towriter)
+            else:
+                raise ValueError('Unknown recorder {0}'.format(recorder))
+            writer.stage_latency = latencies[-1]
+            writer.log_format = log_format
+            writer.checkpoint_interval = checkpoint_interval
+        writers.append(writer)
+    for cam,writer in zip(cams,writers):
+        cam.start()
+        if not writer is None:
+            writer.init(cam)
+            writer.start()
+    return cams,writers,queues,latencies
+
+def _folder_size(folder):
+    nbytes = 0
+    for root,dirs,files in os.walk(folder):
+        for f in files:
+            if not f.endswith('.camlog'):
+                nbytes += os.path.getsize(pjoin(root,f))
+    return nbytes
+
+def _count_logged_frames(folder):
+    '''Frames recorded and frame id gaps from the camlog files in a folder.'''
+    nframes = 0
+    ndropped = 0
+    for f in sorted(glob(pjoin(folder,'**','*.camlog'),recursive = True)):
+        h5files = sorted(glob(pjoin(os.path.dirname(f),'*.h5')))
+        if len(h5files):
+            # hdf5 recorders keep the frame metadata in the data files
+            log = parseHDF5Log(h5files)
+        else:
+            log,comments = parseCamLog(f)
+        if not len(log):
+            continue
+        nframes += len(log)
+        ndropped += int(log['frame_id'].iloc[-1] - log['frame_id'].iloc[0] + 1 - len(log))
+    return nframes,ndropped
+
+def run_benchmark(recorder = 'binary',
+                  ncams = 1,
+                  duration = 10.,
+                  camargs = {},
+                  datafolder = None,
+                  framesperfile = 0,
+                  sleeptime = 0.05,
+                  recording_buffer = 'queue',
+                  recording_buffer_size = 64,
+                  batch_size = 1,
+                  queue_size = 0,
+                  queue_policy = 'block',
+                  compress = 0,
+                  compress_threads = 0,
+                  log_format = 'text',
+                  checkpoint_interval = 0,
+                  keep = False,
+                  timeout = 60.):
+    '''
+    Records from simulated cameras and measures the throughput of a recorder.
+
+    Inputs:
+        recorder (str)       : recorder as in the config file (e.g. binary, tiff_noqueue)
+        ncams (int)          : number of cameras recording in parallel
+        duration (float)     : acquisition time (s)
+        camargs (dict)       : SimulatedCam parameters (height, width, frameRate, filename...)
+        datafolder (str)     : where to record (default is a temporary folder)
+        framesperfile (int)  : recorder_frames_per_file
+        sleeptime (float)    : recorder_sleep_time
+        recording_buffer     : queue or ring
+        batch_size (int)     : recording_batch_size (queue only)
+        queue_size (int)     : recording_queue_size (0 is unbounded)
+        queue_policy (str)   : recording_queue_policy (block, drop or spill)
+        compress (int)       : compression level
+        compress_threads     : compress_threads (tiff and hdf5) or
+                               lossless_workers (lossless)
+        log_format (str)     : recording_log_format (text or binary)
+        checkpoint_interval  : recording_checkpoint_interval (s, 0 is off)
+        keep (bool)          : keep the recorded files
+    Dropped frames are the gaps in the recorded frame ids.
+    Returns:
+        a dictionary with the results for each camera.
+
+    Latencies are measured for each stage of the pipeline (see PipelineLatency);
+    latency is the total, from the frame being returned to the frame being written.
+    '''
+    # each run records to a new folder (in datafolder if specified)
+    if not datafolder is None and not os.path.isdir(datafolder):
+        os.makedirs(datafolder)
+    datafolder = tempfile.mkdtemp(prefix = 'labcams_bench_',dir = datafolder)
+    camargs = dict(camargs)
+    if not 'pattern' in camargs.keys() and not 'filename' in camargs.keys():
+        camargs['pattern'] = 'frameid'
+    res = dict(recorder = recorder,
+               ncams = ncams,
+               duration = duration,
+               framesperfile = framesperfile,
+               sleeptime = sleeptime,
+               recording_buffer = recording_buffer,
+               batch_size = batch_size,
+               queue_size = queue_size,
+               queue_policy = queue_policy,
+               compress = compress,
+               compress_threads = compress_threads,
+               log_format = log_format,
+               checkpoint_interval = checkpoint_interval,
+               camera = camargs,
+               datafolder = datafolder,
+               cams = [])
+    cams,writers,queues,latencies = _start_pipeline(
+        recorder,
+        ncams = ncams,
+        camargs = camargs,
+        datafolder = datafolder,
+        framesperfile = framesperfile,
+        sleeptime = sleeptime,
+        recording_buffer = recording_buffer,
+        recording_buffer_size = recording_buffer_size,
+        batch_size = batch_size,
+        queue_size = queue_size,
+        queue_policy = queue_policy,
+        compress = compress,
+        compress_threads = compress_threads,
+        log_format = log_format,
+        checkpoint_interval = checkpoint_interval)
+    try:
+        while not np.all([cam.camera_ready.is_set() for cam in cams]):
+            time.sleep(0.01)
+        for writer,q in zip(writers,queues):
+            if not writer is None:
+                writer.start_write()
+                # wait for the writer process to be consuming the queue
+                q.put(['# [labcams-bench] recorder: {0}'.format(recorder)])
+                while q.qsize() and writer.is_alive():
+                    time.sleep(0.01)
+        for cam in cams:
+            cam.saving.set()
+        for cam in cams:
+            cam.start_trigger.set()
+        tstart = time.time()
+        highwater = [0 for q in queues]
+        while (time.time() - tstart) < duration:
+            for i,q in enumerate(queues):
+                highwater[i] = max(highwater[i],q.qsize())
+            time.sleep(0.005)
+        for cam in cams:
+            cam.stop_saving()
+        nacquired = [cam.nframes.value + 1 for cam in cams]
+        # wait for the writers to empty the queues
+        twait = time.time()
+        for i,(writer,q) in enumerate(zip(writers,queues)):
+            if writer is None:
+                continue
+            while ((writer.write.is_set() or q.qsize()) and
+                   writer.is_alive() and
+                   (time.time() - twait) < timeout):
+                highwater[i] = max(highwater[i],q.qsize())
+                time.sleep(0.005)
+        telapsed = time.time() - tstart
+    finally:
+        for cam in cams:
+            cam.close()
+        for cam,writer,q in zip(cams,writers,queues):
+            while cam.is_alive():
+                if writer is None or writer.is_alive():
+                    cam.join(0.1)
+                else:
+                    # the writer crashed; empty the queue so the camera
+                    # process can exit.
+                    try:
+                        q.get(timeout = 0.1)
+                    except Empty:
+                        pass
+        for writer in writers:
+            if not writer is None and writer.is_alive():
+                writer.stop()
+    for icam,cam in enumerate(cams):
+        folder = pjoin(datafolder,'cam{0}'.format(icam))
+        nframes,ngaps = 0,0
+        nbytes = 0
+        if os.path.isdir(folder):
+            nframes,ngaps = _count_logged_frames(folder)
+            nbytes = _folder_size(folder)
+        framebytes = cam.h*cam.w*cam.nchan*np.dtype(cam.dtype).itemsize
+        res['cams'].append(dict(
+            frames_acquired = nacquired[icam],
+            frames_recorded = nframes,
+            dropped_frames = ngaps,
+            camera_dropped_frames = cam.nframes_dropped.value,
+            longest_gap = cam.longest_gap.value,
+            queue_overflow = cam.nframes_overflow.value,
+            frame_jitter = cam.frame_jitter.value,
+            fps = nframes/telapsed,
+            mbps = nframes*framebytes/telapsed/1e6,
+            disk_mbps = nbytes/telapsed/1e6,
+            queue_highwater = int(highwater[icam]),
+            latency = latencies[icam]['total'].summary(),
+            stages = latencies[icam].summary(),
+            elapsed = telapsed))
+        display('[bench] {0} cam{1}: {2:.1f} fps, {3:.1f} MB/s, dropped {4}, queue max {5}, latency p50 {6:.4f}s p99 {7:.4f}s'.format(
+            recorder,icam,
+            res['cams'][-1]['fps'],
+            res['cams'][-1]['mbps'],
+            res['cams'][-1]['dropped_frames'],
+            res['cams'][-1]['queue_highwater'],
+            res['cams'][-1]['latency']['p50'],
+            res['cams'][-1]['latency']['p99']))
+        display('[bench] {0} cam{1}: {2}'.format(recorder,icam,
+                                                 latencies[icam].describe()))
+    if not keep:
+        shutil.rmtree(datafolder,ignore_errors = True)
+    return res
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description = 'Measures the throughput of the labcams recorders with simulated cameras.')
+    parser.add_argument('-r','--recorder',
+                        type = str,
+                        nargs = '+',
+                        default = ['binary'],
+                        help = 'recorders to test: {0} or all'.format(' '.join(RECORDERS)))
+    parser.add_argument('-n','--ncams',type = int,default = 1)
+    parser.add_argument('-t','--duration',type = float,default = 10.)
+    parser.add_argument('--height',type = int,default = 512)
+    parser.add_argument('--width',type = int,default = 512)
+    parser.add_argument('--nchan',type = int,default = 1)
+    parser.add_argument('--dtype',type = str,default = 'uint16')
+    parser.add_argument('--rate',type = float,default = 100.)
+    parser.add_argument('--pattern',type = str,default = 'frameid')
+    parser.add_argument('--source',type = str,default = None,
+                        help = 'binary file to replay instead of generating frames')
+    parser.add_argument('--path',type = str,default = None,
+                        help = 'recording folder (default is a temporary folder)')
+    parser.add_argument('--frames-per-file',type = int,nargs = '+',default = [0],
+                        help = 'recorder_frames_per_file (can be multiple values)')
+    parser.add_argument('--sleep-time',type = float,nargs = '+',default = [0.05],
+                        help = 'recorder_sleep_time (can be multiple values)')
+    parser.add_argument('--recording-buffer',type = str,nargs = '+',default = ['queue'],
+                        help = 'queue and/or ring')
+    parser.add_argument('--queue-size',type = int,default = 0,
+                        help = 'maximum number of frames in the queue (0 is unbounded)')
+    parser.add_argument('--queue-policy',type = str,default = 'block',
+                        help = 'block, drop or spill (when the queue is full)')
+    parser.add_argument('--batch-size',type = int,default = 1,
+                        help = 'frames sent to the recorder at once (queue only)')
+    parser.add_argument('--compress',type = int,default = 0)
+    parser.add_argument('--compress-threads',type = int,default = 0,
+                        help = 'threads to compress tiff frames (0 is one per core, 1 is serial)')
+    parser.add_argument('--log-format',type = str,default = 'text',
+                        help = 'text or binary camlog rows')
+    parser.add_argument('--checkpoint-interval',type = float,default = 0,
+                        help = 'seconds between checkpoints (0 is off)')
+    parser.add_argument('--keep',default = False,action = 'store_true',
+                        help = 'keep the recorded files')
+    parser.add_argument('-o','--output',type = str,default = None,
+                        help = 'json file to save the results')
+    opts = parser.parse_args()
+
+    recorders = opts.recorder
+    if 'all' in recorders:
+        recorders = RECORDERS
+    camargs = dict(height = opts.height,
+                   width = opts.width,
+                   nchan = opts.nchan,
+                   dtype = opts.dtype,
+                   frameRate = opts.rate,
+                   pattern = opts.pattern)
+    if not opts.source is None:
+        camargs = dict(frameRate = opts.rate,
+                       filename = opts.source)
+    results = []
+    for recorder in recorders:
+        for buff in opts.recording_buffer:
+            for framesperfile in opts.frames_per_file:
+                for sleeptime in opts.sleep_time:
+                    display('[bench] Testing {0} ({1}, frames per file {2}, sleep time {3})'.format(
+                        recorder,buff,framesperfile,sleeptime))
+                    try:
+                        results.append(run_benchmark(recorder = recorder,
+                                                     ncams = opts.ncams,
+                                                     duration = opts.duration,
+                                                     camargs = camargs,
+                                                     datafolder = opts.path,
+                                                     framesperfile = framesperfile,
+                                                     sleeptime = sleeptime,
+                                                     recording_buffer = buff,
+                                                     batch_size = opts.batch_size,
+                                                     queue_size = opts.queue_size,
+                                                     queue_policy = opts.queue_policy,
+                                                     compress = opts.compress,
+                                                     compress_threads = opts.compress_threads,
+                                                     log_format = opts.log_format,
+                                                     checkpoint_interval = opts.checkpoint_interval,
+                                                     keep = opts.keep))
+                    except Exception as err:
+                        display('[bench] {0} failed: {1}'.format(recorder,err))
+                        results.append(dict(recorder = recorder,
+                                            recording_buffer = buff,
+                                            framesperfile = framesperfile,
+                                            sleeptime = sleeptime,
+                                            error = str(err)))
+    out = json.dumps(results,indent = 4,default = float)
+    if opts.output is None:
+        print(out)
+    else:
+        with open(opts.output,'w') as fd:
+            fd.write(out)
+        display('[bench] Results saved to {0}'.format(opts.output))
+
+if __name__ == '__main__':
+    main()
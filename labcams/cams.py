@@ -23,11 +23,14 @@ try:
     multiprocessing.set_start_method('spawn')
 except:
     pass
-from multiprocessing import Process,Queue,Event,Array,Value
+from multiprocessing import Process,Queue,Event,Value,RawArray,RawValue
+from multiprocessing.queues import Queue as ProcessQueue
 import numpy as np
 from datetime import datetime
 import time
 import sys
+from queue import Full
+from collections import deque
 from .utils import *
 import ctypes
 try:
@@ -35,6 +38,34 @@ try:
 except:
     from PIL import Image
 import cv2
+def _pool_frame(frame,released):
+    return frame
+
+def _pool_released():
+    return None
+
+class _PoolRelease(object):
+    '''Releases a pool buffer when pickled (after the frame before it in the tuple).'''
+    def __init__(self,cam,slot):
+        self.cam = cam
+        self.slot = slot
+    def __reduce__(self):
+        self.cam._release_pool_slot(self.slot)
+        return (_pool_released,())
+
+class PoolFrame(object):
+    '''
+    Pool buffer put in a multiprocessing queue (see GenericCam._get_pool_buffer).
+
+    The queue pickles it in its feeder thread; the slot goes back to the
+    pool once the frame data is pickled and the recorder gets the array.
+    '''
+    def __init__(self,cam,frame,slot):
+        self.frame = frame
+        self.release = _PoolRelease(cam,slot)
+    def __reduce__(self):
+        return (_pool_frame,(self.frame,self.release))
+
 #
 # Generic class for interfacing with the cameras
 # Has last frame on multiprocessing array
@@ -52,6 +83,30 @@ class GenericCam(Process):
         self.stop_trigger = Event()
         self.saving = Event()
         self.nframes = Value('i',0)
+        # frame drop accounting (from the frame ids and camera timestamps)
+        self.nframes_dropped = Value('i',0)
+        self.longest_gap = Value('i',0)
+        self.frame_interval = Value('d',0)
+        self.frame_jitter = Value('d',0)
+        self.stage_latency = None   # PipelineLatency to time each stage
+        self._tsdk = None
+        # frames are sent to the recorder in blocks of batch_size frames
+        # (or after batch_latency seconds)
+        self.batch_size = 1
+        self.batch_latency = 0.05
+        self._batch = None
+        self._nbatch = 0
+        # preallocated buffers that the drivers copy the frames to
+        self.frame_pool_size = 16
+        self._pool = None
+        self._pool_queued = False
+        # what to do when the recording queue is full (see _queue_put)
+        self.queue_policy = 'block'
+        self.queue_size = 0
+        self.spill_folder = None
+        self._spill = None
+        self._noverflow_pending = 0
+        self.nframes_overflow = Value('i',0)
         self.queue = outQ
         self.camera_ready = Event()
         self.eventsQ = Queue()
@@ -68,8 +123,38 @@ class GenericCam(Process):
         #self.memlist = self.memmanager.list()
         #self.memlist.append(None)
         self.lasttime = 0
-    def get_img(self):
-        return self.img#self.memlist[0]
+        self.lastframeid = -1
+        self._reset_drop_stats()
+        
+    def get_img(self,new_only = True):
+        '''
+        Returns a copy of the last frame of the preview.
+        Returns None if there is no new frame since the last call (new_only)
+        or if the frame was overwritten while copying.
+        The camera never waits for the reader (see _publish_img).
+        '''
+        seq = self.preview_seq.value
+        n = seq//2  # last complete frame
+        if new_only and n == self._last_preview:
+            return None
+        img = self._preview[n%2].copy()
+        if self.preview_seq.value > 2*n + 2:
+            # the camera started writing to this buffer
+            return None
+        self._last_preview = n
+        return img
+
+    def _publish_img(self,frame,frameID):
+        '''
+        Copies a frame to the preview. The preview is double buffered with a
+        sequence counter (odd while writing); frame n is in buffer n%2.
+        '''
+        seq = self.preview_seq.value
+        n = seq//2 + 1
+        self.preview_seq.value = seq + 1
+        self._preview[n%2] = np.reshape(frame,self._preview.shape[1:])
+        self.preview_frameid[n%2] = frameID
+        self.preview_seq.value = seq + 2
     
     def stop_saving(self):
         # This will send a stop to stop saving and close the writer.
@@ -84,23 +169,99 @@ class GenericCam(Process):
             for c in self.ctrevents.keys():
                 self.ctrevents[c]['call'] ='self.'+self.ctrevents[c]['function']    
     def _init_variables(self, dtype=np.uint8):
-        if dtype == np.uint8:
-            cdtype = ctypes.c_ubyte
-        else:
-            cdtype = ctypes.c_ushort
-        self.frame = Array(cdtype,np.zeros([self.h,self.w,self.nchan],
-                                           dtype = dtype).flatten())
-        self.img = np.frombuffer(
-            self.frame.get_obj(),
-            dtype = cdtype).reshape([self.h, self.w, self.nchan])
+        self._preview_dtype = np.dtype(dtype)
+        # two preview buffers in shared memory (see _publish_img)
+        self.frame = RawArray(ctypes.c_ubyte,2*self.h*self.w*self.nchan*
+                              self._preview_dtype.itemsize)
+        self.preview_seq = RawValue(ctypes.c_int64,0)
+        self.preview_frameid = RawArray(ctypes.c_int64,2)
+        self._last_preview = -1
+        self._init_preview_views()
+        # the drivers can set the first frame of the preview
+        self.img = self._preview[0]
+
+    def _init_preview_views(self):
+        self._preview = np.frombuffer(self.frame,
+                                      dtype = self._preview_dtype).reshape(
+                                          [2,self.h,self.w,self.nchan])
 
+    def _init_frame_pool(self,shape,dtype,nbuffers = None):
+        '''
+        Preallocates the buffers that the driver copies the SDK frames to
+        (see _get_pool_buffer). Call from the camera process (e.g. _cam_init).
+        '''
+        if nbuffers is None:
+            nbuffers = self.frame_pool_size
+        self._pool = [np.empty(shape,dtype = dtype) for i in range(nbuffers)]
+        self._pool_slots = dict([(b.ctypes.data,i) for i,b in enumerate(self._pool)])
+        self._pool_free = deque(range(nbuffers))
+        self._pool_inuse = [False for b in self._pool]
+        self._pool_queued = False # the frame being handled went to a ProcessQueue
+        self.frame_pool_misses = 0
+
+    def _get_pool_buffer(self):
+        '''
+        Returns a free buffer of the pool; it is in use until _handle_frame
+        is done with it or, when it goes to a multiprocessing queue, until
+        the queue pickled it (see PoolFrame). When all buffers are in use a
+        new array is returned (counted in frame_pool_misses).
+        '''
+        if not len(self._pool_free):
+            self.frame_pool_misses += 1
+            return np.empty_like(self._pool[0])
+        slot = self._pool_free.popleft()
+        self._pool_inuse[slot] = True
+        return self._pool[slot]
+
+    def _pool_slot(self,frame):
+        '''Pool slot of a frame (None if it is not an in use pool buffer).'''
+        if self._pool is None or not isinstance(frame,np.ndarray):
+            return None
+        slot = self._pool_slots.get(frame.ctypes.data)
+        if slot is None or not self._pool_inuse[slot]:
+            return None
+        return slot
+
+    def _release_pool_slot(self,slot):
+        if self._pool_inuse[slot]:
+            self._pool_inuse[slot] = False
+            self._pool_free.append(slot)
+
+    def _release_pool_buffer(self,frame):
+        '''Returns the buffer of a handled frame to the pool (unless a queue still has to pickle it).'''
+        if self._pool_queued:
+            self._pool_queued = False
+            return
+        slot = self._pool_slot(frame)
+        if not slot is None:
+            self._release_pool_slot(slot)
+
+    def _pool_handoff(self,frame):
+        '''Wraps a pool buffer that goes to a multiprocessing queue (released when pickled).'''
+        slot = self._pool_slot(frame)
+        if slot is None or not isinstance(self.queue,ProcessQueue):
+            return frame
+        self._pool_queued = True
+        return PoolFrame(self,frame,slot)
+        
     def _start_recorder(self):
         if not self.recorderpar is None:
             extrapar = {}
             if 'binary' in self.recorderpar['recorder'].lower():
                 from .io import BinaryCamWriter as rec
+                for k in ['blocksize','preallocate','direct']:
+                    if k in self.recorderpar.keys():
+                        extrapar[k] = self.recorderpar[k]
             elif 'tiff' in self.recorderpar['recorder'].lower():
                 from .io import TiffCamWriter as rec
+                for k in ['compression','compression_threads']:
+                    if k in self.recorderpar.keys():
+                        extrapar[k] = self.recorderpar[k]
+            elif 'hdf5' in self.recorderpar['recorder'].lower():
+                from .io import HDF5CamWriter as rec
+                for k in ['codec','compression','compression_threads','chunkframes']:
+                    if k in self.recorderpar.keys():
+                        extrapar[k] = self.recorderpar[k]
             elif 'ffmpeg' in self.recorderpar['recorder'].lower():
                 from .io import FFMPEGCamWriter as rec
                 if 'hwaccel' in self.recorderpar:
@@ -120,12 +281,23 @@ class GenericCam(Process):
                                     datafolder = self.recorderpar['datafolder'],
                                     framesperfile = self.recorderpar['framesperfile'],
                                     incrementruns = True,**extrapar)
+                self.recorder.stage_latency = self.stage_latency
+                if 'log_format' in self.recorderpar.keys():
+                    self.recorder.log_format = self.recorderpar['log_format']
+                if 'checkpoint_interval' in self.recorderpar.keys():
+                    self.recorder.checkpoint_interval = self.recorderpar['checkpoint_interval']
+                if 'stripe' in self.recorderpar.keys():
+                    self.recorder.stripe = self.recorderpar['stripe']
+                if 'stripe_offset' in self.recorderpar.keys():
+                    self.recorder.stripe_offset = self.recorderpar['stripe_offset']
+                if 'log_comments' in self.recorderpar.keys():
+                    self.recorder.log_comments = self.recorderpar['log_comments']
             
     def run(self):
         self._init_ctrevents()
-        self.img = np.frombuffer(self.frame.get_obj(),
-                                 dtype = self.dtype).reshape(
-                                     [self.h,self.w,self.nchan])
+        self._init_preview_views()
+        # working copy of the preview for the camera process
+        self.img = self._preview[0].copy()
         self.close_event.clear()
         self._start_recorder()
         while not self.close_event.is_set():
@@ -135,9 +307,12 @@ class GenericCam(Process):
             self._cam_waitsoftwaretrigger()
             if not self.stop_trigger.is_set():
                 self._cam_startacquisition()
+                self._reset_drop_stats()
                 self.cam_is_running = True
             while not self.stop_trigger.is_set():
                 frame,metadata = self._cam_loop()
+                if not self.stage_latency is None:
+                    self._tsdk = time.time()
                 self._handle_frame(frame,metadata)
                 self._parse_command_queue()
                 # to be able to pause acquisition on software trigger
@@ -146,37 +321,238 @@ class GenericCam(Process):
                     self._cam_waitsoftwaretrigger()
                     if not self.stop_trigger.is_set():
                         self._cam_startacquisition()
+                        self._reset_drop_stats()
                         self.cam_is_running = True
             display('[Camera] Stop trigger set.')
             self.start_trigger.clear()
             self._cam_close()
             self.cam_is_running = False
+            if not self._pool is None and self.frame_pool_misses:
+                display('[Camera] Allocated {0} buffers (frame pool of {1} was in use).'.format(
+                    self.frame_pool_misses,len(self._pool)))
+                self.frame_pool_misses = 0
             if self.was_saving:
                 self.was_saving = False
                 if self.recorder is None:
                     display('[Camera] Sending stop signal to the recorder.')
-                    self.queue.put(['STOP'])
+                    self._send_stop()
                 else:
                     self.recorder.close_run()
+            if not self._spill is None:
+                # move what is left in the scratch file to the recorder
+                self._drain_spill(block = True)
+                self._spill.close()
+                self._spill = None
             self.stop_trigger.clear()
             if self.close_event.is_set():
                 break
 
+    def _reset_drop_stats(self):
+        '''Clears the frame drop counters (called when acquisition starts).'''
+        self.nframes_dropped.value = 0
+        self.longest_gap.value = 0
+        self.frame_interval.value = 0
+        self.frame_jitter.value = 0
+        self._ninterval = 0
+        self._interval_m2 = 0.
+        
+    def _check_dropped(self,frameID,timestamp):
+        '''
+        Checks for gaps in the frame ids and updates the inter-frame interval
+        statistics (Welford running mean and standard deviation).
+        Gaps are logged to the camlog when saving.
+        Timestamps are in the units the camera reports.
+        '''
+        if self.lastframeid < 0 or frameID < self.lastframeid:
+            return  # first frame or the camera counter was reset
+        gap = frameID - self.lastframeid - 1
+        if gap > 0:
+            self.nframes_dropped.value += gap
+            if gap > self.longest_gap.value:
+                self.longest_gap.value = gap
+            if self.saving.is_set():
+                self._log_message('# {0},{1} - dropped {2} frames'.format(
+                    self.lastframeid,
+                    self.lasttime,gap))
+        interval = (timestamp - self.lasttime)/float(gap + 1)
+        self._ninterval += 1
+        delta = interval - self.frame_interval.value
+        self.frame_interval.value += delta/self._ninterval
+        self._interval_m2 += delta*(interval - self.frame_interval.value)
+        if self._ninterval > 1:
+            self.frame_jitter.value = np.sqrt(
+                self._interval_m2/(self._ninterval - 1))
+
+    def _log_message(self,msg):
+        '''Writes a comment to the camlog (through the queue if there is one).'''
+        if self.recorder is None:
+            self._flush_batch()
+            self._queue_put([msg])
+        else:
+            self.recorder._handle_frame([msg])
+
+    def _send_stop(self):
+        '''Sends STOP to the recorder (ends the run).'''
+        if self.queue_size > 0 or self.nframes_overflow.value:
+            self._log_message('# {0},{1} - recording queue full for {2} frames ({3})'.format(
+                self.lastframeid,self.lasttime,
+                self.nframes_overflow.value,self.queue_policy))
+        self._flush_batch()
+        self._queue_put(['STOP'])
+
+    def _start_run(self):
+        '''Called on the first frame of a recording.'''
+        self.nframes_overflow.value = 0
+        self._noverflow_pending = 0
+        if self.recorder is None and self.queue_size > 0:
+            self._log_message('# {0},{1} - recording queue size {2} ({3})'.format(
+                self.lastframeid,self.lasttime,
+                self.queue_size,self.queue_policy))
+
+    def _queue_put(self,buff):
+        '''
+        Puts frames and messages in the recording queue.
+        When the queue is full it depends on queue_policy:
+            block - waits for the recorder
+            drop  - drops frames (messages are kept); the number of frames
+                    dropped is logged in the camlog before the next frame
+            spill - writes to a scratch file (SpillFile), the items are moved
+                    to the queue in order when there is space
+        The number of frames that found the queue full is in nframes_overflow.
+        '''
+        nframes = 0
+        if len(buff) > 1:
+            nframes = len(buff[0]) if isinstance(buff[1],np.ndarray) else 1
+        if self.queue_policy == 'spill':
+            if not self._spill is None and self._spill.nitems:
+                # keep the order
+                self._spill.put(buff)
+                self.nframes_overflow.value += nframes
+                self._drain_spill()
+                return
+            try:
+                self.queue.put(buff,block = False)
+            except Full:
+                if self._spill is None:
+                    from .io import SpillFile
+                    self._spill = SpillFile(self.spill_folder)
+                self._spill.put(buff)
+                self.nframes_overflow.value += nframes
+        elif self.queue_policy == 'drop' and nframes:
+            try:
+                if self._noverflow_pending:
+                    self.queue.put(['# {0},{1} - queue full, dropped {2} frames'.format(
+                        self.lastframeid,self.lasttime,
+                        self._noverflow_pending)],block = False)
+                    self._noverflow_pending = 0
+                self.queue.put(buff,block = False)
+            except Full:
+                self._noverflow_pending += nframes
+                self.nframes_overflow.value += nframes
+                if isinstance(buff[0],PoolFrame):
+                    self._release_pool_slot(buff[0].release.slot)
+        else:
+            try:
+                self.queue.put(buff,block = False)
+            except Full:
+                self.nframes_overflow.value += nframes
+                self.queue.put(buff)
+
+    def _drain_spill(self,block = False):
+        '''Moves spilled items to the queue while there is space (or waits if block).'''
+        while self._spill.nitems:
+            try:
+                self.queue.put(self._spill.peek(),block = block)
+            except Full:
+                return
+            self._spill.pop()
+
+    def _queue_frame(self,frame,metadata,stamps = None):
+        '''
+        Puts a frame in the recorder queue, or adds it to the current block
+        when batch_size > 1. Blocks are sent as (frames,metadata[,stamps])
+        where frames is a [nframes,...] array and metadata a structured array
+        with a record per frame.
+        '''
+        if self.batch_size <= 1:
+            frame = self._pool_handoff(frame)
+            if stamps is None:
+                self._queue_put((frame,metadata))
+            else:
+                self._queue_put((frame,metadata,stamps))
+            return
+        frame = np.asarray(frame)
+        metadtype = [('f{0}'.format(i),
+                      np.int64 if isinstance(m,(int,np.integer)) else np.float64)
+                     for i,m in enumerate(metadata)]
+        if not self._batch is None and (
+                not self._batch.shape[1:] == frame.shape or
+                not self._batch.dtype == frame.dtype or
+                not self._batch_meta.dtype == np.dtype(metadtype)):
+            self._flush_batch()
+        if self._batch is None:
+            # a new block for every batch; the queue pickles it later
+            self._batch = np.empty([self.batch_size] + list(frame.shape),
+                                   dtype = frame.dtype)
+            self._batch_meta = np.empty(self.batch_size,dtype = metadtype)
+            self._batch_stamps = None
+            if not stamps is None:
+                self._batch_stamps = np.empty([self.batch_size,len(stamps)])
+            self._nbatch = 0
+            self._tbatch = time.time()
+        self._batch[self._nbatch] = frame
+        self._batch_meta[self._nbatch] = tuple(metadata)
+        if not self._batch_stamps is None:
+            self._batch_stamps[self._nbatch] = stamps
+        self._nbatch += 1
+        if self._nbatch == self.batch_size:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        '''Sends the frames in the current block to the recorder queue.'''
+        if self._batch is None:
+            return
+        n = self._nbatch
+        if n:
+            if self._batch_stamps is None:
+                self._queue_put((self._batch[:n],self._batch_meta[:n]))
+            else:
+                self._queue_put((self._batch[:n],self._batch_meta[:n],
+                                 self._batch_stamps[:n]))
+        self._batch = None
+        self._nbatch = 0
+
     def _handle_frame(self,frame,metadata):
         #display('loop rate : {0}'.format(1./(timestamp - self.lasttime)))
+        if not frame is None and not metadata[0] == self.lastframeid:
+            self._check_dropped(*metadata[:2])
+        if not self._spill is None and self._spill.nitems:
+            self._drain_spill()
         if self.saving.is_set():
+            if not self.was_saving:
+                self._start_run()
             self.was_saving = True
             if not frame is None:
                 if not metadata[0] == self.lastframeid :
-                    if not self.recorder is None:
-                        self.recorder.save(frame,metadata)
+                    if self.stage_latency is None:
+                        if not self.recorder is None:
+                            self.recorder.save(frame,metadata)
+                        else:
+                            self._queue_frame(frame,metadata)
                     else:
-                        self.queue.put((frame,metadata))
+                        tenqueue = time.time()
+                        self.stage_latency.add('camera',tenqueue - self._tsdk)
+                        if not self.recorder is None:
+                            self.recorder.save(frame,metadata,
+                                               (self._tsdk,tenqueue))
+                        else:
+                            self._queue_frame(frame,metadata,
+                                              (self._tsdk,tenqueue))
         elif self.was_saving:
             if self.recorder is None:
                 self.was_saving = False            
                 display('[Camera] Sending stop signal to the recorder.')
-                self.queue.put(['STOP'])
+                self._send_stop()
             else:
                 self.was_saving = False            
                 self.recorder.close_run()
@@ -190,9 +566,13 @@ class GenericCam(Process):
                 #self.nframes.value += 1
             self.lastframeid = frameID
             self.lasttime = timestamp
+            self._release_pool_buffer(frame)
+        if self._nbatch and (time.time() - self._tbatch) > self.batch_latency:
+            # so that low frame rates still get written
+            self._flush_batch()
         
     def _update_buffer(self,frame,frameID):
-        self.img[:] = np.reshape(frame,self.img.shape)[:]
+        self._publish_img(frame,frameID)
         #self.memlist[0] = np.reshape(frame,[self.h,self.w,self.nchan])
     def _parse_command_queue(self):
         if not self.eventsQ.empty():
@@ -210,10 +590,7 @@ class GenericCam(Process):
                     msg = '# {0},{1} - {2}'.format(
                         self.lastframeid,
                         self.lasttime,cmd[1])
-                    if self.recorder is None:
-                        self.queue.put([msg])
-                    else:
-                        self.recorder.logfile.write(msg)
+                    self._log_message(msg)
                     
     def _call_event(self,eventname,eventvalue):
         if eventname in self.ctrevents.keys():
@@ -333,6 +710,7 @@ class OpenCVCam(GenericCam):
         self.lastframeid = -1
         self.cam = cv2.VideoCapture(self.cam_id)
         self.set_framerate(self.frame_rate)        
+        self._init_frame_pool((self.h,self.w,self.nchan),self.dtype)
         self.camera_ready.set()
         self.nframes.value = 0
     def _cam_loop(self):
@@ -343,10 +721,185 @@ class OpenCVCam(GenericCam):
         if not ret_val:
             return
         timestamp = time.time()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB,
+                             dst = self._get_pool_buffer())
         return frame,(frameID,timestamp)
 
     def _cam_close(self):
         self.cam.release()
         display('[OpenCV {0}] - Stopped acquisition.'.format(self.cam_id))
         
+
+# Simulated camera; generates frames without hardware (for testing and benchmarks)
+class SimulatedCam(GenericCam):
+    def __init__(self,
+                 camId = 0,
+                 outQ = None,
+                 height = 480,
+                 width = 640,
+                 nchan = 1,
+                 dtype = 'uint8',
+                 frameRate = 30.,
+                 pattern = 'noise',
+                 nBankFrames = 32,
+                 nFrameBuffers = 10,
+                 filename = None,
+                 triggered = Event(),
+                 recorderpar = None,
+                 **kwargs):
+        '''
+        Simulated camera that produces frames at a fixed rate.
+            pattern can be:
+                noise   - random frames (from a bank of nBankFrames)
+                gratings - moving sinusoidal gratings
+                frameid - the frame id is encoded in the first 8 pixels 
+                          (one byte per pixel, little endian)
+            filename - replays frames from a binary file (see mmap_dat);
+                       the shape and dtype are taken from the file.
+        '''
+        super(SimulatedCam,self).__init__(outQ = outQ, recorderpar = recorderpar)
+        self.drivername = 'Simulated'
+        self.cam_id = camId
+        self.h = int(height)
+        self.w = int(width)
+        self.nchan = int(nchan)
+        self.dtype = np.dtype(dtype).type
+        self.frame_rate = float(frameRate)
+        self.pattern = pattern.lower()
+        self.nbank = int(nBankFrames)
+        self.nbuffers = int(nFrameBuffers)
+        self.filename = filename
+        self._source = None
+        if not self.filename is None:
+            self.pattern = 'file'
+            source = self._open_source()
+            self.dtype = source.dtype.type
+            if len(source.shape) == 4:
+                self.nchan,self.h,self.w = source.shape[1:]
+            else:
+                self.nchan = 1
+                self.h,self.w = source.shape[1:]
+            del source
+        self._init_variables(dtype = self.dtype)
+        self._make_bank()
+        self.img[:] = np.reshape(self._bank[0],self.img.shape)[:]
+        self.triggered = triggered
+        if self.triggered.is_set():
+            display('[Simulated {0}] Triggered mode ON (hardware triggers are not simulated).'.format(self.cam_id))
+        display('[Simulated {0}] {1}x{2}x{3} {4} frames at {5} fps ({6}).'.format(
+            self.cam_id,self.h,self.w,self.nchan,
+            np.dtype(self.dtype).name,self.frame_rate,self.pattern))
+
+    def _init_controls(self):
+        self.ctrevents = dict(
+            framerate=dict(
+                function = 'set_framerate',
+                widget = 'float',
+                variable = 'frame_rate',
+                units = 'fps',
+                type = 'float',
+                min = 0.1,
+                max = 10000,
+                step = 1))
+
+    def set_framerate(self,framerate = 30.):
+        '''Set frame rate in frames per second'''
+        self.frame_rate = float(framerate)
+        display('[Simulated {0}] Set frame_rate to: {1}.'.format(self.cam_id,
+                                                                 self.frame_rate))
+
+    def _make_bank(self):
+        '''Pre-computes frames so the generation does not limit the frame rate.'''
+        shape = [self.nbank,self.h,self.w]
+        if self.nchan > 1:
+            shape += [self.nchan]
+        vmax = np.iinfo(self.dtype).max if np.issubdtype(
+            self.dtype,np.integer) else 1.
+        if self.pattern == 'file':
+            self._bank = self._source_frame(self._open_source(),0)[np.newaxis]
+        elif self.pattern == 'gratings':
+            x = np.arange(self.w,dtype = np.float32)
+            phase = np.linspace(0,2*np.pi,self.nbank,endpoint = False)
+            grat = 0.5*(1 + np.sin(2*np.pi*x[np.newaxis,:]/64. +
+                                   phase[:,np.newaxis]))
+            bank = np.broadcast_to(grat[:,np.newaxis,:],[self.nbank,self.h,self.w])
+            if self.nchan > 1:
+                bank = np.broadcast_to(bank[...,np.newaxis],shape)
+            self._bank = (bank*vmax).astype(self.dtype)
+        elif self.pattern == 'frameid':
+            self._bank = np.zeros(shape[1:],dtype = self.dtype)[np.newaxis]
+        else:
+            if not self.pattern == 'noise':
+                display('[Simulated {0}] Unknown pattern {1}, using noise.'.format(
+                    self.cam_id,self.pattern))
+                self.pattern = 'noise'
+            rng = np.random.default_rng(0)
+            self._bank = (rng.random(shape,dtype = np.float32)*vmax).astype(self.dtype)
+
+    def _open_source(self):
+        from .io import mmap_dat
+        return mmap_dat(self.filename,dtype = None)
+
+    def _source_frame(self,source,iframe):
+        frame = source[np.mod(iframe,len(source))]
+        if frame.ndim == 3:
+            # files are NCHANNELS x H x W
+            frame = frame.transpose([1,2,0])
+            if frame.shape[2] == 1:
+                frame = frame[:,:,0]
+        return np.ascontiguousarray(frame)
+
+    @staticmethod
+    def frame_id_from_frame(frame):
+        '''Decodes the frame id from a frame recorded with the frameid pattern.'''
+        frame = np.asarray(frame)
+        if frame.ndim > 2:
+            frame = frame[...,0]
+        return int(np.frombuffer(frame[0,:8].astype(np.uint8).tobytes(),
+                                 dtype = '<i8')[0])
+
+    def _cam_init(self):
+        self.nframes.value = 0
+        self.lastframeid = -1
+        if self.pattern == 'file' and self._source is None:
+            # opened in the acquisition process, memory maps are not shared
+            self._source = self._open_source()
+        if self._pool is None:
+            self._init_frame_pool(self._bank.shape[1:],self._bank.dtype)
+        self.camera_ready.set()
+
+    def _cam_startacquisition(self):
+        display('[Simulated {0}] - Started acquisition.'.format(self.cam_id))
+        self._tstart = time.perf_counter()
+        self._nextid = 0
+        
+    def _cam_loop(self):
+        # frame k is ready at tstart + k/frame_rate; like a camera with
+        # nFrameBuffers, frames are lost when the loop falls behind.
+        period = 1./self.frame_rate
+        tnow = time.perf_counter()
+        navailable = int((tnow - self._tstart)/period)
+        if navailable - self._nextid > self.nbuffers:
+            self._nextid = navailable - self.nbuffers
+        tframe = self._tstart + self._nextid*period
+        if tframe > tnow:
+            time.sleep(tframe - tnow)
+        frameID = self._nextid
+        self._nextid += 1
+        if self.pattern == 'file':
+            frame = self._source_frame(self._source,frameID)
+        elif self.pattern == 'frameid':
+            # copied to the pool like a driver copies from the SDK
+            frame = self._get_pool_buffer()
+            frame[:] = self._bank[0]
+            chan = frame if frame.ndim == 2 else frame[...,0]
+            chan[0,:8] = np.frombuffer(np.int64(frameID).tobytes(),
+                                       dtype = np.uint8)
+        else:
+            frame = self._bank[np.mod(frameID,self.nbank)]
+        timestamp = time.time()
+        self.nframes.value = frameID
+        return frame,(frameID,timestamp)
+
+    def _cam_close(self):
+        display('[Simulated {0}] - Stopped acquisition.'.format(self.cam_id))
@@ -18,6 +18,7 @@ from .utils import *
 from .cams import *
 from .io import *
 from .widgets import *
+from .io import _volume_id
 
 LOGO = '''
                                              MMM
@@ -47,6 +48,25 @@ LOGO = '''
 
 N_UDP = 1024
 
+def _binary_options(cam):
+    '''Binary recorder options (blocksize, preallocate, direct) from the camera settings.'''
+    options = dict()
+    for k in ['blocksize','preallocate','direct']:
+        if 'binary_' + k in cam.keys():
+            options[k] = cam['binary_' + k]
+    return options
+
+def _hdf5_options(cam):
+    '''HDF5 recorder options from the camera settings (compress is the blosc level).'''
+    options = dict(compression = cam['compress'])
+    if 'hdf5_codec' in cam.keys():
+        options['codec'] = cam['hdf5_codec']
+    if 'compress_threads' in cam.keys():
+        options['compression_threads'] = cam['compress_threads']
+    if 'hdf5_chunk_frames' in cam.keys():
+        options['chunkframes'] = cam['hdf5_chunk_frames']
+    return options
+
 class LabCamsGUI(QMainWindow):
     app = None
     cams = []
@@ -130,7 +150,10 @@ class LabCamsGUI(QMainWindow):
             if not 'recorder_path_format' in self.parameters.keys():
                 self.parameters['recorder_path_format'] = pjoin('{datafolder}','{dataname}','{filename}','{today}_{run}_{nfiles}')
 
-            self.camQueues.append(Queue())
+            if 'recording_queue_size' in cam.keys() and cam['recording_queue_size'] > 0:
+                self.camQueues.append(Queue(maxsize = int(cam['recording_queue_size'])))
+            else:
+                self.camQueues.append(Queue())
             if 'noqueue' in cam['recorder']:
                 recorderpar = dict(
                     recorder = cam['recorder'],
@@ -143,6 +166,19 @@ class LabCamsGUI(QMainWindow):
                 if 'ffmpeg' in cam['recorder']:
                     if 'hwaccel' in cam.keys():
                         recorderpar['hwaccel'] = cam['hwaccel']
+                if 'binary' in cam['recorder']:
+                    recorderpar.update(_binary_options(cam))
+                if 'tiff' in cam['recorder'] and 'compress_threads' in cam.keys():
+                    recorderpar['compression_threads'] = cam['compress_threads']
+                if 'hdf5' in cam['recorder']:
+                    recorderpar.update(_hdf5_options(cam))
+                if 'recording_log_format' in cam.keys():
+                    recorderpar['log_format'] = cam['recording_log_format']
+                if 'recording_checkpoint_interval' in cam.keys():
+                    recorderpar['checkpoint_interval'] = cam['recording_checkpoint_interval']
+                if 'recorder_stripe' in self.parameters.keys():
+                    recorderpar['stripe'] = self.parameters['recorder_stripe']
+                recorderpar['stripe_offset'] = c
             else:
                 display('Using the queue for recording.')
                 recorderpar = None # Use a queue recorder
@@ -375,11 +411,55 @@ class LabCamsGUI(QMainWindow):
                                               triggered = self.triggered,
                                               recorderpar = recorderpar,
                                               hardware_trigger = cam['hardware_trigger']))
+            elif cam['driver'].lower() == 'simulated':
+                if not 'id' in cam.keys():
+                    cam['id'] = c
+                self.cams.append(SimulatedCam(camId=cam['id'],
+                                              outQ = self.camQueues[-1],
+                                              triggered = self.triggered,
+                                              recorderpar = recorderpar,
+                                              **{k:cam[k] for k in cam.keys()
+                                                 if k in ['height','width','nchan','dtype',
+                                                          'frameRate','pattern',
+                                                          'nBankFrames','nFrameBuffers']}))
             else: 
                 display('[WARNING] -----> Unknown camera driver' +
                         cam['driver'])
                 self.camQueues.pop()
                 self.saveflags.pop()
+            if not 'recording_buffer' in cam.keys():
+                cam['recording_buffer'] = 'queue'
+            if cam['recording_buffer'] == 'ring' and not 'noqueue' in cam['recorder']:
+                if not 'recording_buffer_size' in cam.keys():
+                    cam['recording_buffer_size'] = 64
+                display('Using a shared memory ring ({0} frames) for recording.'.format(
+                    cam['recording_buffer_size']))
+                self.camQueues[-1] = FrameRingBuffer(h = self.cams[-1].h,
+                                                     w = self.cams[-1].w,
+                                                     nchan = self.cams[-1].nchan,
+                                                     dtype = self.cams[-1].dtype,
+                                                     nslots = cam['recording_buffer_size'])
+                self.cams[-1].queue = self.camQueues[-1]
+            elif 'recording_batch_size' in cam.keys() and not 'noqueue' in cam['recorder']:
+                self.cams[-1].batch_size = int(cam['recording_batch_size'])
+                if 'recording_batch_latency' in cam.keys():
+                    self.cams[-1].batch_latency = float(cam['recording_batch_latency'])
+                display('Sending frames to the recorder in blocks of {0}.'.format(
+                    self.cams[-1].batch_size))
+            if not 'noqueue' in cam['recorder']:
+                if 'recording_queue_size' in cam.keys():
+                    self.cams[-1].queue_size = int(cam['recording_queue_size'])
+                if cam['recording_buffer'] == 'ring':
+                    self.cams[-1].queue_size = cam['recording_buffer_size']
+                if 'recording_queue_policy' in cam.keys():
+                    if not cam['recording_queue_policy'] in ['block','drop','spill']:
+                        raise ValueError('Unknown recording_queue_policy {0}'.format(
+                            cam['recording_queue_policy']))
+                    self.cams[-1].queue_policy = cam['recording_queue_policy']
+                if 'recording_spill_path' in cam.keys() and len(cam['recording_spill_path']):
+                    self.cams[-1].spill_folder = cam['recording_spill_path']
+            if 'recording_latency' in cam.keys() and cam['recording_latency']:
+                self.cams[-1].stage_latency = PipelineLatency()
             if not 'recorder_sleep_time' in self.parameters.keys():
                 self.parameters['recorder_sleep_time'] = 0.3
             if 'SaveMethod' in cam.keys():
@@ -395,7 +475,10 @@ class LabCamsGUI(QMainWindow):
                                 dataname = cam['description'])
                 if  cam['recorder'] == 'tiff':
                     display('Recording to TIFF')
+                    if not 'compress_threads' in cam.keys():
+                        cam['compress_threads'] = 0
                     self.writers.append(TiffWriter(compression = cam['compress'],
+                                                   compression_threads = cam['compress_threads'],
                                                    **towriter))
                 elif cam['recorder'] == 'ffmpeg':
                     display('Recording with ffmpeg')
@@ -406,16 +489,33 @@ class LabCamsGUI(QMainWindow):
                                                      **towriter))
                 elif cam['recorder'] == 'binary':
                     display('Recording binary')
-                    self.writers.append(BinaryWriter(**towriter))
+                    self.writers.append(BinaryWriter(**_binary_options(cam),
+                                                     **towriter))
                 elif cam['recorder'] == 'opencv':
                     display('Recording opencv')
                     self.writers.append(OpenCVWriter(compression = cam['compress'],**towriter))
+                elif cam['recorder'] == 'hdf5':
+                    display('Recording hdf5')
+                    self.writers.append(HDF5Writer(**_hdf5_options(cam),
+                                                   **towriter))
+                elif cam['recorder'] == 'lossless':
+                    display('Recording lossless')
+                    if not 'lossless_codec' in cam.keys():
+                        cam['lossless_codec'] = 'jp2'
+                    if not 'lossless_workers' in cam.keys():
+                        cam['lossless_workers'] = 0
+                    self.writers.append(LosslessWriter(codec = cam['lossless_codec'],
+                                                       compression = max(cam['compress'],1),
+                                                       workers = cam['lossless_workers'],
+                                                       **towriter))
                 else:
                     print(''' 
 
 The available recorders are:
     - tiff (multiple tiffstacks - the default)   
     - binary 
+    - hdf5    Chunked hdf5 files compressed with blosc (needs h5py and hdf5plugin)
+    - lossless  Lossless JPEG-2000, png or zlib encoded by a pool of processes (read with LosslessStack)
     - ffmpeg  Records video format using ffmpeg (hwaccel options: intel, nvidia - remove for no hardware acceleration)
     - opencv  Records video format using openCV
 
@@ -424,6 +524,15 @@ The recorders can be specified with the '"recorder":"ffmpeg"' option in each cam
                     raise ValueError('Unknown recorder {0} '.format(cam['recorder']))
             else:
                 self.writers.append(None)
+            if not self.writers[-1] is None:
+                self.writers[-1].stage_latency = self.cams[-1].stage_latency
+                if 'recording_log_format' in cam.keys():
+                    self.writers[-1].log_format = cam['recording_log_format']
+                if 'recording_checkpoint_interval' in cam.keys():
+                    self.writers[-1].checkpoint_interval = cam['recording_checkpoint_interval']
+                if 'recorder_stripe' in self.parameters.keys():
+                    self.writers[-1].stripe = self.parameters['recorder_stripe']
+                self.writers[-1].stripe_offset = c
                 
             if 'CamStimTrigger' in cam.keys():
                 self.camstim_widget.outQ = self.camQueues[-1]
@@ -432,6 +541,7 @@ The recorders can be specified with the '"recorder":"ffmpeg"' option in each cam
             for k in np.sort(list(cam.keys())):
                 if not k == 'name' and not k == 'recorder':
                     display('\t\t - {0} {1}'.format(k,cam[k]))
+        self.check_bandwidth()
         #self.resize(100,100)
 
         self.initUI()
@@ -458,6 +568,67 @@ The recorders can be specified with the '"recorder":"ffmpeg"' option in each cam
         self.triggerCams(soft_trigger = self.software_trigger,
                          save=self.saveOnStart)
 
+    def check_bandwidth(self):
+        '''
+        Compares the write bandwidth needed by the cameras that record with a
+        quick write test of the recorder path(s), before the cameras start.
+        recording_bandwidth_check: warn (default), refuse (exit when the disk
+        is too slow) or off. The result is written to the camlog of each run.
+        '''
+        check = 'warn'
+        if 'recording_bandwidth_check' in self.parameters.keys():
+            check = self.parameters['recording_bandwidth_check']
+        if check == 'off':
+            return
+        required = 0
+        for cam,desc,flg in zip(self.cams,self.cam_descriptions,self.saveflags):
+            if not flg:
+                continue
+            frame_rate = None
+            if hasattr(cam,'frame_rate'):
+                frame_rate = cam.frame_rate
+            elif 'frameRate' in desc.keys():
+                frame_rate = desc['frameRate']
+            if cam.h is None or not frame_rate:
+                display('[bandwidth] Unknown frame size or rate for {0}, not checked.'.format(desc['name']))
+                continue
+            dtype = cam.dtype if hasattr(cam,'dtype') else np.uint16
+            required += recording_bandwidth((cam.h,cam.w,cam.nchan),dtype,frame_rate,
+                                            recorder = desc['recorder'],
+                                            compress = desc['compress'])
+        if required == 0:
+            return
+        folders = self.parameters['recorder_path']
+        if not type(folders) is list:
+            folders = [folders]
+        measured = dict()  # folders on the same volume are measured once
+        for folder in folders:
+            try:
+                volume = _volume_id(folder)
+                if not volume in measured.keys():
+                    measured[volume] = measure_write_bandwidth(folder)
+            except OSError as err:
+                display('[bandwidth] Could not test {0}: {1}'.format(folder,err))
+        if not len(measured):
+            return
+        available = np.sum(list(measured.values()))
+        headroom = available/required
+        msg = 'Bandwidth: recording needs {0:.1f} MB/s, {1} wrote {2:.1f} MB/s (headroom {3:.2f}x)'.format(
+            required/1e6,', '.join(folders),available/1e6,headroom)
+        display('[bandwidth] ' + msg)
+        for cam,writer in zip(self.cams,self.writers):
+            if not writer is None:
+                writer.log_comments = writer.log_comments + [msg]
+            elif not cam.recorderpar is None:
+                cam.recorderpar['log_comments'] = [msg]
+        if headroom < 1:
+            if check == 'refuse':
+                display('[ERROR] The recorder path can not sustain the recording, change recording_bandwidth_check to start anyway.')
+                sys.exit(1)
+            display('[WARNING] The recorder path may not sustain the recording: frames will pile up in memory or be dropped.')
+        elif headroom < 1.5:
+            display('[WARNING] Little bandwidth headroom, other programs writing to the disk may slow the recording.')
+
     def setExperimentName(self,expname):
         # Makes sure that the experiment name has the right slashes.
         if os.path.sep == '/':
@@ -541,9 +712,11 @@ The recorders can be specified with the '"recorder":"ffmpeg"' option in each cam
                                                     self.saveflags,
                                                     self.writers)):
                 if flg:
+                    if not cam.stage_latency is None:
+                        cam.stage_latency.reset()
                     cam.saving.set()
                     if not writer is None:
-                        writer.write.set()
+                        writer.start_write()
         else:
             for c,(cam,flg,writer) in enumerate(zip(self.cams,
                                                     self.saveflags,
@@ -552,6 +725,9 @@ The recorders can be specified with the '"recorder":"ffmpeg"' option in each cam
                     if not writer is None:
                         cam.stop_saving()
                     #writer.write.clear() # cam stops writer
+                    if not cam.stage_latency is None:
+                        display('Camera [{0}] latency: {1}'.format(
+                            c,cam.stage_latency.describe()))
         #time.sleep(2)
         if soft_trigger:
             for c,cam in enumerate(self.cams):
@@ -630,7 +806,8 @@ The recorders can be specified with the '"recorder":"ffmpeg"' option in each cam
                 #self.camwidgets[c].image(frame,cam.nframes.value)
                 frame = cam.get_img()
                 if not frame is None:
-                    self.camwidgets[c].image(frame,cam.nframes.value) #frame
+                    self.camwidgets[c].image(frame,cam.nframes.value,
+                                             cam.nframes_dropped.value) #frame
             except Exception as e:
                 display('Could not draw cam: {0}'.format(c))
                 exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -702,9 +879,38 @@ def main():
     parser.add_argument('--mj2-rate',
                         default=30.,
                         action='store')
+    parser.add_argument('--mj2-workers',
+                        default=0,
+                        type=int,
+                        help='Processes encoding chunks of the file (0 is one per core)',
+                        action='store')
+    parser.add_argument('--mj2-chunk',
+                        default=512,
+                        type=int,
+                        help='Frames per chunk',
+                        action='store')
+    parser.add_argument('--mj2-no-verify',
+                        default=False,
+                        help='Do not decode the movie to compare with the binary file',
+                        action='store_true')
+    parser.add_argument('--recover',
+                        default=None,
+                        type=str,
+                        help='Check the runs in a folder after a crash: truncates partial frames and rebuilds the camlog and frame index',
+                        action='store')
+    parser.add_argument('--dry-run',
+                        default=False,
+                        help='With --recover, only report what was lost',
+                        action='store_true')
     
     opts = parser.parse_args()
 
+    if not opts.recover is None:
+        from labcams.io import recover_folder
+        assert os.path.isdir(opts.recover), "Folder {0} not found".format(opts.recover)
+        recover_folder(opts.recover,dry_run = opts.dry_run)
+        sys.exit(0)
+
     if opts.bin_to_mj2:
         from labcams.io import mmap_dat
         
@@ -715,7 +921,10 @@ def main():
         ext = os.path.splitext(fname)[-1]
         assert ext in ['.dat','.bin'], "File {0} needs to be binary.".format(fname)  
         stack = mmap_dat(fname)
-        stack_to_mj2_lossless(stack, fname, rate = opts.mj2_rate)
+        stack_to_mj2_lossless(stack, fname, rate = opts.mj2_rate,
+                              nworkers = opts.mj2_workers,
+                              chunksize = opts.mj2_chunk,
+                              verify = not opts.mj2_no_verify)
         print('Converted {0}'.format(fname.replace(ext,'.mov')))
         sys.exit(0)
         
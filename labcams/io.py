@@ -18,23 +18,497 @@
 import time
 import sys
 from multiprocessing import Process,Queue,Event,Array,Value
+from multiprocessing import RawArray,RawValue,Semaphore,Lock
+from queue import Empty,Full
+import ctypes
 from ctypes import c_long, c_char_p
 from datetime import datetime
 import time
 import sys
-from .utils import display
+from .utils import display,chunk_indices
 import numpy as np
 import os
+import pickle
+from io import BytesIO
+import tempfile
+import shutil
+import zlib
+import re
+import json
+import struct
+import subprocess
+import threading
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+from collections import deque,OrderedDict
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
 from glob import glob
 from os.path import join as pjoin
 from tifffile import imread, TiffFile
 from tifffile import TiffWriter as twriter
 import pandas as pd
-from skvideo.io import FFmpegWriter
 import cv2
 
 VERSION = '0.6'
 
+class FrameRingBuffer(object):
+    '''
+    Ring of preallocated frame slots in shared memory.
+
+    Has the put/get/qsize/empty interface of multiprocessing.Queue so it can
+    be used in place of the recording queue between a camera and a writer.
+    Each frame is copied once into a slot by the camera process and the
+    writer gets a view of the slot; the slot is released on the next get.
+    Messages (['STOP'] or ['# comment']) use the same slots so they stay in
+    order with the frames. Latency stamps (third element of the tuple) are
+    passed along when present.
+
+    Inputs:
+        h,w,nchan (int)      : frame dimensions
+        dtype                : frame datatype
+        nslots (int)         : number of frame slots (default 64)
+        nmeta (int)          : max number of metadata values per frame
+        msgsize (int)        : max size of a message (bytes)
+
+    Example:
+        ring = FrameRingBuffer(cam.h, cam.w, cam.nchan, cam.dtype)
+        cam.queue = ring
+        writer = BinaryWriter(inQ = ring)
+    '''
+    def __init__(self, h, w, nchan = 1, dtype = np.uint8,
+                 nslots = 64, nmeta = 8, msgsize = 1024):
+        self.h = int(h)
+        self.w = int(w)
+        self.nchan = int(nchan)
+        self.dtype = np.dtype(dtype)
+        self.nslots = int(nslots)
+        self.nmeta = int(nmeta)
+        self.msgsize = int(msgsize)
+        self.nstamps = 4
+        self.framebytes = self.h*self.w*self.nchan*self.dtype.itemsize
+        self._frames = RawArray(ctypes.c_ubyte,self.nslots*self.framebytes)
+        self._meta_int = RawArray(ctypes.c_int64,self.nslots*self.nmeta)
+        self._meta_float = RawArray(ctypes.c_double,self.nslots*self.nmeta)
+        self._meta_isint = RawArray(ctypes.c_ubyte,self.nslots*self.nmeta)
+        # number of metadata values in the slot, -1 for a message
+        self._slot_nmeta = RawArray(ctypes.c_int,self.nslots)
+        self._slot_shape = RawArray(ctypes.c_int,self.nslots*3)
+        self._slot_ndim = RawArray(ctypes.c_ubyte,self.nslots)
+        self._stamps = RawArray(ctypes.c_double,self.nslots*self.nstamps)
+        self._slot_nstamps = RawArray(ctypes.c_ubyte,self.nslots)
+        self._msg = RawArray(ctypes.c_char,self.nslots*self.msgsize)
+        self._nwritten = RawValue(ctypes.c_int64,0)
+        self._nread = RawValue(ctypes.c_int64,0)
+        self._filled = Semaphore(0)
+        self._free = Semaphore(self.nslots)
+        self._putlock = Lock()
+        self._init_views()
+
+    def _init_views(self):
+        self._views = np.frombuffer(self._frames,dtype = self.dtype).reshape(
+            [self.nslots,self.h*self.w*self.nchan])
+        self._shapes = np.frombuffer(self._slot_shape,dtype = np.int32).reshape(
+            [self.nslots,3])
+        self._mint = np.frombuffer(self._meta_int,dtype = np.int64).reshape(
+            [self.nslots,self.nmeta])
+        self._mfloat = np.frombuffer(self._meta_float,dtype = np.float64).reshape(
+            [self.nslots,self.nmeta])
+        self._misint = np.frombuffer(self._meta_isint,dtype = np.uint8).reshape(
+            [self.nslots,self.nmeta])
+        self._tstamps = np.frombuffer(self._stamps,dtype = np.float64).reshape(
+            [self.nslots,self.nstamps])
+        self._held = False
+
+    def __getstate__(self):
+        # numpy views are rebuilt on the other side
+        state = self.__dict__.copy()
+        for k in ['_views','_shapes','_mint','_mfloat','_misint','_tstamps','_held']:
+            state.pop(k,None)
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._init_views()
+
+    def qsize(self):
+        return int(self._nwritten.value - self._nread.value)
+
+    def empty(self):
+        return self.qsize() <= 0
+
+    def full(self):
+        return self.qsize() >= self.nslots
+
+    def put(self,buff,block = True,timeout = None):
+        if not self._free.acquire(block,timeout):
+            raise Full
+        with self._putlock:
+            islot = self._nwritten.value % self.nslots
+            if len(buff) == 1:
+                msg = str(buff[0]).encode('utf-8')[:self.msgsize-1]
+                start = islot*self.msgsize
+                self._msg[start:start+len(msg)+1] = msg + b'\0'
+                self._slot_nmeta[islot] = -1
+            else:
+                frame,metadata = buff[:2]
+                frame = np.asarray(frame)
+                # frames can have less channels than the slot (e.g. PCO with
+                # the excitation trigger)
+                self._views[islot][:frame.size] = frame.reshape(-1)
+                self._shapes[islot][:frame.ndim] = frame.shape
+                self._slot_ndim[islot] = frame.ndim
+                nmeta = min(len(metadata),self.nmeta)
+                for i in range(nmeta):
+                    if isinstance(metadata[i],(int,np.integer)):
+                        self._mint[islot,i] = metadata[i]
+                        self._misint[islot,i] = 1
+                    else:
+                        self._mfloat[islot,i] = metadata[i]
+                        self._misint[islot,i] = 0
+                self._slot_nmeta[islot] = nmeta
+                nstamps = 0
+                if len(buff) > 2:
+                    nstamps = min(len(buff[2]),self.nstamps)
+                    self._tstamps[islot,:nstamps] = buff[2][:nstamps]
+                self._slot_nstamps[islot] = nstamps
+            self._nwritten.value += 1
+        self._filled.release()
+
+    def put_nowait(self,buff):
+        return self.put(buff,block = False)
+
+    def _release(self):
+        if self._held:
+            self._held = False
+            self._free.release()
+
+    def get(self,block = True,timeout = None):
+        '''
+        Returns (frame,metadata), (frame,metadata,stamps) or [message].
+        The frame is a view of the slot; it is valid until the next get.
+        '''
+        self._release()
+        if not self._filled.acquire(block,timeout):
+            raise Empty
+        islot = self._nread.value % self.nslots
+        self._nread.value += 1
+        self._held = True
+        nmeta = self._slot_nmeta[islot]
+        if nmeta < 0:
+            start = islot*self.msgsize
+            msg = self._msg[start:start+self.msgsize].split(b'\0')[0]
+            return [msg.decode('utf-8')]
+        shape = self._shapes[islot][:self._slot_ndim[islot]]
+        frame = self._views[islot][:np.prod(shape)].reshape(shape)
+        metadata = tuple([int(self._mint[islot,i]) if self._misint[islot,i]
+                          else float(self._mfloat[islot,i])
+                          for i in range(nmeta)])
+        nstamps = self._slot_nstamps[islot]
+        if nstamps:
+            return frame,metadata,tuple(self._tstamps[islot,:nstamps].tolist())
+        return frame,metadata
+
+    def get_nowait(self):
+        return self.get(block = False)
+
+################################################################################
+################################################################################
+################################################################################
+class SpillFile(object):
+    '''
+    First in first out store of queue items (frames or messages) in a
+    scratch file. The cameras spill to it when the recording queue is full
+    (recording_queue_policy spill) and move the items back to the queue when
+    there is space, so the order is kept.
+
+    Inputs:
+        folder (str)         : where to create the scratch file (default is the temporary folder)
+
+    Example:
+        spill = SpillFile()
+        spill.put((frame,metadata))
+        item = spill.peek()   # next item (None if empty)
+        spill.pop()           # removes it
+    '''
+    def __init__(self, folder = None, prefix = 'labcams_spill_'):
+        self.folder = folder
+        self.prefix = prefix
+        self.fd = None
+        self.filename = None
+        self.nitems = 0
+        self._next = None
+        self._readpos = 0
+
+    def _open(self):
+        if not self.folder is None and not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        fd,self.filename = tempfile.mkstemp(prefix = self.prefix,
+                                            suffix = '.spill',
+                                            dir = self.folder)
+        self.fd = os.fdopen(fd,'w+b')
+        self._readpos = 0
+
+    def put(self,item):
+        if self.fd is None:
+            self._open()
+        self.fd.seek(0,os.SEEK_END)
+        pickle.dump(item,self.fd,protocol = pickle.HIGHEST_PROTOCOL)
+        self.nitems += 1
+
+    def peek(self):
+        if self._next is None and self.nitems:
+            self.fd.flush()
+            self.fd.seek(self._readpos)
+            self._next = pickle.load(self.fd)
+            self._readpos = self.fd.tell()
+        return self._next
+
+    def pop(self):
+        item = self.peek()
+        self._next = None
+        self.nitems -= 1
+        if self.nitems == 0:
+            # start over so the file does not grow
+            self.fd.seek(0)
+            self.fd.truncate()
+            self._readpos = 0
+        return item
+
+    def close(self):
+        if not self.fd is None:
+            self.fd.close()
+            os.remove(self.filename)
+        self.fd = None
+        self.nitems = 0
+        self._next = None
+
+################################################################################
+################################################################################
+################################################################################
+# Frame index (.camidx): one fixed size record per frame, after a 16 byte header
+CAMIDX_DTYPE = np.dtype([('frame_id','<i8'),     # camera frame id
+                         ('timestamp','<f8'),    # camera (hardware) timestamp
+                         ('host_time','<f8'),    # host time (s)
+                         ('file','<i4'),         # file number in the run
+                         ('index','<i4'),        # frame number in the file
+                         ('offset','<i8')])      # byte offset in the file (-1 if unknown)
+_CAMIDX_MAGIC = b'LCAMIDX1'
+
+class FrameIndexFile(object):
+    '''
+    Writes the frame index (.camidx) of a run, read it with FrameIndex.
+
+    Records (CAMIDX_DTYPE) are buffered and written in blocks.
+
+    Inputs:
+        filename (str)
+        blocksize (int)      : records written at once
+    '''
+    def __init__(self, filename, blocksize = 256):
+        self.filename = filename
+        self.fd = open(filename,'wb')
+        self.fd.write(_CAMIDX_MAGIC + struct.pack('<Q',CAMIDX_DTYPE.itemsize))
+        self._buf = np.zeros(blocksize,dtype = CAMIDX_DTYPE)
+        self._nbuf = 0
+        self.nframes = 0
+
+    def add(self,records):
+        '''Adds records (a CAMIDX_DTYPE array).'''
+        i = 0
+        while i < len(records):
+            n = min(len(records) - i,len(self._buf) - self._nbuf)
+            self._buf[self._nbuf:self._nbuf + n] = records[i:i + n]
+            self._nbuf += n
+            i += n
+            if self._nbuf == len(self._buf):
+                self.flush()
+        self.nframes += len(records)
+
+    def flush(self):
+        if self._nbuf:
+            self.fd.write(self._buf[:self._nbuf].tobytes())
+            self._nbuf = 0
+        self.fd.flush()
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        self.fd.close()
+        self.fd = None
+
+_CAMREC_MAGIC = b'LCAMREC1'
+
+class CamlogRecords(object):
+    '''
+    Binary columnar camlog (.camrec): the frame rows of the camlog as numpy
+    structured records, written in blocks. The comments stay in the .camlog.
+
+    The file has a header (json with the column names and formats, written
+    with the first row) followed by the records. parseCamLog reads it.
+
+    Inputs:
+        filename (str)
+        blocksize (int)      : rows written at once
+    '''
+    def __init__(self, filename, blocksize = 1024):
+        self.filename = filename
+        self.blocksize = blocksize
+        self.fd = open(filename,'wb')
+        self.dtype = None
+        self._buf = None
+        self._nbuf = 0
+        self.nrows = 0
+
+    def _write_header(self,row):
+        # columns named as in parseCamLog
+        names = ['frame_id','timestamp'] + ['var{0}'.format(i)
+                                            for i in range(2,len(row))]
+        formats = ['<i8' if isinstance(v,(bool,int,np.integer)) else '<f8'
+                   for v in row]
+        self.dtype = np.dtype(dict(names = names,formats = formats))
+        header = json.dumps(dict(names = names,formats = formats)).encode()
+        self.fd.write(_CAMREC_MAGIC + struct.pack('<Q',len(header)) + header)
+        self._buf = np.zeros(self.blocksize,dtype = self.dtype)
+
+    def add(self,rows):
+        '''Adds camlog rows (tuples with frame_id, timestamp, ...).'''
+        if not len(rows):
+            return
+        if self.dtype is None:
+            self._write_header(rows[0])
+        records = np.array([tuple(r) for r in rows],dtype = self.dtype)
+        i = 0
+        while i < len(records):
+            n = min(len(records) - i,self.blocksize - self._nbuf)
+            self._buf[self._nbuf:self._nbuf + n] = records[i:i + n]
+            self._nbuf += n
+            i += n
+            if self._nbuf == self.blocksize:
+                self.flush()
+        self.nrows += len(records)
+
+    def flush(self):
+        if self._nbuf:
+            self.fd.write(self._buf[:self._nbuf].tobytes())
+            self._nbuf = 0
+        self.fd.flush()
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        self.fd.close()
+        self.fd = None
+
+def read_camrec(filename):
+    '''Reads a binary columnar camlog (.camrec) as a structured array.'''
+    with open(filename,'rb') as fd:
+        magic = fd.read(len(_CAMREC_MAGIC))
+        assert magic == _CAMREC_MAGIC, '{0} is not a binary camlog.'.format(filename)
+        nheader, = struct.unpack('<Q',fd.read(8))
+        header = json.loads(fd.read(nheader).decode())
+        dtype = np.dtype(dict(names = header['names'],formats = header['formats']))
+        data = fd.read()
+    # a partial row at the end (if the recording stopped) is ignored
+    nrows = len(data)//dtype.itemsize
+    return np.frombuffer(data[:nrows*dtype.itemsize],dtype = dtype)
+
+def camlog_to_camrec(fname):
+    '''
+    Writes the frame rows of a text camlog to a binary columnar camlog
+    (.camrec next to it); parseCamLog reads the .camrec when it exists.
+
+    Example:
+        camlog_to_camrec('20200710_run000_00000000.camlog')
+    '''
+    logdata,comments = parseCamLog(fname)
+    out = os.path.splitext(fname)[0] + '.camrec'
+    rec = CamlogRecords(out)
+    rec.add(list(logdata.itertuples(index = False,name = None)))
+    rec.close()
+    return out
+
+################################################################################
+################################################################################
+################################################################################
+def _free_space(folder):
+    '''Free space (bytes) on the volume of a folder (that may not exist yet).'''
+    folder = os.path.abspath(folder)
+    while not os.path.exists(folder) and not os.path.dirname(folder) == folder:
+        folder = os.path.dirname(folder)
+    try:
+        return shutil.disk_usage(folder).free
+    except OSError:
+        return 0
+
+def _volume_id(folder):
+    '''Device of the volume of a folder (that may not exist yet).'''
+    folder = os.path.abspath(folder)
+    while not os.path.exists(folder) and not os.path.dirname(folder) == folder:
+        folder = os.path.dirname(folder)
+    return os.stat(folder).st_dev
+
+# Rough size of the recorded data relative to the raw frames
+_RECORDER_DATA_RATIO = dict(binary = 1.,
+                            tiff = 1.,
+                            tiff_compressed = 0.6,
+                            hdf5 = 0.7,
+                            lossless = 0.5,
+                            ffmpeg = 0.1,
+                            opencv = 0.1)
+
+def recording_bandwidth(shape, dtype, frame_rate, recorder = 'binary', compress = 0):
+    '''
+    Estimates the write bandwidth (bytes/s) needed to record a camera.
+
+    Inputs:
+        shape (tuple)        : frame shape (H,W[,NCHANNELS])
+        dtype                : frame datatype
+        frame_rate (float)   : frames per second
+        recorder (str)       : recorder as in the config file (e.g. binary, tiff_noqueue)
+        compress (int)       : compression level (tiff)
+    Compressed recorders use a rough ratio (_RECORDER_DATA_RATIO), the real
+    ratio depends on the images.
+    '''
+    raw = np.prod(shape)*np.dtype(dtype).itemsize*float(frame_rate)
+    recorder = recorder.lower().replace('_noqueue','')
+    if recorder == 'tiff' and compress > 0:
+        recorder = 'tiff_compressed'
+    return raw*_RECORDER_DATA_RATIO.get(recorder,1.)
+
+def measure_write_bandwidth(folder, nbytes = 67108864, blocksize = 8388608, timeout = 2.):
+    '''
+    Measures the write bandwidth of a folder by writing a temporary file.
+
+    Inputs:
+        folder (str)         : folder to test (created if it does not exist)
+        nbytes (int)         : bytes to write (default 64MB)
+        blocksize (int)      : bytes written at once
+        timeout (float)      : stop after this many seconds
+    Returns:
+        bandwidth (bytes/s), including the time to sync the file to disk.
+
+    Random data is written so compressing filesystems do not inflate the result.
+    '''
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    block = np.random.randint(0,255,size = blocksize,dtype = np.uint8).tobytes()
+    fd,fname = tempfile.mkstemp(prefix = '.labcams_bandwidth_',dir = folder)
+    written = 0
+    try:
+        tstart = time.time()
+        while written < nbytes and time.time() - tstart < timeout:
+            written += os.write(fd,block)
+        os.fsync(fd)
+        elapsed = time.time() - tstart
+    finally:
+        os.close(fd)
+        os.remove(fname)
+    return written/elapsed
+
 class GenericWriter(object):
     def __init__(self,
                  inQ = None,
@@ -56,7 +530,16 @@ class GenericWriter(object):
         self.sleeptime = sleeptime # seconds
         self.framesperfile = framesperfile
         self.filename = ''
-        self.datafolder = datafolder
+        if type(datafolder) in [list,tuple]:
+            self.datafolders = list(datafolder)
+        else:
+            self.datafolders = [datafolder]
+        self.datafolder = self.datafolders[0]
+        self.stripe = 'files'      # files, cameras or space (see _stripe_folder)
+        self.stripe_offset = 0     # camera number, cameras start on different folders
+        self._stripe_cache = (None,None)
+        self._manifest = None      # files of the run when recording to several folders
+        self._manifestfile = None
         self.dataname = dataname
         self.foldername = None
         self.incrementruns = incrementruns
@@ -65,6 +548,15 @@ class GenericWriter(object):
         self.parQ = None
         self.today = datetime.today().strftime('%Y%m%d')
         self.logfile = None
+        self.frameindex = None     # FrameIndexFile of the run
+        self._file_nframes = 0
+        self.log_format = 'text'   # frame rows in the camlog or in a .camrec (binary)
+        self._camrec = None
+        self.checkpoint_interval = 10 # seconds between checkpoints (0 is off)
+        self.log_comments = []     # written to the camlog header of each run
+        self._tcheckpoint = 0
+        self._statefile = None
+        self.stage_latency = None  # PipelineLatency (see utils)
         self.nFiles = 0
         runname = 'run{0:03d}'.format(self.runs)
         self.path_format = pathformat
@@ -88,6 +580,8 @@ class GenericWriter(object):
         if hasattr(cam,'nchan'):
             self.nchannels = cam.nchan
 
+    def start_write(self):
+        self.write = True
     def _stop_write(self):
         self.write = False
     def stop(self):
@@ -100,7 +594,28 @@ class GenericWriter(object):
     def get_filename(self):
         return str(self.filename[:]).strip(' ')
 
+    def _stripe_folder(self):
+        '''
+        Data folder of the next file when recording to several folders (volumes):
+            files   - round-robin, each file goes to the next folder
+            cameras - each camera (stripe_offset) records to one folder
+            space   - the folder with the most free space
+        '''
+        nfolders = len(self.datafolders)
+        if nfolders == 1:
+            return self.datafolders[0]
+        if self.stripe == 'cameras':
+            return self.datafolders[self.stripe_offset % nfolders]
+        if self.stripe == 'space':
+            key = (self.runs,self.nFiles)
+            if not self._stripe_cache[0] == key:
+                free = [_free_space(f) for f in self.datafolders]
+                self._stripe_cache = (key,self.datafolders[int(np.argmax(free))])
+            return self._stripe_cache[1]
+        return self.datafolders[(self.nFiles + self.stripe_offset) % nfolders]
+
     def get_filename_path(self):
+        self.path_keys['datafolder'] = self._stripe_folder()
         self.path_keys['run'] = 'run{0:03d}'.format(self.runs)
         nfiles = self.nFiles
         self.path_keys['nfiles'] = '{0:08d}'.format(nfiles)
@@ -122,13 +637,21 @@ class GenericWriter(object):
         filename = self.get_filename_path()
         if not self.fd is None:
             self.close_file()
+        self._update_manifest()
         self._open_file(filename,frame)
+        self._file_nframes = 0
         # Create a log file
         if self.logfile is None:
             self._open_logfile()
         self.nFiles += 1
         if hasattr(self,'parsed_filename'):
             filename = self.parsed_filename
+        if not self._manifest is None:
+            self._manifest['files'].append(dict(
+                filename = os.path.abspath(filename),
+                folder = self.datafolders.index(self.path_keys['datafolder']),
+                frames = 0))
+            self._update_manifest()
         display('Opened: '+ filename)        
         self.logfile.write('# [' + datetime.today().strftime('%y-%m-%d %H:%M:%S')+'] - ' + filename + '\n')
 
@@ -150,16 +673,118 @@ class GenericWriter(object):
             datetime.today().strftime('%d-%m-%Y')) + '\n')
         self.logfile.write('# labcams version: {0}'.format(
             VERSION) + '\n')                
+        for c in self.log_comments:
+            self.logfile.write('# ' + c + '\n')
         self.logfile.write('# Log header:' + 'frame_id,timestamp' + '\n')
+        self.frameindex = FrameIndexFile(filename.replace('{extension}'.format(
+            **self.path_keys),'.camidx'))
+        self._statefile = filename.replace('{extension}'.format(
+            **self.path_keys),'.camstate')
+        if len(self.datafolders) > 1:
+            self._manifestfile = filename.replace('{extension}'.format(
+                **self.path_keys),'.cammanifest')
+            self._manifest = dict(dataname = self.dataname,
+                                  stripe = self.stripe,
+                                  folders = [os.path.abspath(f) for f in self.datafolders],
+                                  camlog = os.path.abspath(logfname),
+                                  files = [],
+                                  closed = False)
+            self.logfile.write('# Manifest: {0}'.format(
+                os.path.basename(self._manifestfile)) + '\n')
+        if self.log_format == 'binary':
+            self._camrec = CamlogRecords(filename.replace('{extension}'.format(
+                **self.path_keys),'.camrec'))
+            self.logfile.write('# Log records: {0}'.format(
+                os.path.basename(self._camrec.filename)) + '\n')
 
     def _open_file(self,filename,frame):
         pass
 
+    def _update_manifest(self, closed = False):
+        '''Writes the files of the run and their number of frames to the manifest.'''
+        if self._manifest is None:
+            return
+        if len(self._manifest['files']):
+            self._manifest['files'][-1]['frames'] = int(self._file_nframes)
+        self._manifest['closed'] = closed
+        with open(self._manifestfile + '.tmp','w') as fd:
+            json.dump(self._manifest,fd,indent = 1)
+        os.replace(self._manifestfile + '.tmp',self._manifestfile)
+
+    def _index_frames(self,rows,stamps,frame):
+        '''
+        Adds the written frames to the frame index (.camidx) of the run.
+        The host time is the first stamp (recording_latency) or the time
+        the frames were written.
+        '''
+        records = np.zeros(len(rows),dtype = CAMIDX_DTYPE)
+        records['frame_id'] = [r[0] for r in rows]
+        records['timestamp'] = [r[1] for r in rows]
+        if stamps is None:
+            records['host_time'] = time.time()
+        else:
+            records['host_time'] = [s[0] for s in stamps]
+        records['file'] = self.nFiles - 1
+        records['index'] = self._file_nframes + np.arange(len(rows))
+        records['offset'] = self._frame_offsets(records['index'],frame)
+        self._file_nframes += len(rows)
+        self.frameindex.add(records)
+
+    def _frame_offsets(self,index,frame):
+        '''Byte offsets of frames in the file (-1, recorders with fixed size frames override this).'''
+        return -1
+
+    def _check_checkpoint(self):
+        if (self.checkpoint_interval > 0 and
+            time.time() - self._tcheckpoint > self.checkpoint_interval):
+            self.checkpoint()
+
+    def checkpoint(self, closed = False):
+        '''
+        Flushes the data file, the camlog and the frame index to disk and
+        writes the state of the run (.camstate) so recover_run can tell
+        which frames are valid if the recording stops unexpectedly.
+        '''
+        self._tcheckpoint = time.time()
+        if not self.fd is None:
+            self._sync_file()
+        for f in [self.frameindex,self._camrec]:
+            if not f is None and not f.fd is None:
+                f.flush()
+                os.fsync(f.fd.fileno())
+        if not self.logfile is None:
+            self.logfile.flush()
+            os.fsync(self.logfile.fileno())
+        self._update_manifest(closed = closed)
+        if self._statefile is None:
+            return
+        state = dict(time = self._tcheckpoint,
+                     frames = int(self.saved_frame_count),
+                     files = int(self.nFiles),
+                     file_frames = int(self._file_nframes),
+                     extension = self.extension,
+                     closed = closed)
+        with open(self._statefile + '.tmp','w') as fd:
+            json.dump(state,fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(self._statefile + '.tmp',self._statefile)
+
+    def _sync_file(self):
+        '''Flushes the data file to disk; recorders that do not use a file object override this.'''
+        if hasattr(self.fd,'sync'):
+            self.fd.sync()
+        elif hasattr(self.fd,'flush') and hasattr(self.fd,'fileno'):
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+
     def _write(self,frame,frameid,timestamp):
         pass
 
-    def save(self,frame,metadata):
-        return self._handle_frame((frame,metadata))
+    def save(self,frame,metadata,stamps = None):
+        if stamps is None:
+            return self._handle_frame((frame,metadata))
+        return self._handle_frame((frame,metadata,stamps))
     
     def _handle_frame(self,buff):
         if buff[0] is None:
@@ -177,39 +802,104 @@ class GenericWriter(object):
                     self._open_logfile()
                 self.logfile.write(msg + '\n')
             return None,msg
+        elif isinstance(buff[1],np.ndarray):
+            return self._handle_block(buff)
         else:
-            frame,(metadata) = buff
-            if (self.fd is None or
-                (self.framesperfile > 0 and np.mod(self.saved_frame_count,
-                                                   self.framesperfile)==0)):
-                self.open_file(frame = frame)
-                if not self.inQ is None:
-                    display('Queue size: {0}'.format(self.inQ.qsize()))
-
-                    self.logfile.write('# [' + datetime.today().strftime('%y-%m-%d %H:%M:%S')+'] - '
-                                       + 'Queue: {0}'.format(self.inQ.qsize())
-                                       + '\n')
+            frame,(metadata) = buff[:2]
+            self._check_open_file(frame)
             frameid, timestamp = metadata[:2] 
             self._write(frame,frameid,timestamp)
+            self._index_frames([metadata],buff[2:3] if len(buff) > 2 else None,frame)
+            if not self.stage_latency is None and len(buff) > 2:
+                self.stage_latency.add_written(buff[2],time.time())
             if np.mod(frameid,7000) == 0:
-                if self.inQ is None:
-                    display('[{0} - frame:{1}]'.format(
-                        self.dataname,frameid))
-                else:
-                    display('[{0} - frame:{1}] Queue size: {2}'.format(
-                        self.dataname,frameid,self.inQ.qsize()))
-            self.logfile.write(','.join(['{0}'.format(a) for a in metadata]) + '\n')
+                self._display_frame_count(frameid)
+            self._log_frames([metadata])
             self.saved_frame_count += 1
+            self._check_checkpoint()
         return frameid,frame
+
+    def _handle_block(self,buff):
+        '''
+        Writes a block of frames (frames,metadata[,stamps]) sent by a camera
+        with batch_size > 1. metadata is a structured array with one record
+        per frame; blocks are split at file boundaries.
+        '''
+        frames,metadata = buff[:2]
+        stamps = None
+        if len(buff) > 2:
+            stamps = buff[2]
+        i = 0
+        while i < len(frames):
+            self._check_open_file(frames[i])
+            n = len(frames) - i
+            if self.framesperfile > 0:
+                n = min(n,self.framesperfile - np.mod(self.saved_frame_count,
+                                                      self.framesperfile))
+            self._write_block(frames[i:i+n],metadata[i:i+n])
+            rows = [m.item() for m in metadata[i:i+n]]
+            self._index_frames(rows,None if stamps is None else stamps[i:i+n],frames[i])
+            if not self.stage_latency is None and not stamps is None:
+                twritten = time.time()
+                for s in stamps[i:i+n]:
+                    self.stage_latency.add_written(s,twritten)
+            for m in rows:
+                if np.mod(m[0],7000) == 0:
+                    self._display_frame_count(m[0])
+            self._log_frames(rows)
+            self.saved_frame_count += n
+            i += n
+        self._check_checkpoint()
+        return rows[-1][0],frames[-1]
+
+    def _log_frames(self,rows):
+        '''Logs the metadata of the written frames (one row per frame) to the camlog.'''
+        if not self._camrec is None:
+            self._camrec.add(rows)
+            return
+        self.logfile.write(''.join([','.join(['{0}'.format(a) for a in m]) + '\n'
+                                    for m in rows]))
+
+    def _write_block(self,frames,metadata):
+        '''Writes a block of frames; recorders that can write it at once override this.'''
+        for frame,m in zip(frames,metadata):
+            frameid,timestamp = m.item()[:2]
+            self._write(frame,frameid,timestamp)
+
+    def _check_open_file(self,frame):
+        if (self.fd is None or
+            (self.framesperfile > 0 and np.mod(self.saved_frame_count,
+                                               self.framesperfile)==0)):
+            self.open_file(frame = frame)
+            if not self.inQ is None:
+                display('Queue size: {0}'.format(self.inQ.qsize()))
+
+                self.logfile.write('# [' + datetime.today().strftime('%y-%m-%d %H:%M:%S')+'] - '
+                                   + 'Queue: {0}'.format(self.inQ.qsize())
+                                   + '\n')
+
+    def _display_frame_count(self,frameid):
+        if self.inQ is None:
+            display('[{0} - frame:{1}]'.format(
+                self.dataname,frameid))
+        else:
+            display('[{0} - frame:{1}] Queue size: {2}'.format(
+                self.dataname,frameid,self.inQ.qsize()))
     
     def close_run(self):
         
         if not self.logfile is None:
-            # Check if there are comments on the queue
-            while not self.inQ.empty():
-                buff = self.inQ.get()
-                frameid,frame = self._handle_frame(buff)
             self.close_file()
+            if self.checkpoint_interval > 0:
+                self.checkpoint(closed = True)
+            if not self.frameindex is None:
+                self.frameindex.close()
+                self.frameindex = None
+            if not self._camrec is None:
+                self._camrec.close()
+                self._camrec = None
+            self._update_manifest(closed = True)
+            self._manifest = None
             self.logfile.write('# [' +
                                datetime.today().strftime(
                                    '%y-%m-%d %H:%M:%S')+'] - ' +
@@ -251,16 +941,29 @@ class GenericWriterProcess(Process,GenericWriter):
         Process.__init__(self)
         self.write = Event()
         self.close = Event()
+        self.nruns = Value('i',0) # runs started with start_write
+        self._nstops = 0          # STOP messages received (writer process)
         self.filename = Array('u',' ' * 1024)
         self.inQ = inQ
         self.parQ = Queue()
         self.daemon = True
 
+    def start_write(self):
+        '''Starts a run; it ends when the camera sends STOP.'''
+        with self.nruns.get_lock():
+            self.nruns.value += 1
+            self.write.set()
+
     def _stop_write(self):
-        self.write.clear()
+        # The STOP of a run clears write only if no other run was started
+        # since (the next run may be set before the STOP is in the queue).
+        with self.nruns.get_lock():
+            self._nstops += 1
+            if self._nstops >= self.nruns.value:
+                self.write.clear()
 
     def set_filename(self,filename):
-        self._stop_write()
+        self.write.clear()
         for i in range(len(self.filename)):
             self.filename[i] = ' '
         for i in range(len(filename)):
@@ -268,36 +971,135 @@ class GenericWriterProcess(Process,GenericWriter):
         display('Filename updated: ' + self.get_filename())
     
     def stop(self):
-        self._stop_write()
+        self.write.clear()
         self.close.set()
         self.join()
         
     def _write(self,frame,frameid,timestamp):
         pass
     
-    def get_from_queue_and_save(self):
-        buff = self.inQ.get()
+    def get_from_queue_and_save(self,timeout = None):
+        '''Waits for the next buffer in the queue and saves it; raises Empty on timeout.'''
+        buff = self.inQ.get(timeout = timeout)
+        if len(buff) > 2:
+            # dequeue stamp
+            if isinstance(buff[2],np.ndarray):
+                stamps = np.empty((len(buff[2]),buff[2].shape[1] + 1))
+                stamps[:,:-1] = buff[2]
+                stamps[:,-1] = time.time()
+                buff = (buff[0],buff[1],stamps)
+            else:
+                buff = (buff[0],buff[1],tuple(buff[2]) + (time.time(),))
         return self._handle_frame(buff)
 
     def run(self):
+        # The writer blocks on the write event and on the queue, it wakes up
+        # as soon as there is data; sleeptime is only the timeout to check
+        # for the close event.
         while not self.close.is_set():
             self.saved_frame_count = 0
             self.nFiles = 0
             if not self.parQ.empty():
                 self.getFromParQueue()
+            if not self.write.wait(self.sleeptime):
+                continue
+            # write until the camera sends STOP; frames of the next run
+            # stay in the queue.
             while self.write.is_set() and not self.close.is_set():
-                while self.inQ.qsize():
-                    frameid,frame = self.get_from_queue_and_save()
-                # spare the processor just in case...
-                time.sleep(self.sleeptime)
-            time.sleep(self.sleeptime)
-            # If queue is not empty, empty if to disk.
-            while self.inQ.qsize():
-                frameid,frame = self.get_from_queue_and_save()
-            #display('Queue is empty. Proceding with close.')
+                try:
+                    frameid,frame = self.get_from_queue_and_save(
+                        timeout = self.sleeptime)
+                except Empty:
+                    continue
+                if frameid is None and frame == 'STOP':
+                    break
+            if self.close.is_set():
+                break
             # close the run
             self.close_run()
-        
+        # empty the queue to disk before closing
+        while True:
+            try:
+                frameid,frame = self.get_from_queue_and_save(
+                    timeout = self.sleeptime)
+            except Empty:
+                break
+        self.close_run()
+
+################################################################################
+################################################################################
+################################################################################
+class ThreadedTiffFile(object):
+    '''
+    Tiff file where frames are zlib compressed by a pool of threads (zlib
+    releases the GIL) and written in order by the thread that calls save.
+
+    Each frame is stored as a single deflate tile (padded to multiples of 16
+    pixels), frames decode to the same arrays as the ones written with
+    tifffile (one page per frame, description 'id:..;timestamp:..').
+    Frames that are not single channel are compressed by tifffile, in order.
+
+    Inputs:
+        filename (str)
+        compression (int)    : zlib level (1-9)
+        pool                 : concurrent.futures.ThreadPoolExecutor
+        nthreads (int)       : number of threads of the pool
+        maxpending (int)     : frames being compressed before save waits
+                               (default is twice the number of threads)
+    '''
+    def __init__(self, filename, compression, pool, nthreads, maxpending = None):
+        self.fd = twriter(filename)
+        self.compression = int(compression)
+        self.pool = pool
+        self.nthreads = nthreads
+        if maxpending is None:
+            maxpending = 2*nthreads
+        self.maxpending = maxpending
+        self.pending = deque()
+
+    def save(self,frame,description):
+        # copy because the buffer can be reused by the camera (or the ring)
+        frame = np.array(frame)
+        if frame.ndim == 2 or frame.shape[-1] == 1:
+            tile = tuple(int(np.ceil(d/16.)*16) for d in frame.shape[:2])
+            compressed = self.pool.submit(self._compress,frame,tile)
+        else:
+            tile = None
+            compressed = None
+        self.pending.append((compressed,frame,tile,description))
+        while len(self.pending) > self.maxpending:
+            self._write_next()
+
+    def _compress(self,frame,tile):
+        frame = frame.reshape(frame.shape[:2])
+        if not frame.shape == tile:
+            padded = np.zeros(tile,dtype = frame.dtype)
+            padded[:frame.shape[0],:frame.shape[1]] = frame
+            frame = padded
+        return zlib.compress(frame,self.compression)
+
+    def _write_next(self):
+        compressed,frame,tile,description = self.pending.popleft()
+        if compressed is None:
+            self.fd.save(frame,
+                         compress = self.compression,
+                         description = description)
+        else:
+            self.fd.save(iter([compressed.result()]),
+                         shape = frame.shape,
+                         dtype = frame.dtype,
+                         tile = tile,
+                         compress = self.compression,
+                         description = description)
+
+    def close(self):
+        while len(self.pending):
+            self._write_next()
+        self.fd.close()
+
+################################################################################
+################################################################################
+################################################################################
 class TiffWriter(GenericWriterProcess):
     def __init__(self,
                  inQ = None,
@@ -310,8 +1112,18 @@ class TiffWriter(GenericWriterProcess):
                  framesperfile=256,
                  sleeptime = 1./30,
                  incrementruns=True,
-                 compression=None):
+                 compression=None,
+                 compression_threads=0):
+        '''
+        Records multipage tiff files.
+            compression         - zlib level (0 is uncompressed)
+            compression_threads - threads to compress frames (0 is one per
+                                  core, 1 compresses in the writer, see
+                                  ThreadedTiffFile)
+        '''
         self.extension = '.tif'
+        self.compression_threads = compression_threads
+        self._pool = None
         super(TiffWriter,self).__init__(inQ = inQ,
                                         loggerQ=loggerQ,
                                         datafolder=datafolder,
@@ -338,13 +1150,187 @@ class TiffWriter(GenericWriterProcess):
         self.fd = None
 
     def _open_file(self,filename,frame = None):
-        self.fd = twriter(filename)
+        self.fd = _open_tiff(self,filename)
 
     def _write(self,frame,frameid,timestamp):
-        self.fd.save(frame,
-                     compress=self.compression,
-                     description='id:{0};timestamp:{1}'.format(frameid,
-                                                               timestamp))
+        _save_tiff(self,frame,'id:{0};timestamp:{1}'.format(frameid,
+                                                            timestamp))
+
+    def _sync_file(self):
+        _sync_tiff(self.fd)
+
+def _open_tiff(writer,filename):
+    '''Opens a tiff file for a tiff recorder (threaded when compressing).'''
+    nthreads = writer.compression_threads
+    if nthreads is None or nthreads <= 0:
+        nthreads = min(os.cpu_count() or 1,8)
+    if not writer.compression or nthreads <= 1:
+        return twriter(filename)
+    if writer._pool is None:
+        # created in the recorder process (the pool can not be pickled)
+        writer._pool = ThreadPoolExecutor(max_workers = nthreads)
+    return ThreadedTiffFile(filename,writer.compression,writer._pool,nthreads)
+
+def _sync_tiff(fd):
+    '''Writes the pending frames and syncs a tiff file to disk (checkpoints).'''
+    if isinstance(fd,ThreadedTiffFile):
+        while len(fd.pending):
+            fd._write_next()
+        fd = fd.fd
+    fd.filehandle.flush()
+    # fsync applies to the file, not only to the descriptor it is called on
+    fsync_fd = os.open(fd.filehandle.path,os.O_WRONLY | getattr(os,'O_BINARY',0))
+    try:
+        os.fsync(fsync_fd)
+    finally:
+        os.close(fsync_fd)
+
+def _save_tiff(writer,frame,description):
+    if isinstance(writer.fd,ThreadedTiffFile):
+        writer.fd.save(frame,description)
+    else:
+        writer.fd.save(frame,
+                       compress=writer.compression,
+                       description=description)
+
+################################################################################
+################################################################################
+################################################################################
+class BinaryFile(object):
+    '''
+    Raw binary file written in large aligned blocks.
+
+    Frames are copied to an aligned staging buffer that is written when it
+    has blocksize bytes. The file can be preallocated (posix_fallocate) and
+    opened with O_DIRECT (linux) to bypass the page cache. On close the file
+    is truncated to the data size, so the layout is the same as writing the
+    frames one after the other (mmap_dat works as before).
+
+    Inputs:
+        filename (str)
+        blocksize (int)      : bytes per write (multiple of 4096; default 8MB)
+        preallocate (int)    : bytes to reserve when opening the file (0 is off)
+        direct (bool)        : use O_DIRECT where available
+
+    elapsed is the time spent in the file calls (write, fsync and close),
+    so nbytes/elapsed is the write bandwidth (not counting the time waiting
+    for frames).
+
+    Example:
+        fd = BinaryFile(filename, preallocate = nframes*frame.nbytes)
+        fd.write(frame)
+        fd.close()
+        display('{0:.1f} MB/s'.format(fd.nbytes/fd.elapsed/1e6))
+    '''
+    alignment = 4096
+    def __init__(self, filename, blocksize = 8*1024*1024,
+                 preallocate = 0, direct = False):
+        self.filename = filename
+        self.blocksize = int(np.ceil(blocksize/float(self.alignment))*self.alignment)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os,'O_BINARY',0)
+        self.direct = False
+        if direct and hasattr(os,'O_DIRECT'):
+            try:
+                self.fd = os.open(filename,flags | os.O_DIRECT,0o644)
+                self.direct = True
+            except OSError:
+                display('[BinaryFile] O_DIRECT not supported for {0}'.format(filename))
+        if not self.direct:
+            self.fd = os.open(filename,flags,0o644)
+        if preallocate > 0 and hasattr(os,'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd,0,int(preallocate))
+            except OSError as err:
+                display('[BinaryFile] Could not preallocate {0}: {1}'.format(
+                    filename,err))
+        # staging buffer aligned to the page size (needed for O_DIRECT)
+        raw = np.empty(self.blocksize + self.alignment,dtype = np.uint8)
+        offset = (-raw.ctypes.data) % self.alignment
+        self._buf = raw[offset:offset + self.blocksize]
+        self._nbuf = 0
+        self.nbytes = 0
+        self.elapsed = 0
+
+    def write(self,data):
+        data = memoryview(np.ascontiguousarray(data)).cast('B')
+        i = 0
+        while i < len(data):
+            n = min(len(data) - i,self.blocksize - self._nbuf)
+            self._buf[self._nbuf:self._nbuf + n] = data[i:i + n]
+            self._nbuf += n
+            i += n
+            if self._nbuf == self.blocksize:
+                self._write_buffer(self._nbuf)
+        self.nbytes += len(data)
+
+    def _write_buffer(self,nbytes):
+        tstart = time.perf_counter()
+        view = memoryview(self._buf)[:nbytes]
+        while len(view):
+            n = os.write(self.fd,view)
+            view = view[n:]
+        self._nbuf = 0
+        self.elapsed += time.perf_counter() - tstart
+
+    def flush(self):
+        '''Writes the staging buffer (padded to the alignment with O_DIRECT).'''
+        if self._nbuf:
+            nbytes = self._nbuf
+            if self.direct:
+                nbytes = int(np.ceil(nbytes/float(self.alignment))*self.alignment)
+                self._buf[self._nbuf:nbytes] = 0
+            self._write_buffer(nbytes)
+
+    def sync(self):
+        '''Writes the buffered frames and syncs the file to disk (checkpoints).'''
+        n = self._nbuf
+        if self.direct:
+            # only whole aligned blocks, the rest stays in the buffer
+            n = (n//self.alignment)*self.alignment
+        if n:
+            rest = self._nbuf - n
+            self._write_buffer(n)
+            if rest:
+                self._buf[:rest] = self._buf[n:n + rest]
+                self._nbuf = rest
+        tstart = time.perf_counter()
+        os.fsync(self.fd)
+        self.elapsed += time.perf_counter() - tstart
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        tstart = time.perf_counter()
+        # remove the padding and the preallocated space
+        os.ftruncate(self.fd,self.nbytes)
+        os.close(self.fd)
+        self.fd = None
+        self.elapsed += time.perf_counter() - tstart
+
+def _binary_preallocate(writer,frame):
+    '''Bytes to preallocate for a new file of a binary recorder.'''
+    nframes = writer.preallocate
+    if writer.framesperfile > 0:
+        nframes = writer.framesperfile
+    return int(nframes)*frame.nbytes
+
+def _log_binary_throughput(writer):
+    '''Logs the write bandwidth of the run of a binary recorder (call before close_run).
+
+    The MB/s count only the time in the file calls, not waiting for frames.
+    '''
+    if writer._run_nbytes and writer._run_elapsed > 0:
+        msg = 'Wrote {0:.1f} MB in {1:.2f} s of writes ({2:.1f} MB/s)'.format(
+            writer._run_nbytes/1e6,
+            writer._run_elapsed,
+            writer._run_nbytes/writer._run_elapsed/1e6)
+        display('[Recorder] ' + msg)
+        if not writer.logfile is None:
+            writer.logfile.write('# [' + datetime.today().strftime(
+                '%y-%m-%d %H:%M:%S')+'] - ' + msg + '\n')
+    writer._run_nbytes = 0
+    writer._run_elapsed = 0
 
 ################################################################################
 ################################################################################
@@ -360,8 +1346,22 @@ class BinaryWriter(GenericWriterProcess):
                                     '{today}_{run}_{nfiles}'),
                  framesperfile=0,
                  sleeptime = 1./300,
-                 incrementruns=True):
+                 incrementruns=True,
+                 blocksize = 8*1024*1024,
+                 preallocate = 0,
+                 direct = False):
+        '''
+        Records raw binary files (see BinaryFile).
+            blocksize   - bytes per write
+            preallocate - frames to reserve per file (framesperfile is used if > 0)
+            direct      - use O_DIRECT (linux)
+        '''
         self.extension = '_{nchannels}_{H}_{W}_{dtype}.dat'
+        self.blocksize = blocksize
+        self.preallocate = preallocate
+        self.direct = direct
+        self._run_nbytes = 0
+        self._run_elapsed = 0
         super(BinaryWriter,self).__init__(inQ = inQ,
                                           loggerQ=loggerQ,
                                           filename=filename,
@@ -378,8 +1378,18 @@ class BinaryWriter(GenericWriterProcess):
     def close_file(self):
         if not self.fd is None:
             self.fd.close()
+            self._run_nbytes += self.fd.nbytes
+            self._run_elapsed += self.fd.elapsed
         self.fd = None
 
+    def _frame_offsets(self,index,frame):
+        return index*frame.nbytes
+
+    def close_run(self):
+        self.close_file()
+        _log_binary_throughput(self)
+        super(BinaryWriter,self).close_run()
+
     def _open_file(self,filename,frame = None):
         self.w = frame.shape[1]
         self.h = frame.shape[0]
@@ -395,13 +1405,158 @@ class BinaryWriter(GenericWriterProcess):
                                    H=self.h,
                                    dtype=dtype) 
         self.parsed_filename = filename
-        self.fd = open(filename,'wb')
+        self.fd = BinaryFile(filename,
+                             blocksize = self.blocksize,
+                             preallocate = _binary_preallocate(self,frame),
+                             direct = self.direct)
         
     def _write(self,frame,frameid,timestamp):
         self.fd.write(frame)
         if np.mod(frameid,5000) == 0: 
             display('Wrote frame id - {0}'.format(frameid))
+
+    def _write_block(self,frames,metadata):
+        self.fd.write(frames)
         
+################################################################################
+################################################################################
+################################################################################
+def _ffmpeg_binary():
+    '''The ffmpeg executable (as configured for skvideo).'''
+    import skvideo
+    path = skvideo.getFFmpegPath()
+    if len(path):
+        return pjoin(path,skvideo._FFMPEG_APPLICATION)
+    return skvideo._FFMPEG_APPLICATION
+
+def _ffmpeg_pix_fmt(dtype,nchannels):
+    '''Raw input pixel format for frames of dtype with nchannels (as skvideo).'''
+    if np.dtype(dtype).itemsize == 2:
+        fmts = {1:'gray16le',2:'ya16le',3:'rgb48le',4:'rgba64le'}
+    else:
+        fmts = {1:'gray',2:'ya8',3:'rgb24',4:'rgba'}
+    if not nchannels in fmts.keys():
+        raise ValueError('ffmpeg can not record {0} channels'.format(nchannels))
+    return fmts[nchannels]
+
+class FFmpegPipe(object):
+    '''
+    Writes raw frames to an ffmpeg process (one process per file).
+
+    The frame bytes are written straight to the stdin pipe (enlarged where
+    possible) without checking or reshaping each frame. ffmpeg reports the encoded frames on
+    stderr (-progress), a thread reads them; lag is the number of frames
+    written that were not encoded yet.
+
+    Inputs:
+        filename (str)
+        frame (array)        : first frame (sets the size and input pixel format)
+        inputdict (dict)     : ffmpeg input options (as skvideo FFmpegWriter)
+        outputdict (dict)    : ffmpeg output options
+        maxlag (int)         : lag_warning reports when lag is over maxlag frames
+        pipesize (int)       : size of the stdin pipe (bytes, linux only)
+    '''
+    def __init__(self, filename, frame, inputdict = {}, outputdict = {},
+                 maxlag = 60, pipesize = 1024*1024):
+        inputdict = dict(inputdict)
+        nchannels = 1 if frame.ndim == 2 else frame.shape[2]
+        if not '-pix_fmt' in inputdict.keys():
+            inputdict['-pix_fmt'] = _ffmpeg_pix_fmt(frame.dtype,nchannels)
+        inputdict['-f'] = 'rawvideo'
+        inputdict['-s'] = '{0}x{1}'.format(frame.shape[1],frame.shape[0])
+        cmd = [_ffmpeg_binary(),'-y','-nostats','-loglevel','error',
+               '-progress','pipe:2']
+        for k,v in inputdict.items():
+            cmd += [k,str(v)]
+        cmd += ['-i','-']
+        for k,v in outputdict.items():
+            cmd += [k,str(v)]
+        self.cmd = cmd + [filename]
+        self.filename = filename
+        self.frame_nbytes = frame.nbytes
+        self.maxlag = maxlag
+        self.nframes = 0
+        self.encoded = 0
+        self.maxlagged = 0
+        self._tlag = 0
+        self.errors = deque(maxlen = 20)
+        self.proc = subprocess.Popen(self.cmd,
+                                     stdin = subprocess.PIPE,
+                                     stdout = subprocess.DEVNULL,
+                                     stderr = subprocess.PIPE,
+                                     bufsize = 0)
+        if hasattr(fcntl,'F_SETPIPE_SZ'):
+            try:
+                # larger pipe so ffmpeg hiccups do not stall the recorder
+                fcntl.fcntl(self.proc.stdin.fileno(),fcntl.F_SETPIPE_SZ,pipesize)
+            except OSError:
+                pass
+        self._monitor = threading.Thread(target = self._read_progress)
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def _read_progress(self):
+        for line in self.proc.stderr:
+            line = line.decode(errors = 'replace').strip()
+            if line.startswith('frame='):
+                try:
+                    self.encoded = int(line[6:])
+                except ValueError:
+                    pass
+            elif len(line) and not line.split('=')[0].isidentifier():
+                # not a progress key=value, an ffmpeg error
+                self.errors.append(line)
+
+    @property
+    def lag(self):
+        return self.nframes - self.encoded
+
+    def write(self,frames):
+        '''Writes a frame or a block of frames [nframes,...].'''
+        data = memoryview(np.ascontiguousarray(frames)).cast('B')
+        try:
+            view = data
+            while len(view):
+                n = self.proc.stdin.write(view)
+                view = view[n:]
+        except (BrokenPipeError,OSError):
+            self.proc.wait()
+            raise IOError('ffmpeg stopped writing {0}: {1}'.format(
+                self.filename,' '.join(self.errors)))
+        self.nframes += len(data)//self.frame_nbytes
+        self.maxlagged = max(self.maxlagged,self.lag)
+
+    def lag_warning(self,interval = 5.):
+        '''Returns a message when the encoder lags more than maxlag frames (at most every interval seconds).'''
+        if self.lag > self.maxlag and (time.time() - self._tlag) > interval:
+            self._tlag = time.time()
+            return 'ffmpeg is {0} frames behind ({1} written, {2} encoded)'.format(
+                self.lag,self.nframes,self.encoded)
+        return None
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError,OSError):
+            pass
+        self.proc.wait()
+        self._monitor.join()
+        if self.proc.returncode:
+            display('[ffmpeg] {0} exited with {1}: {2}'.format(
+                self.filename,self.proc.returncode,' '.join(self.errors)))
+        self.proc = None
+
+def _write_ffmpeg(writer,frames):
+    '''Writes to the ffmpeg pipe of a recorder and logs when the encoder lags.'''
+    writer.fd.write(frames)
+    msg = writer.fd.lag_warning()
+    if not msg is None:
+        display('[Recorder] ' + msg)
+        writer.logfile.write('# [' + datetime.today().strftime(
+            '%y-%m-%d %H:%M:%S') + '] - ' + msg + '\n')
+
 ################################################################################
 ################################################################################
 ################################################################################
@@ -494,22 +1649,27 @@ class FFMPEGWriter(GenericWriterProcess):
 
         # does a check for the datatype, if uint16 then save compressed lossless
         if frame.dtype in [np.uint16] and len(frame.shape) == 2:
-            self.fd = FFmpegWriter(filename.replace(self.extension,'.mov'),
-                                   inputdict={'-pix_fmt':'gray16le',
-                                              '-r':str(self.frame_rate)}, # this is important
-                                   outputdict={'-c:v':'libopenjpeg',
-                                               '-pix_fmt':'gray16le',
-                                               '-r':str(self.frame_rate)})
+            self.fd = FFmpegPipe(filename.replace(self.extension,'.mov'),frame,
+                                 inputdict={'-pix_fmt':'gray16le',
+                                            '-r':str(self.frame_rate)}, # this is important
+                                 outputdict={'-c:v':'libopenjpeg',
+                                             '-pix_fmt':'gray16le',
+                                             '-r':str(self.frame_rate)},
+                                 maxlag = 2*self.frame_rate)
             return
         elif len(frame.shape) == 3 and (frame.shape[-1] == 3):
             self.doutputs['-pix_fmt'] = 'yuv420p'
             display('Camera has 3 channels; recording in yuv420p.')
-        self.fd = FFmpegWriter(filename,
-                               inputdict=self.dinputs,
-                               outputdict=self.doutputs)
+        self.fd = FFmpegPipe(filename,frame,
+                             inputdict=self.dinputs,
+                             outputdict=self.doutputs,
+                             maxlag = 2*self.frame_rate)
             
     def _write(self,frame,frameid,timestamp):
-        self.fd.writeFrame(frame)
+        _write_ffmpeg(self,frame)
+
+    def _write_block(self,frames,metadata):
+        _write_ffmpeg(self,frames)
 
 ################################################################################
 ################################################################################
@@ -659,19 +1819,24 @@ class FFMPEGCamWriter(GenericWriter):
 
         # does a check for the datatype, if uint16 then save compressed lossless
         if frame.dtype in [np.uint16] and len(frame.shape) == 2:
-            self.fd = FFmpegWriter(filename.replace(self.extension,'.mov'),
-                                   inputdict={'-pix_fmt':'gray16le',
-                                              '-r':str(self.frame_rate)}, # this is important
-                                   outputdict={'-c:v':'libopenjpeg',
-                                               '-pix_fmt':'gray16le',
-                                               '-r':str(self.frame_rate)})
+            self.fd = FFmpegPipe(filename.replace(self.extension,'.mov'),frame,
+                                 inputdict={'-pix_fmt':'gray16le',
+                                            '-r':str(self.frame_rate)}, # this is important
+                                 outputdict={'-c:v':'libopenjpeg',
+                                             '-pix_fmt':'gray16le',
+                                             '-r':str(self.frame_rate)},
+                                 maxlag = 2*self.frame_rate)
         else:
-            self.fd = FFmpegWriter(filename,
-                                   inputdict=self.dinputs,
-                                   outputdict=self.doutputs)
+            self.fd = FFmpegPipe(filename,frame,
+                                 inputdict=self.dinputs,
+                                 outputdict=self.doutputs,
+                                 maxlag = 2*self.frame_rate)
             
     def _write(self,frame,frameid,timestamp):
-        self.fd.writeFrame(frame)
+        _write_ffmpeg(self,frame)
+
+    def _write_block(self,frames,metadata):
+        _write_ffmpeg(self,frames)
 
 ################################################################################
 ################################################################################
@@ -687,10 +1852,18 @@ class BinaryCamWriter(GenericWriter):
                                     '{today}_{run}_{nfiles}'),
                  framesperfile=0,
                  inQ = None,
-                 incrementruns=True):
+                 incrementruns=True,
+                 blocksize = 8*1024*1024,
+                 preallocate = 0,
+                 direct = False):
         self.extension = '_{nchannels}_{H}_{W}_{dtype}.dat'
         self.cam = cam
         self.nchannels = cam.nchan
+        self.blocksize = blocksize
+        self.preallocate = preallocate
+        self.direct = direct
+        self._run_nbytes = 0
+        self._run_elapsed = 0
         super(BinaryCamWriter,self).__init__(filename=filename,
                                              datafolder=datafolder,
                                              dataname=dataname,
@@ -704,9 +1877,19 @@ class BinaryCamWriter(GenericWriter):
     def close_file(self):
         if not self.fd is None:
             self.fd.close()
+            self._run_nbytes += self.fd.nbytes
+            self._run_elapsed += self.fd.elapsed
             print("------->>> Closed file.")
         self.fd = None
 
+    def _frame_offsets(self,index,frame):
+        return index*frame.nbytes
+
+    def close_run(self):
+        self.close_file()
+        _log_binary_throughput(self)
+        super(BinaryCamWriter,self).close_run()
+
     def _open_file(self,filename,frame = None):
         self.w = frame.shape[1]
         self.h = frame.shape[0]
@@ -721,10 +1904,16 @@ class BinaryCamWriter(GenericWriter):
                                    W=self.w,
                                    H=self.h, dtype=dtype)
         self.parsed_filename = filename
-        self.fd = open(filename,'wb')
+        self.fd = BinaryFile(filename,
+                             blocksize = self.blocksize,
+                             preallocate = _binary_preallocate(self,frame),
+                             direct = self.direct)
 
     def _write(self,frame,frameid,timestamp):
         self.fd.write(frame)
+
+    def _write_block(self,frames,metadata):
+        self.fd.write(frames)
         
 class TiffCamWriter(GenericWriter):
     def __init__(self,
@@ -738,9 +1927,12 @@ class TiffCamWriter(GenericWriter):
                  sleeptime = 1./300,
                  inQ = None,
                  incrementruns=True,
-                 compression = None):
+                 compression = None,
+                 compression_threads = 0):
         self.extension = '.tif'
         self.cam = cam
+        self.compression_threads = compression_threads
+        self._pool = None
         super(TiffCamWriter,self).__init__(datafolder=datafolder,
                                            filename=filename,
                                            inQ = inQ,
@@ -760,130 +1952,972 @@ class TiffCamWriter(GenericWriter):
         self.fd = None
 
     def _open_file(self,filename,frame = None):
-        self.fd = twriter(filename)
+        self.fd = _open_tiff(self,filename)
 
     def _write(self,frame,frameid,timestamp):
-        self.fd.save(frame,
-                     compress=self.compression,
-                     description='id:{0};timestamp:{1}'.format(frameid,timestamp))
+        _save_tiff(self,frame,'id:{0};timestamp:{1}'.format(frameid,timestamp))
+
+    def _sync_file(self):
+        _sync_tiff(self.fd)
         
 ################################################################################
 ################################################################################
 ################################################################################
+HDF5_CODECS = ['lz4','zstd','none']
 
-def parseCamLog(fname, readTeensy = False):
-    logheaderkey = '# Log header:'
-    comments = []
-    with open(fname,'r') as fd:
-        for line in fd:
-            if line.startswith('#'):
-                line = line.strip('\n').strip('\r')
-                comments.append(line)
-                if line.startswith(logheaderkey):
-                    columns = line.strip(logheaderkey).strip(' ').split(',')
-
-    logdata = pd.read_csv(fname, 
-                          delimiter=',',
-                          header=None,
-                          comment='#',
-                          engine='c')
-    col = [c for c in logdata.columns]
+def _import_hdf5():
+    '''Imports h5py and hdf5plugin (optional dependencies of the hdf5 recorders).'''
+    try:
+        import h5py
+        import hdf5plugin
+    except ImportError as err:
+        raise ImportError('''The hdf5 recorders need h5py and hdf5plugin:
+
+        pip install h5py hdf5plugin
+''') from err
+    return h5py,hdf5plugin
+
+class HDF5File(object):
+    '''
+    HDF5 file with the frames chunked along time and the frame metadata.
+
+    Datasets:
+        frames      : [nframes,H,W,nchannels] compressed with blosc
+                      (lz4 or zstd with bitshuffle)
+        frame_id, timestamp, var2...
+                    : one value per frame (the columns of the camlog)
+
+    Frames are buffered in memory and written one chunk at a time, so each
+    chunk is compressed once (blosc uses nthreads).
+
+    Inputs:
+        filename (str)
+        frame (array)        : first frame (sets the shape and dtype)
+        codec (str)          : lz4, zstd or none
+        level (int)          : blosc compression level (1-9, 0 is 5)
+        nthreads (int)       : blosc threads (0 is one per core)
+        chunkframes (int)    : frames per chunk (0 is about 4MB per chunk)
+
+    Example:
+        fd = HDF5File(filename, frame, codec = 'zstd')
+        fd.write(frames)
+        fd.add_metadata([(frameid, timestamp), ...])
+        fd.close()
+    '''
+    def __init__(self, filename, frame, codec = 'lz4', level = 5,
+                 nthreads = 0, chunkframes = 0):
+        h5py,hdf5plugin = _import_hdf5()
+        if nthreads is None or nthreads <= 0:
+            nthreads = os.cpu_count() or 1
+        if not level:
+            level = 5
+        # read by blosc when compressing
+        os.environ['BLOSC_NTHREADS'] = str(int(nthreads))
+        shape = tuple(frame.shape)
+        if len(shape) == 2:
+            shape = shape + (1,)
+        if chunkframes is None or chunkframes <= 0:
+            chunkframes = int(max(1,(4*1024*1024)//frame.nbytes))
+        self.chunkframes = int(chunkframes)
+        filters = dict()
+        if not codec is None and not codec == 'none':
+            if not codec in HDF5_CODECS:
+                raise ValueError('Unknown hdf5 codec {0} (use {1})'.format(
+                    codec,', '.join(HDF5_CODECS)))
+            filters = hdf5plugin.Blosc(cname = codec,
+                                       clevel = int(np.clip(level,1,9)),
+                                       shuffle = hdf5plugin.Blosc.BITSHUFFLE)
+        self.fd = h5py.File(filename,'w')
+        self.fd.attrs['labcams_version'] = VERSION
+        self.fd.attrs['codec'] = str(codec)
+        self.frames = self.fd.create_dataset('frames',
+                                             shape = (0,) + shape,
+                                             maxshape = (None,) + shape,
+                                             chunks = (self.chunkframes,) + shape,
+                                             dtype = frame.dtype,
+                                             **filters)
+        self._buf = np.empty((self.chunkframes,) + shape,dtype = frame.dtype)
+        self._nbuf = 0
+        self.nframes = 0
+        self.metadata = None
+        self._rows = []
+
+    def write(self,frames):
+        '''Appends a frame or a block of frames [nframes,...].'''
+        frames = np.asarray(frames)
+        if frames.ndim == 2 or frames.shape == self._buf.shape[1:]:
+            frames = frames[np.newaxis]
+        frames = frames.reshape((len(frames),) + self._buf.shape[1:])
+        i = 0
+        while i < len(frames):
+            n = min(len(frames) - i,self.chunkframes - self._nbuf)
+            self._buf[self._nbuf:self._nbuf + n] = frames[i:i + n]
+            self._nbuf += n
+            i += n
+            if self._nbuf == self.chunkframes:
+                self.flush()
+
+    def add_metadata(self,rows):
+        '''Appends the metadata (frame_id, timestamp, ...) of the written frames.'''
+        self._rows.extend([tuple(r) for r in rows])
+        if len(self._rows) >= self.chunkframes:
+            self._write_metadata()
+
+    def _write_metadata(self):
+        if not len(self._rows):
+            return
+        if self.metadata is None:
+            # the columns are named as in parseCamLog
+            names = ['frame_id','timestamp'] + ['var{0}'.format(i)
+                                                for i in range(2,len(self._rows[0]))]
+            self.metadata = []
+            for name,value in zip(names,self._rows[0]):
+                dtype = np.int64 if isinstance(value,(int,np.integer)) else np.float64
+                self.metadata.append(self.fd.create_dataset(name,
+                                                            shape = (0,),
+                                                            maxshape = (None,),
+                                                            chunks = (max(self.chunkframes,1024),),
+                                                            dtype = dtype))
+        for i,dset in enumerate(self.metadata):
+            n = len(dset)
+            dset.resize((n + len(self._rows),))
+            dset[n:] = [r[i] for r in self._rows]
+        self._rows = []
+
+    def flush(self):
+        '''Writes the buffered frames and metadata to the file.'''
+        if self._nbuf:
+            self.frames.resize((self.nframes + self._nbuf,) + self._buf.shape[1:])
+            self.frames[self.nframes:] = self._buf[:self._nbuf]
+            self.nframes += self._nbuf
+            self._nbuf = 0
+        self._write_metadata()
+
+    def sync(self):
+        '''Writes the buffered frames and flushes the file (checkpoints).'''
+        self.flush()
+        self.fd.flush()
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        self.fd.close()
+        self.fd = None
+
+class HDF5Writer(GenericWriterProcess):
+    def __init__(self,
+                 inQ = None,
+                 loggerQ = None,
+                 filename = pjoin('dummy','run'),
+                 dataname = 'cam',
+                 pathformat = pjoin('{datafolder}','{dataname}','{filename}',
+                                    '{today}_{run}_{nfiles}'),
+                 datafolder=pjoin(os.path.expanduser('~'),'data'),
+                 framesperfile=0,
+                 sleeptime = 1./300,
+                 incrementruns=True,
+                 codec = 'lz4',
+                 compression = 5,
+                 compression_threads = 0,
+                 chunkframes = 0):
+        '''
+        Records one hdf5 file per run (or per framesperfile) (see HDF5File).
+            codec               - lz4, zstd or none
+            compression         - blosc level (1-9, 0 is 5)
+            compression_threads - blosc threads (0 is one per core)
+            chunkframes         - frames per chunk (0 is about 4MB)
+        '''
+        _import_hdf5()
+        self.extension = '.h5'
+        self.codec = codec
+        self.compression = compression
+        self.compression_threads = compression_threads
+        self.chunkframes = chunkframes
+        super(HDF5Writer,self).__init__(inQ = inQ,
+                                        loggerQ=loggerQ,
+                                        datafolder=datafolder,
+                                        filename=filename,
+                                        dataname=dataname,
+                                        pathformat=pathformat,
+                                        framesperfile=framesperfile,
+                                        sleeptime=sleeptime,
+                                        incrementruns=incrementruns)
+
+    def close_file(self):
+        if not self.fd is None:
+            self.fd.close()
+        self.fd = None
+
+    def _open_file(self,filename,frame = None):
+        self.fd = _open_hdf5(self,filename,frame)
+
+    def _write(self,frame,frameid,timestamp):
+        self.fd.write(frame)
+
+    def _write_block(self,frames,metadata):
+        self.fd.write(frames)
+
+    def _log_frames(self,rows):
+        # the frame metadata goes to the hdf5 file (the camlog has only comments)
+        self.fd.add_metadata(rows)
+
+def _open_hdf5(writer,filename,frame):
+    return HDF5File(filename,frame,
+                    codec = writer.codec,
+                    level = writer.compression,
+                    nthreads = writer.compression_threads,
+                    chunkframes = writer.chunkframes)
+
+class HDF5CamWriter(GenericWriter):
+    def __init__(self,
+                 cam,
+                 filename = pjoin('dummy','run'),
+                 dataname = 'cam',
+                 datafolder=pjoin(os.path.expanduser('~'),'data'),
+                 pathformat = pjoin('{datafolder}','{dataname}','{filename}',
+                                    '{today}_{run}_{nfiles}'),
+                 framesperfile=0,
+                 sleeptime = 1./300,
+                 inQ = None,
+                 incrementruns=True,
+                 codec = 'lz4',
+                 compression = 5,
+                 compression_threads = 0,
+                 chunkframes = 0):
+        _import_hdf5()
+        self.extension = '.h5'
+        self.cam = cam
+        self.codec = codec
+        self.compression = compression
+        self.compression_threads = compression_threads
+        self.chunkframes = chunkframes
+        super(HDF5CamWriter,self).__init__(datafolder=datafolder,
+                                           filename=filename,
+                                           inQ = inQ,
+                                           dataname=dataname,
+                                           pathformat=pathformat,
+                                           framesperfile=framesperfile,
+                                           sleeptime=sleeptime,
+                                           incrementruns=incrementruns)
+
+    def close_file(self):
+        if not self.fd is None:
+            self.fd.close()
+        self.fd = None
+
+    def _open_file(self,filename,frame = None):
+        self.fd = _open_hdf5(self,filename,frame)
+
+    def _write(self,frame,frameid,timestamp):
+        self.fd.write(frame)
+
+    def _write_block(self,frames,metadata):
+        self.fd.write(frames)
+
+    def _log_frames(self,rows):
+        self.fd.add_metadata(rows)
+
+################################################################################
+################################################################################
+################################################################################
+LOSSLESS_CODECS = ['jp2','png','zlib']
+_LOSSLESS_MAGIC = b'LABCAMS1'
+_LOSSLESS_FOOTER = struct.Struct('<QQ8s') # index offset, nframes, magic
+
+def encode_frame(frame, codec = 'jp2', level = 1):
+    '''
+    Lossless encoding of a frame (multichannel frames are encoded as [H,W*nchannels]).
+
+    Inputs:
+        frame (array)        : [H,W] or [H,W,nchannels] uint8 or uint16
+        codec (str)          : jp2 (JPEG-2000), png or zlib
+        level (int)          : compression level (png and zlib)
+    Returns:
+        the encoded bytes
+    '''
+    frame = np.ascontiguousarray(frame)
+    if codec == 'zlib':
+        return zlib.compress(frame,int(np.clip(level,1,9)))
+    img = frame.reshape(frame.shape[0],-1)
+    if codec == 'jp2':
+        ok,buf = cv2.imencode('.jp2',img,[cv2.IMWRITE_JPEG2000_COMPRESSION_X1000,1000])
+    elif codec == 'png':
+        ok,buf = cv2.imencode('.png',img,[cv2.IMWRITE_PNG_COMPRESSION,
+                                          int(np.clip(level,0,9))])
+    else:
+        raise ValueError('Unknown codec {0} (use {1})'.format(
+            codec,', '.join(LOSSLESS_CODECS)))
+    if not ok:
+        raise ValueError('Could not encode frame with {0}'.format(codec))
+    return buf.tobytes()
+
+def decode_frame(buf, shape, dtype, codec = 'jp2'):
+    '''Decodes a frame encoded with encode_frame.'''
+    if codec == 'zlib':
+        frame = np.frombuffer(zlib.decompress(buf),dtype = dtype)
+    else:
+        frame = cv2.imdecode(np.frombuffer(buf,dtype = np.uint8),
+                             cv2.IMREAD_UNCHANGED)
+    return frame.reshape(shape)
+
+class LosslessFile(object):
+    '''
+    Container for losslessly encoded frames, encoded by a pool of processes.
+
+    Frames are sent to the workers as they arrive and the encoded frames are
+    written in order. The file has a header (json with the codec, frame
+    shape and dtype), the encoded frames (each after its size, uint64) and
+    an index (offset and size of each frame) at the end; read it with
+    LosslessStack. Files that were not closed are read from the frame sizes
+    (sync writes the frames to disk at checkpoints).
+
+    Inputs:
+        filename (str)
+        frame (array)        : first frame (sets the shape and dtype)
+        pool                 : concurrent.futures executor to encode the frames
+        nworkers (int)       : number of workers of the pool
+        codec (str)          : jp2, png or zlib
+        level (int)          : compression level (png and zlib)
+        maxpending (int)     : frames being encoded before write waits
+                               (default is 4 per worker)
+    '''
+    def __init__(self, filename, frame, pool, nworkers, codec = 'jp2', level = 1,
+                 maxpending = None):
+        if not codec in LOSSLESS_CODECS:
+            raise ValueError('Unknown codec {0} (use {1})'.format(
+                codec,', '.join(LOSSLESS_CODECS)))
+        self.codec = codec
+        self.level = level
+        self.pool = pool
+        self.nworkers = nworkers
+        if maxpending is None:
+            maxpending = 4*nworkers
+        self.maxpending = maxpending
+        self.pending = deque()
+        self.shape = tuple(frame.shape)
+        self.dtype = np.dtype(frame.dtype)
+        self.fd = open(filename,'wb')
+        header = json.dumps(dict(codec = codec,
+                                 shape = self.shape,
+                                 dtype = self.dtype.str,
+                                 frame_sizes = True,
+                                 labcams_version = VERSION)).encode()
+        self.fd.write(_LOSSLESS_MAGIC + struct.pack('<Q',len(header)) + header)
+        self.offsets = []
+        self.nbytes = []
+
+    def write(self,frame):
+        # copy because the buffer can be reused before it is sent to the worker
+        self.pending.append(self.pool.submit(encode_frame,np.array(frame),
+                                             self.codec,self.level))
+        while len(self.pending) > self.maxpending:
+            self._write_next()
+
+    def _write_next(self):
+        buf = self.pending.popleft().result()
+        self.fd.write(struct.pack('<Q',len(buf)))
+        self.offsets.append(self.fd.tell())
+        self.nbytes.append(len(buf))
+        self.fd.write(buf)
+
+    def sync(self):
+        '''Writes the frames being encoded and syncs the file to disk (checkpoints).'''
+        while len(self.pending):
+            self._write_next()
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def close(self):
+        if self.fd is None:
+            return
+        while len(self.pending):
+            self._write_next()
+        self.fd.write(struct.pack('<Q',0)) # end of the frames
+        offset = self.fd.tell()
+        self.fd.write(np.array([self.offsets,self.nbytes],
+                               dtype = np.uint64).T.tobytes())
+        self.fd.write(_LOSSLESS_FOOTER.pack(offset,len(self.offsets),
+                                            _LOSSLESS_MAGIC))
+        self.fd.close()
+        self.fd = None
+
+class LosslessWriter(GenericWriterProcess):
+    def __init__(self,
+                 inQ = None,
+                 loggerQ = None,
+                 filename = pjoin('dummy','run'),
+                 dataname = 'cam',
+                 pathformat = pjoin('{datafolder}','{dataname}','{filename}',
+                                    '{today}_{run}_{nfiles}'),
+                 datafolder=pjoin(os.path.expanduser('~'),'data'),
+                 framesperfile=0,
+                 sleeptime = 1./300,
+                 incrementruns=True,
+                 codec = 'jp2',
+                 compression = 1,
+                 workers = 0):
+        '''
+        Records losslessly encoded frames with a pool of processes (see LosslessFile).
+            codec       - jp2 (JPEG-2000), png or zlib
+            compression - level for png and zlib
+            workers     - encoder processes (0 is one per core)
+        '''
+        self.extension = '.lossless'
+        self.codec = codec
+        self.compression = compression
+        self.workers = workers
+        self._pool = None
+        self._nworkers = 0
+        super(LosslessWriter,self).__init__(inQ = inQ,
+                                            loggerQ=loggerQ,
+                                            datafolder=datafolder,
+                                            filename=filename,
+                                            dataname=dataname,
+                                            pathformat=pathformat,
+                                            framesperfile=framesperfile,
+                                            sleeptime=sleeptime,
+                                            incrementruns=incrementruns)
+        # the recorder starts the encoder processes (daemons can not)
+        self.daemon = False
+
+    def run(self):
+        workers = self.workers
+        if workers is None or workers <= 0:
+            workers = os.cpu_count() or 1
+        self._pool = ProcessPoolExecutor(max_workers = workers)
+        self._nworkers = workers
+        # start the workers before the first frame arrives
+        self._pool.submit(int)
+        super(LosslessWriter,self).run()
+        self._pool.shutdown()
+
+    def close_file(self):
+        if not self.fd is None:
+            self.fd.close()
+        self.fd = None
+
+    def _open_file(self,filename,frame = None):
+        self.fd = LosslessFile(filename,frame,self._pool,self._nworkers,
+                               codec = self.codec,
+                               level = self.compression)
+
+    def _write(self,frame,frameid,timestamp):
+        self.fd.write(frame)
+
+    def _sync_file(self):
+        self.fd.sync()
+
+################################################################################
+################################################################################
+################################################################################
+
+def _read_csv_rows(rows, columns):
+    '''Parses comma separated rows (bytes) in bulk to a DataFrame, comments are skipped.'''
+    try:
+        data = pd.read_csv(BytesIO(rows),delimiter = ',',header = None,
+                           comment = '#',engine = 'c')
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame({c:np.zeros(0) for c in columns})
+    col = [c for c in data.columns]
     for icol in range(len(col)):
         if icol <= len(columns)-1:
             col[icol] = columns[icol]
         else:
             col[icol] = 'var{0}'.format(icol)
-    logdata.columns = col
-    if readTeensy:
-        # get the sync pulses and frames along with the LED
-        def _convert(string):
+    data.columns = col
+    return data
+
+def _camlog_cache_key(fname):
+    '''Size and modification time of the camlog (and .camrec).'''
+    key = []
+    for f in [fname,os.path.splitext(fname)[0] + '.camrec']:
+        if os.path.isfile(f):
+            st = os.stat(f)
+            key += [st.st_size,st.st_mtime_ns]
+    return np.array(key,dtype = np.int64)
+
+_TEENSY_EVENTS = ('#LED:','#SYNC:','#SYNC1:') # comments with the teensy events
+
+def _parse_camlog(fname):
+    '''
+    Reads a camlog in a single pass: the file is read at once, the comments
+    are found with a regular expression, the frame rows and the teensy
+    events (#LED:, #SYNC:, #SYNC1:) are parsed in bulk.
+    '''
+    with open(fname,'rb') as fd:
+        text = fd.read().replace(b'\r',b'')
+    comments = re.findall(rb'\n(#[^\n]*)',b'\n' + text)
+    columns = []
+    logheaderkey = '# Log header:'
+    for c in comments:
+        if c.startswith(logheaderkey.encode()):
+            columns = c.decode().strip(logheaderkey).strip(' ').split(',')
+    camrec = os.path.splitext(fname)[0] + '.camrec'
+    if os.path.isfile(camrec):
+        logdata = pd.DataFrame(read_camrec(camrec))
+    else:
+        logdata = _read_csv_rows(text,columns)
+    led = _read_csv_rows(b'\n'.join([c[5:] for c in comments if c.startswith(b'#LED:')]),
+                         ['led','frame','timestamp'])
+    sync = [c for c in comments if c.startswith((b'#SYNC:',b'#SYNC1:'))]
+    syncchan = [float(c.startswith(b'#SYNC1:')) for c in sync]
+    sync = _read_csv_rows(b'\n'.join([c.split(b':',1)[1] for c in sync]),
+                          ['count','frame','timestamp'])
+    sync.insert(0,'sync',np.array(syncchan[:len(sync)],dtype = float))
+    comments = [c.decode() for c in comments]
+    ncomm = [c for c in comments if not c.startswith(_TEENSY_EVENTS)]
+    return logdata,led,sync,comments,ncomm
+
+def parseCamLog(fname, readTeensy = False, cache = False):
+    '''
+    Reads a camlog; returns the frame rows (DataFrame) and the comments.
+    The rows are read from the binary camlog (.camrec) when there is one.
+
+    With cache, the parsed log is saved next to the camlog (.camcache.npz)
+    and loaded from there while the size and modification time of the
+    camlog do not change (the folder needs to be writable).
+
+    Inputs:
+        fname (str)          : camlog
+        readTeensy (bool)    : also return the LED and SYNC events
+        cache (bool)         : use (and write) the cache (default False)
+    Returns:
+        logdata,comments or logdata,led,sync,comments (without the events) with readTeensy
+    '''
+    cachefile = os.path.splitext(fname)[0] + '.camcache.npz'
+    key = _camlog_cache_key(fname)
+    res = None
+    if cache and os.path.isfile(cachefile):
+        try:
+            with np.load(cachefile) as fd:
+                if np.array_equal(fd['key'],key):
+                    tables = []
+                    for name in ['log','led','sync']:
+                        tables.append(pd.DataFrame(
+                            {c:fd[name + '/' + c] for c in fd[name + '_columns']}))
+                    comments = str(fd['comments']).split('\n') if fd['ncomments'] else []
+                    ncomm = [comments[i] for i in fd['ncomm']]
+                    res = tables + [comments,ncomm]
+        except Exception as err:
+            display('Could not read the camlog cache {0}: {1}'.format(cachefile,err))
+    if res is None:
+        res = list(_parse_camlog(fname))
+        # only numeric columns are cached (strings would need pickling)
+        if cache and np.all([pd.api.types.is_numeric_dtype(t[c])
+                             for t in res[:3] for c in t.columns]):
+            logdata,led,sync,comments,ncomm = res
+            arrays = dict(key = key,
+                          comments = '\n'.join(comments),
+                          ncomments = len(comments),
+                          ncomm = np.array([i for i,c in enumerate(comments)
+                                            if not c.startswith(_TEENSY_EVENTS)],dtype = np.int64))
+            for name,table in zip(['log','led','sync'],[logdata,led,sync]):
+                arrays[name + '_columns'] = np.array([str(c) for c in table.columns])
+                for c in table.columns:
+                    arrays[name + '/' + str(c)] = table[c].values
             try:
-                val = int(string)
-            except ValueError as err:
-                val = float(string)
-            return val
-
-        led = []
-        sync= []
-        ncomm = []
-        for l in comments:
-            if l.startswith('#LED:'):
-                led.append([_convert(f) for f in  l.strip('#LED:').split(',')])
-            elif l.startswith('#SYNC:'):
-                sync.append([0.] + [_convert(f) for f in  l.strip('#SYNC:').split(',')])
-            elif l.startswith('#SYNC1:'):
-                sync.append([1.] + [_convert(f) for f in  l.strip('#SYNC1:').split(',')])
-            else:
-                ncomm.append(l)
-        sync = pd.DataFrame(sync, columns=['sync','count','frame','timestamp'])
-        led = pd.DataFrame(led, columns=['led','frame','timestamp'])
+                with open(cachefile,'wb') as fd:
+                    np.savez(fd,**arrays)
+            except OSError as err:
+                display('Could not write the camlog cache {0}: {1}'.format(cachefile,err))
+    logdata,led,sync,comments,ncomm = res
+    if readTeensy:
         return logdata,led,sync,ncomm
     return logdata,comments
 
 parse_cam_log = parseCamLog
 
+def parseHDF5Log(filenames):
+    '''
+    Reads the frame metadata (frame_id, timestamp, ...) of hdf5 recordings.
+
+    Inputs:
+        filenames (str or list) : hdf5 file(s) of a run (in order)
+    Returns:
+        a pandas DataFrame with the same columns as parseCamLog
+    '''
+    h5py,hdf5plugin = _import_hdf5()
+    if type(filenames) is str:
+        filenames = [filenames]
+    logdata = []
+    for fname in filenames:
+        with h5py.File(fname,'r') as fd:
+            columns = ['frame_id','timestamp'] + sorted(
+                [k for k in fd.keys() if k.startswith('var')],
+                key = lambda k: int(k[3:]))
+            logdata.append(pd.DataFrame({c:fd[c][:] for c in columns
+                                         if c in fd.keys()}))
+    return pd.concat(logdata,ignore_index = True)
+
+def read_manifest(filename, folders = None):
+    '''
+    Reads the manifest of a run recorded to several folders (recorder_path is a list).
+
+    Inputs:
+        filename (str)       : the .cammanifest (or the .camlog) of the run
+        folders (list)       : where the recorder folders are now, in the order of
+                               recorder_path (default is where they were recorded)
+    Returns:
+        the manifest (dict); 'files' has the filename, folder and frames
+        of each file in the order they were recorded.
+
+    Files are searched in the recorded folder, the folder passed in folders
+    and next to the manifest.
+    '''
+    filename = os.path.splitext(filename)[0] + '.cammanifest'
+    with open(filename,'r') as fd:
+        manifest = json.load(fd)
+    for f in manifest['files']:
+        fname = f['filename']
+        if not os.path.isfile(fname) and not folders is None:
+            recorded = manifest['folders'][f['folder']]
+            fname = pjoin(folders[f['folder']],os.path.relpath(fname,recorded))
+        if not os.path.isfile(fname):
+            fname = pjoin(os.path.dirname(filename),os.path.basename(f['filename']))
+        f['filename'] = fname
+    return manifest
+
+def run_files(filename, folders = None):
+    '''Data files of a run, from the manifest of the run (.cammanifest or .camlog).'''
+    return [f['filename'] for f in read_manifest(filename,folders)['files']]
+
+def _frame_indices(Z,nframes):
+    '''Frame numbers from an index (int, slice, integer array or boolean mask).'''
+    if isinstance(Z,slice):
+        return np.arange(*Z.indices(nframes))
+    Z = np.asarray(Z)
+    if Z.dtype == bool:
+        if not Z.shape == (nframes,):
+            raise IndexError('Boolean index has {0} values for {1} frames.'.format(
+                Z.size,nframes))
+        return np.nonzero(Z)[0]
+    Z = Z.astype(np.int64).ravel()
+    if np.any(Z >= nframes) or np.any(Z < -nframes):
+        raise IndexError('Index out of bounds for {0} frames.'.format(nframes))
+    return np.where(Z < 0,Z + nframes,Z)
+
+def _frame_shape(shape,dtype,frameindex):
+    '''Shape of a frame after indexing (on an array without data).'''
+    dummy = np.lib.stride_tricks.as_strided(np.zeros(1,dtype = dtype),
+                                            shape = shape,
+                                            strides = (0,)*len(shape))
+    return dummy[frameindex].shape
+
 class TiffStack(object):
-    def __init__(self,filenames):
+    def __init__(self,filenames,frameindex = None,
+                 cachesize = 268435456,
+                 readahead = 0,
+                 maxfiles = 16):
+        '''
+        Frames from multipage tiff files.
+            filenames  - list of files, a folder or the manifest (.cammanifest
+                         or .camlog) of a run recorded to several folders
+            frameindex - FrameIndex (or .camidx file) of the run; gives the
+                         exact number of frames in each file
+            cachesize  - bytes of decoded frames kept in memory (default 256MB),
+                         the least recently used frames are dropped first
+            readahead  - frames decoded in the background when reading
+                         sequentially (default 0 is off)
+            maxfiles   - number of files kept open
+
+        Only the pages of the requested frames are read and decoded.
+        '''
+        manifestframes = None
         if type(filenames) is str:
-            filenames = np.sort(glob(pjoin(filenames,'*.tif')))
+            if os.path.splitext(filenames)[1] in ['.cammanifest','.camlog']:
+                manifest = read_manifest(filenames)
+                filenames = [f['filename'] for f in manifest['files']]
+                manifestframes = [f['frames'] for f in manifest['files']]
+            else:
+                filenames = np.sort(glob(pjoin(filenames,'*.tif')))
         
         assert type(filenames) in [list,np.ndarray], 'Pass a list of filenames.'
         self.filenames = filenames
         for f in filenames:
             assert os.path.exists(f), f + ' not found.'
+        if type(frameindex) is str:
+            frameindex = FrameIndex(frameindex)
+        self.cachesize = cachesize
+        self.readahead = readahead
+        self.maxfiles = max(1,maxfiles)
+        self.files = [None for f in self.filenames]
+        self._openfiles = deque()           # files in the order they were opened
+        self._cache = OrderedDict()         # decoded frames, least recently used first
+        self._cachebytes = 0
+        self._lock = threading.RLock()      # file handles are shared with the readahead
+        self._readahead_pool = None
+        self._readahead_job = None
+        self._lastframe = None
         # Get an estimate by opening only the first and last files
         framesPerFile = []
-        self.files = []
         for i,fn in enumerate(self.filenames):
             if i == 0 or i == len(self.filenames)-1:
-                self.files.append(TiffFile(fn))
-            else:
-                self.files.append(None)                
-            f = self.files[-1]
-            if i == 0:
-                dims = f.series[0].shape
-                self.shape = dims
-            elif i == len(self.filenames)-1:
-                dims = f.series[0].shape
-            framesPerFile.append(np.int64(dims[0]))
+                nframes = len(self._file(i).pages)
+            framesPerFile.append(np.int64(nframes))
+        if not manifestframes is None:
+            framesPerFile = manifestframes
+        if not frameindex is None:
+            framesPerFile = frameindex.framesperfile
         self.framesPerFile = np.array(framesPerFile, dtype=np.int64)
         self.framesOffset = np.hstack([0,np.cumsum(self.framesPerFile[:-1])])
-        self.nFrames = np.sum(framesPerFile)
-        self.curfile = 0
-        self.curstack = self.files[self.curfile].asarray()
-        N,self.h,self.w = self.curstack.shape[:3]
-        self.dtype = self.curstack.dtype
-        self.shape = (self.nFrames,self.shape[1],self.shape[2])
+        self.nFrames = int(np.sum(framesPerFile))
+        page = self._file(0).pages[0]
+        self.h,self.w = page.shape[:2]
+        self.dtype = page.dtype
+        self.shape = (self.nFrames,self.h,self.w) + tuple(page.shape[2:])
+    def _file(self,fileidx):
+        '''Opens a file (closes the least recently opened when there are more than maxfiles).'''
+        with self._lock:
+            if self.files[fileidx] is None:
+                if len(self._openfiles) >= self.maxfiles:
+                    old = self._openfiles.popleft()
+                    self.files[old].close()
+                    self.files[old] = None
+                self.files[fileidx] = TiffFile(self.filenames[fileidx])
+                self._openfiles.append(fileidx)
+            return self.files[fileidx]
+    def _read(self,frame):
+        '''Reads and decodes a frame (through the cache).'''
+        with self._lock:
+            if frame in self._cache.keys():
+                self._cache.move_to_end(frame)
+                return self._cache[frame]
+            fileidx,frameidx = self.getFrameIndex(frame)
+            img = self._file(fileidx).pages[int(frameidx)].asarray()
+            if img.nbytes <= self.cachesize:
+                self._cache[frame] = img
+                self._cachebytes += img.nbytes
+                while self._cachebytes > self.cachesize:
+                    _,old = self._cache.popitem(last = False)
+                    self._cachebytes -= old.nbytes
+            return img
+    def _read_ahead(self,frames):
+        for frame in frames:
+            if self._readahead_pool is None:
+                break
+            self._read(frame)
+    def _start_readahead(self,frame):
+        '''Decodes the next frames in a thread when the frames are read in order.'''
+        if not self._lastframe is None and frame == self._lastframe + 1:
+            if self._readahead_pool is None:
+                self._readahead_pool = ThreadPoolExecutor(max_workers = 1)
+            if self._readahead_job is None or self._readahead_job.done():
+                last = min(frame + 1 + self.readahead,self.nFrames)
+                frames = [f for f in range(frame + 1,last)
+                          if not f in self._cache.keys()]
+                if len(frames):
+                    self._readahead_job = self._readahead_pool.submit(
+                        self._read_ahead,frames)
+        self._lastframe = frame
     def getFrameIndex(self,frame):
         '''Computes the frame index from multipage tiff files.'''
         fileidx = np.where(self.framesOffset <= frame)[0][-1]
         return fileidx,frame - self.framesOffset[fileidx]
-    def __getitem__(self,*args):
-        index  = args[0]
-        if not type(index) is int:
-            Z, X, Y = index
-            if type(Z) is slice:
-                index = range(Z.start, Z.stop, Z.step)
-            else:
-                index = Z
-        else:
-            index = [index]
-        img = np.empty((len(index),self.h,self.w),dtype = self.dtype)
-        for i,ind in enumerate(index):
-            img[i,:,:] = self.getFrame(ind)
-        return np.squeeze(img)
+    def __getitem__(self,index):
+        '''
+        Indexes the stack like a numpy array (frames, then the frame axes).
+
+        Example:
+            stack[10]                  # one frame
+            stack[-100:]               # the last 100 frames
+            stack[::10,100:200,50:]    # every 10th frame, cropped
+            stack[[5,2,900]]           # integer arrays
+            stack[mask]                # boolean mask with one value per frame
+            stack[0:3,np.array([1,2])] # array indices on the frame axes
+
+        Frames are grouped by file and read in page order; full frames are
+        decoded straight into the output array. The frame axes are indexed
+        on each frame (frame indices do not broadcast with them).
+        '''
+        if not type(index) is tuple:
+            index = (index,)
+        Z,frameindex = index[0],index[1:]
+        if Z is Ellipsis:
+            Z,frameindex = slice(None),index
+        frames = _frame_indices(Z,self.nFrames)
+        crop = len(frameindex) and not all(
+            [i is Ellipsis or (isinstance(i,slice) and i == slice(None))
+             for i in frameindex])
+        img = np.empty((len(frames),) + _frame_shape(self.shape[1:],self.dtype,frameindex),
+                       dtype = self.dtype)
+        fileidx = np.searchsorted(self.framesOffset,frames,side = 'right') - 1
+        with self._lock:
+            for ifile in np.unique(fileidx):
+                sel = np.where(fileidx == ifile)[0]
+                sel = sel[np.argsort(frames[sel],kind = 'stable')]
+                for i in sel:
+                    frame = frames[i]
+                    if crop or frame in self._cache.keys():
+                        img[i] = self._read(frame)[frameindex]
+                    else:
+                        self._file(ifile).pages[int(frame - self.framesOffset[ifile])].asarray(
+                            out = img[i])
+        if self.readahead > 0 and len(frames):
+            self._start_readahead(frames[-1])
+        if not isinstance(Z,slice) and not np.asarray(Z).dtype == bool:
+            return img.reshape(np.shape(Z) + img.shape[1:]) # integer indices
+        return img
     def getFrame(self,frame):
         ''' Returns a single frame from the stack '''
-        fileidx,frameidx = self.getFrameIndex(frame)
-        if not fileidx == self.curfile:
-            if self.files[fileidx] is None:
-                self.files[fileidx] = TiffFile(self.filenames[fileidx])
-            self.curstack = self.files[fileidx].asarray()
-            self.curfile = fileidx
-        return self.curstack[frameidx,:,:]
+        img = self._read(frame)
+        if self.readahead > 0:
+            self._start_readahead(frame)
+        return img
+    def close(self):
+        '''Stops the readahead and closes the files.'''
+        pool = self._readahead_pool
+        self._readahead_pool = None
+        if not pool is None:
+            pool.shutdown(wait = True)
+        with self._lock:
+            for i in self._openfiles:
+                self.files[i].close()
+                self.files[i] = None
+            self._openfiles.clear()
+            self._cache.clear()
+            self._cachebytes = 0
     def __len__(self):
         return self.nFrames
 
+class FrameIndex(object):
+    '''
+    Reads the frame index (.camidx) of a run as a memory map (see CAMIDX_DTYPE).
+
+    Finds frames by frame id (constant time when no frames were dropped)
+    or by timestamp across the files of a run.
+
+    Example:
+        idx = FrameIndex(filename)    # the .camidx or the .camlog of the run
+        ifile,iframe,offset = idx.locate(frame_id)
+        i = idx.find_timestamp(t)
+        idx.framesperfile             # frames in each file
+    '''
+    def __init__(self,filename):
+        filename = os.path.splitext(filename)[0] + '.camidx'
+        self.filename = filename
+        with open(filename,'rb') as fd:
+            magic = fd.read(len(_CAMIDX_MAGIC))
+            assert magic == _CAMIDX_MAGIC, '{0} is not a frame index.'.format(filename)
+            itemsize, = struct.unpack('<Q',fd.read(8))
+        assert itemsize == CAMIDX_DTYPE.itemsize, 'Unknown frame index record size {0}'.format(itemsize)
+        nrecords = (os.path.getsize(filename) - 16)//itemsize
+        if nrecords > 0:
+            self.records = np.memmap(filename,dtype = CAMIDX_DTYPE,mode = 'r',
+                                     offset = 16,shape = (nrecords,))
+        else:
+            self.records = np.zeros(0,dtype = CAMIDX_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self,index):
+        return self.records[index]
+
+    @property
+    def frame_id(self):
+        return self.records['frame_id']
+
+    @property
+    def timestamp(self):
+        return self.records['timestamp']
+
+    @property
+    def framesperfile(self):
+        return np.bincount(self.records['file'])
+
+    def find(self,frame_id):
+        '''Position of frame_id in the run.'''
+        ids = self.records['frame_id']
+        if not len(ids):
+            raise KeyError('Frame {0} not in {1}'.format(frame_id,self.filename))
+        i = int(frame_id - ids[0])
+        if 0 <= i < len(ids) and ids[i] == frame_id:
+            return i
+        i = int(np.searchsorted(ids,frame_id))
+        if i < len(ids) and ids[i] == frame_id:
+            return i
+        raise KeyError('Frame {0} not in {1}'.format(frame_id,self.filename))
+
+    def locate(self,frame_id):
+        '''Returns the file number, frame number in the file and byte offset of frame_id.'''
+        r = self.records[self.find(frame_id)]
+        return int(r['file']),int(r['index']),int(r['offset'])
+
+    def find_timestamp(self,timestamp,host = False):
+        '''Position of the first frame at or after timestamp (camera or host time).'''
+        t = self.records['host_time' if host else 'timestamp']
+        return int(min(np.searchsorted(t,timestamp),len(t)-1))
+
+class LosslessStack(object):
+    '''
+    Reads the frames recorded with the lossless recorder (see LosslessFile).
+
+    When the file has no index (the recording was not closed) the complete
+    frames are found from the frame sizes.
+
+    Example:
+        stack = LosslessStack(filename)
+        frame = stack[10]
+        frames = stack[100:200]
+    '''
+    def __init__(self,filename):
+        self.filename = filename
+        self.fd = open(filename,'rb')
+        magic = self.fd.read(len(_LOSSLESS_MAGIC))
+        assert magic == _LOSSLESS_MAGIC, '{0} is not a lossless recording.'.format(filename)
+        nheader, = struct.unpack('<Q',self.fd.read(8))
+        header = json.loads(self.fd.read(nheader).decode())
+        self.codec = header['codec']
+        self.dtype = np.dtype(header['dtype'])
+        self.frame_shape = tuple(header['shape'])
+        start = self.fd.tell()
+        filesize = self.fd.seek(0,os.SEEK_END)
+        magic = None
+        if filesize - start >= _LOSSLESS_FOOTER.size:
+            self.fd.seek(-_LOSSLESS_FOOTER.size,os.SEEK_END)
+            offset,nframes,magic = _LOSSLESS_FOOTER.unpack(self.fd.read(_LOSSLESS_FOOTER.size))
+        if magic == _LOSSLESS_MAGIC:
+            self.fd.seek(offset)
+            self.index = np.frombuffer(self.fd.read(int(nframes)*16),
+                                       dtype = np.uint64).reshape(-1,2)
+        else:
+            assert header.get('frame_sizes',False), '{0} has no index (was the recording closed?).'.format(filename)
+            self.index = self._scan_frames(start,filesize)
+        self.nframes = len(self.index)
+        self.shape = (self.nframes,) + self.frame_shape
+
+    def _scan_frames(self,offset,filesize):
+        '''Index (offset and size) of the complete frames, from the frame sizes.'''
+        index = []
+        while offset + 8 <= filesize:
+            self.fd.seek(offset)
+            nbytes, = struct.unpack('<Q',self.fd.read(8))
+            if nbytes == 0 or offset + 8 + nbytes > filesize:
+                break # end of the frames or a partial frame
+            index.append((offset + 8,nbytes))
+            offset += 8 + nbytes
+        return np.array(index,dtype = np.uint64).reshape(-1,2)
+
+    def getFrame(self,frame):
+        ''' Returns a single frame from the stack '''
+        offset,nbytes = self.index[frame]
+        self.fd.seek(int(offset))
+        return decode_frame(self.fd.read(int(nbytes)),self.frame_shape,
+                            self.dtype,codec = self.codec)
+
+    def __getitem__(self,index):
+        if isinstance(index,(int,np.integer)):
+            return self.getFrame(index)
+        idx = np.arange(self.nframes)[index]
+        return np.stack([self.getFrame(i) for i in idx])
+
+    def __len__(self):
+        return self.nframes
+
+    def close(self):
+        self.fd.close()
+
 def mmap_dat(filename,
              mode = 'r',
              nframes = None,
@@ -907,9 +2941,17 @@ def mmap_dat(filename,
     Example:
         dat = mmap_dat(filename)
 
+    The manifest (.cammanifest) of a run recorded to several folders can be
+    passed instead of filename; when the run has more than one file a
+    BinaryStack is returned (see mmap_run).
+
     Joao Couto - from wfield
     '''
-    
+    if os.path.splitext(filename)[1] == '.cammanifest':
+        files = run_files(filename)
+        if len(files) > 1:
+            return mmap_run(filename,mode = mode)
+        filename = files[0]
     if not os.path.isfile(filename):
         raise OSError('File {0} not found.'.format(filename))
     if shape is None or dtype is None: # try to get it from the filename
@@ -932,7 +2974,221 @@ def mmap_dat(filename,
                      shape = (int(nframes),*shape))
 
 
-def stack_to_mj2_lossless(stack,fname, rate = 30):
+class BinaryStack(object):
+    '''
+    Frames of a binary run split in several files, as one array (see mmap_run).
+
+    Each file is a memory map; indexing works like a numpy array with the
+    frames of all files on the first axis. Only the requested frames are
+    read; slices inside one file return a view of the memory map.
+
+    Example:
+        stack = mmap_run(folder)
+        stack.shape
+        frames = stack[1000:3000,:,100:200] # across file boundaries
+        stack.log.iloc[1000:3000]           # frame_id and timestamp of the frames
+        stack.metadata(frames)              # same, for any index
+    '''
+    def __init__(self,filenames,camlog = None,mode = 'r'):
+        self.filenames = list(filenames)
+        assert len(self.filenames), 'No binary files.'
+        self.maps = [mmap_dat(f,mode = mode) for f in self.filenames]
+        self.framesPerFile = np.array([len(m) for m in self.maps],dtype = np.int64)
+        self.framesOffset = np.hstack([0,np.cumsum(self.framesPerFile[:-1])])
+        self.nFrames = int(np.sum(self.framesPerFile))
+        self.dtype = self.maps[0].dtype
+        self.shape = (self.nFrames,) + self.maps[0].shape[1:]
+        self.camlog = camlog
+        self.log = None
+        self.comments = None
+        if not camlog is None:
+            self.log,self.comments = parseCamLog(camlog)
+    def __len__(self):
+        return self.nFrames
+    def getFrameIndex(self,frame):
+        '''Computes the file and the frame in the file.'''
+        fileidx = np.searchsorted(self.framesOffset,frame,side = 'right') - 1
+        return fileidx,frame - self.framesOffset[fileidx]
+    def __getitem__(self,index):
+        if not type(index) is tuple:
+            index = (index,)
+        Z,frameindex = index[0],index[1:]
+        if Z is Ellipsis:
+            Z,frameindex = slice(None),index
+        frames = _frame_indices(Z,self.nFrames)
+        fileidx = np.searchsorted(self.framesOffset,frames,side = 'right') - 1
+        if isinstance(Z,slice) and len(frames) and fileidx[0] == fileidx[-1]:
+            # inside one file: a view of the memory map
+            start,stop,step = Z.indices(self.nFrames)
+            offset = self.framesOffset[fileidx[0]]
+            stop = frames[-1] + (1 if step > 0 else -1) - offset
+            local = slice(frames[0] - offset,None if stop < 0 else stop,step)
+            return self.maps[fileidx[0]][(local,) + frameindex]
+        img = np.empty((len(frames),) + _frame_shape(self.shape[1:],self.dtype,frameindex),
+                       dtype = self.dtype)
+        for ifile in np.unique(fileidx):
+            sel = np.where(fileidx == ifile)[0]
+            local = frames[sel] - self.framesOffset[ifile]
+            img[sel] = self.maps[ifile][local][(slice(None),) + frameindex]
+        if not isinstance(Z,slice) and not np.asarray(Z).dtype == bool:
+            return img.reshape(np.shape(Z) + img.shape[1:]) # integer indices
+        return img
+    def metadata(self,index = slice(None)):
+        '''Camlog rows (frame_id, timestamp, ...) of the frames selected by index.'''
+        assert not self.log is None, 'The run has no camlog.'
+        frames = _frame_indices(index,self.nFrames)
+        return self.log.iloc[frames]
+
+def _run_key(filename):
+    '''
+    Name of the run of a binary file or camlog: the filename without the
+    _NCHANNELS_H_W_DTYPE (or _H_W_DTYPE) of binary files and the file number.
+    '''
+    name,ext = os.path.splitext(filename)
+    parts = name.split('_')
+    if ext in ['.dat','.bin']:
+        try: # Check if there are multiple channels
+            [int(m) for m in parts[-4:-1]]
+            parts = parts[:-4]
+        except ValueError:
+            parts = parts[:-3]
+    if len(parts) > 1 and parts[-1].isdigit():
+        parts = parts[:-1]
+    return '_'.join(parts)
+
+def _run_camlog(filenames):
+    '''The camlog of a binary run (next to the first file, with the same run name).'''
+    key = _run_key(filenames[0])
+    camlogs = [f for f in np.sort(glob(pjoin(os.path.dirname(filenames[0]),'*.camlog')))
+               if _run_key(f) == key]
+    if len(camlogs):
+        return camlogs[0]
+    return None
+
+def mmap_run(filename, mode = 'r'):
+    '''
+    Memory maps all the files of a binary run (recorder_frames_per_file > 0)
+    as a single array with the frames on the first axis.
+
+    Inputs:
+        filename (str|list)  : a folder with one run (raises when there are
+                               more), a glob pattern
+                               (e.g. 'folder/*run001*.dat'), the camlog or
+                               manifest of the run or a list of files
+        mode (str)           : memory map access mode (default 'r')
+    Returns:
+        a BinaryStack; the camlog rows of the run are in stack.log
+
+    Example:
+        stack = mmap_run('~/data/cam0/20210101_run000')
+        frame = stack[-1]
+    '''
+    camlog = None
+    if type(filename) in [list,tuple,np.ndarray]:
+        filenames = list(filename)
+    elif os.path.isdir(filename):
+        filenames = np.sort(glob(pjoin(filename,'*.dat'))).tolist()
+    elif os.path.splitext(filename)[1] in ['.camlog','.cammanifest']:
+        camlog = os.path.splitext(filename)[0] + '.camlog'
+        if os.path.isfile(os.path.splitext(filename)[0] + '.cammanifest'):
+            filenames = run_files(filename)
+        else:
+            comments = []
+            with open(camlog,'r') as fd:
+                for line in fd:
+                    if line.startswith('#'):
+                        comments.append(line.strip('\n').strip('\r'))
+            filenames = _camlog_files(camlog,comments)
+    else:
+        filenames = np.sort(glob(filename)).tolist()
+    filenames = [f for f in filenames if os.path.splitext(f)[1] in ['.dat','.bin']]
+    assert len(filenames), 'No binary files in {0}'.format(filename)
+    if camlog is None:
+        runs = np.unique([_run_key(f) for f in filenames])
+        if len(runs) > 1:
+            raise ValueError('{0} has files of {1} runs ({2}); pass the camlog of a run or a pattern.'.format(
+                filename,len(runs),', '.join([os.path.basename(r) for r in runs])))
+        camlog = _run_camlog(filenames)
+    stack = BinaryStack(filenames,camlog = camlog,mode = mode)
+    if not stack.log is None and not len(stack.log) == len(stack):
+        display('[mmap_run] {0} has {1} rows for {2} frames.'.format(
+            camlog,len(stack.log),len(stack)))
+    return stack
+
+_MJ2_COUNTER = None # frames encoded by the workers (see stack_to_mj2_lossless)
+
+def _mj2_init_worker(counter):
+    global _MJ2_COUNTER
+    _MJ2_COUNTER = counter
+
+def _mj2_source(stack):
+    '''
+    (filename,shape,dtype) when the stack maps a file from its start, so the
+    workers map the file themselves instead of receiving the frames.
+    '''
+    if (isinstance(stack,np.memmap) and not stack.filename is None and
+        stack.offset == 0 and stack.flags.c_contiguous and
+        not stack._mmap is None):
+        start = np.frombuffer(stack._mmap,dtype = np.uint8).__array_interface__['data'][0]
+        if stack.__array_interface__['data'][0] == start:
+            return (stack.filename,stack.shape,stack.dtype.str)
+    return None
+
+def _mj2_decode(filename,shape,dtype):
+    '''Decodes a movie with ffmpeg, yields the frames.'''
+    proc = subprocess.Popen([_ffmpeg_binary(),'-loglevel','error','-i',filename,
+                             '-f','rawvideo','-pix_fmt','gray16le','-'],
+                            stdout = subprocess.PIPE,stderr = subprocess.DEVNULL)
+    nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+    while True:
+        buf = proc.stdout.read(nbytes)
+        if len(buf) < nbytes:
+            break
+        yield np.frombuffer(buf,dtype = dtype).reshape(shape)
+    proc.stdout.close()
+    proc.wait()
+
+def _mj2_encode_chunk(source,start,stop,filename,rate,verify):
+    '''
+    Encodes frames [start,stop) of a stack to filename (runs in a worker).
+    Returns start, stop and the number of frames that do not match the
+    source after decoding (-1 when not verified).
+    '''
+    if type(source) is tuple:
+        fname,shape,dtype = source
+        frames = np.memmap(fname,mode = 'r',dtype = dtype,shape = tuple(shape))[start:stop]
+    else:
+        frames = source
+    fd = FFmpegPipe(filename,frames[0],
+                    inputdict = {'-pix_fmt':'gray16le','-r':str(rate)},
+                    outputdict = {'-c:v':'libopenjpeg','-pix_fmt':'gray16le','-r':str(rate)})
+    for i in range(0,len(frames),16):
+        fd.write(frames[i:i + 16])
+        if not _MJ2_COUNTER is None:
+            with _MJ2_COUNTER.get_lock():
+                _MJ2_COUNTER.value += len(frames[i:i + 16])
+    fd.close()
+    mismatch = -1
+    if verify:
+        ndecoded = 0
+        mismatch = 0
+        for i,frame in enumerate(_mj2_decode(filename,frames.shape[1:],frames.dtype)):
+            if i >= len(frames) or not zlib.crc32(frame) == zlib.crc32(np.ascontiguousarray(frames[i])):
+                mismatch += 1
+            ndecoded += 1
+        mismatch += abs(len(frames) - ndecoded)
+    return start,stop,mismatch
+
+def _mj2_count_frames(filename):
+    '''Counts the frames of a movie without decoding.'''
+    # one line per packet (frame) in the framemd5 output
+    proc = subprocess.run([_ffmpeg_binary(),'-loglevel','error','-i',filename,
+                           '-map','0:v:0','-c','copy','-f','framemd5','-'],
+                          stdout = subprocess.PIPE,stderr = subprocess.DEVNULL)
+    return len([l for l in proc.stdout.split(b'\n')
+                if len(l) and not l.startswith(b'#')])
+
+def stack_to_mj2_lossless(stack,fname, rate = 30, nworkers = 0, chunksize = 512, verify = True):
     '''
     Compresses a uint16 stack with FFMPEG and libopenjpeg
     
@@ -940,6 +3196,13 @@ def stack_to_mj2_lossless(stack,fname, rate = 30):
         stack                : array or memorymapped binary file
         fname                : output filename (will change extension to .mov)
         rate                 : rate of the mj2 movie [30 Hz default]
+        nworkers             : processes encoding chunks of the stack [0 is one per core]
+        chunksize            : frames per chunk
+        verify               : decode each chunk and compare with the stack
+
+    The stack is split in chunks (chunk_indices) that are encoded in parallel
+    and joined without re-encoding. Workers map binary files themselves.
+    Raises an OSError when the movie does not match the stack.
 
     Example:
        from labcams.io import * 
@@ -958,13 +3221,276 @@ def stack_to_mj2_lossless(stack,fname, rate = 30):
     assert stack.dtype == np.uint16, "[mj2 conversion] This only works for uint16 for now."
 
     nstack = stack.reshape([-1,*stack.shape[2:]]) # flatten if needed    
-    sq = FFmpegWriter(outfname, inputdict={'-pix_fmt':'gray16le',
-                                              '-r':str(rate)}, # this is important
-                      outputdict={'-c:v':'libopenjpeg',
-                                  '-pix_fmt':'gray16le',
-                                  '-r':str(rate)})
+    source = _mj2_source(nstack)
+    chunks = chunk_indices(len(nstack),chunksize)
+    if nworkers < 1:
+        nworkers = os.cpu_count()
+    nworkers = min(nworkers,len(chunks))
+    tmpdir = tempfile.mkdtemp(prefix = '.mj2_',dir = os.path.dirname(os.path.abspath(outfname)))
+    segments = [pjoin(tmpdir,'{0:06d}.mov'.format(i)) for i in range(len(chunks))]
+    def _job(i):
+        start,stop = chunks[i]
+        return (source if not source is None else np.ascontiguousarray(nstack[start:stop]),
+                start,stop,segments[i],rate,verify)
     from tqdm import tqdm
-    for i,f in tqdm(enumerate(nstack),total=len(nstack)):
-        sq.writeFrame(f)
-    sq.close()
+    try:
+        results = []
+        with tqdm(total = len(nstack),desc = '[mj2 conversion]') as pbar:
+            if nworkers <= 1:
+                for i in range(len(chunks)):
+                    results.append(_mj2_encode_chunk(*_job(i)))
+                    pbar.update(results[-1][1] - results[-1][0])
+            else:
+                counter = Value('l',0)
+                with ProcessPoolExecutor(max_workers = nworkers,
+                                         initializer = _mj2_init_worker,
+                                         initargs = (counter,)) as pool:
+                    jobs = [pool.submit(_mj2_encode_chunk,*_job(i)) for i in range(len(chunks))]
+                    while not all([j.done() for j in jobs]):
+                        time.sleep(0.2)
+                        pbar.update(counter.value - pbar.n)
+                    results = [j.result() for j in jobs]
+                    pbar.update(len(nstack) - pbar.n)
+        bad = [(start,stop,n) for start,stop,n in results if n > 0]
+        if len(bad):
+            raise OSError('[mj2 conversion] {0} frames do not match the stack (chunks {1}).'.format(
+                np.sum([n for start,stop,n in bad]),[b[:2] for b in bad]))
+        if len(segments) == 1:
+            os.replace(segments[0],outfname)
+        else:
+            listfile = pjoin(tmpdir,'segments.txt')
+            with open(listfile,'w') as fd:
+                for f in segments:
+                    fd.write("file '{0}'\n".format(f))
+            proc = subprocess.run([_ffmpeg_binary(),'-y','-loglevel','error',
+                                   '-f','concat','-safe','0','-i',listfile,
+                                   '-c','copy',outfname],
+                                  stdout = subprocess.DEVNULL,stderr = subprocess.PIPE)
+            if proc.returncode:
+                raise OSError('[mj2 conversion] Could not join the chunks: {0}'.format(
+                    proc.stderr.decode(errors = 'replace')))
+        if verify:
+            nframes = _mj2_count_frames(outfname)
+            if not nframes == len(nstack):
+                raise OSError('[mj2 conversion] {0} has {1} frames, the stack has {2}.'.format(
+                    outfname,nframes,len(nstack)))
+    finally:
+        shutil.rmtree(tmpdir,ignore_errors = True)
     
+def _recover_data_file(fname, truncate = True):
+    '''
+    Counts the complete frames in a data file (and truncates a partial frame
+    at the end of binary files). Returns (nframes,truncated bytes,note);
+    nframes is None when the format can not be checked or the file can not
+    be read (the note starts with 'could not be read').
+    '''
+    ext = os.path.splitext(fname)[1]
+    try:
+        if ext in ['.dat','.bin']:
+            dat = mmap_dat(fname)
+            framesize = int(np.prod(dat.shape[1:])*dat.dtype.itemsize)
+            nframes = len(dat)
+            del dat
+            extra = os.path.getsize(fname) - nframes*framesize
+            if extra and truncate:
+                os.truncate(fname,nframes*framesize)
+            return nframes,extra,''
+        elif ext == '.tif':
+            nframes = 0
+            note = ''
+            with TiffFile(fname) as fd:
+                try:
+                    for page in fd.pages:
+                        page.asarray()
+                        nframes += 1
+                except Exception as err: # the pages before are complete
+                    note = 'truncated after {0} pages ({1})'.format(nframes,err)
+            return nframes,0,note
+        elif ext == '.h5':
+            h5py,hdf5plugin = _import_hdf5()
+            with h5py.File(fname,'r') as fd:
+                return len(fd['frames']),0,''
+        elif ext == '.lossless':
+            stack = LosslessStack(fname)
+            stack.close()
+            return len(stack),0,''
+    except Exception as err:
+        return None,0,'could not be read ({0})'.format(err)
+    return None,0,'not checked'
+
+def _camlog_files(fname,comments):
+    '''Data files of a run from the "opened" comments of the camlog.'''
+    folder = os.path.dirname(fname)
+    files = []
+    for c in comments:
+        if not c.startswith('# [') or not '] - ' in c:
+            continue
+        f = c.split('] - ',1)[1].strip()
+        if not os.path.splitext(f)[1] in ['.dat','.bin','.tif','.h5',
+                                          '.lossless','.avi','.mov']:
+            continue
+        if not os.path.isfile(f):
+            f = pjoin(folder,os.path.basename(f))
+        if os.path.isfile(f) and not f in files:
+            files.append(f)
+    return files
+
+def recover_run(fname, dry_run = False):
+    '''
+    Checks a run after a crash and keeps the frames that are complete.
+
+    Counts the complete frames in the data files (binary files are truncated
+    to the last complete frame), drops the camlog rows of frames that were
+    not written, and rebuilds the frame index (.camidx). A comment with
+    what was lost is added to the camlog. Runs with data files that can not
+    be read are only reported (the files are left as they are).
+
+    Inputs:
+        fname (str)          : camlog of the run
+        dry_run (bool)       : only report, do not change the files
+    Returns:
+        a dictionary with the report.
+    '''
+    comments = []
+    with open(fname,'r') as fd:
+        for line in fd:
+            if line.startswith('#'):
+                comments.append(line.strip('\n').strip('\r'))
+    report = dict(camlog = fname,files = [],closed = None,
+                  checkpoint_frames = None,truncated_bytes = 0,
+                  unreadable = [])
+    statefile = os.path.splitext(fname)[0] + '.camstate'
+    if os.path.isfile(statefile):
+        with open(statefile,'r') as fd:
+            state = json.load(fd)
+        report['closed'] = state['closed']
+        report['checkpoint_frames'] = state['frames']
+    files = _camlog_files(fname,comments)
+    counts = []
+    for f in files:
+        nframes,extra,note = _recover_data_file(f,truncate = not dry_run)
+        report['files'].append(dict(filename = f,frames = nframes,
+                                    truncated_bytes = extra,note = note))
+        report['truncated_bytes'] += extra
+        if note.startswith('could not be read'):
+            report['unreadable'].append(f)
+        counts.append(nframes)
+    camidx = os.path.splitext(fname)[0] + '.camidx'
+    # the frame rows
+    if len(files) and np.all([f.endswith('.h5') for f in files]):
+        try:
+            logdata = parseHDF5Log(files)
+        except Exception:
+            # the rows are in the hdf5 files, use the frame index (last checkpoint)
+            logdata = pd.DataFrame()
+            if os.path.isfile(camidx):
+                old = FrameIndex(camidx)
+                logdata = pd.DataFrame(dict(frame_id = np.array(old.records['frame_id']),
+                                            timestamp = np.array(old.records['timestamp'])))
+                del old
+    else:
+        try:
+            logdata,_ = parseCamLog(fname)
+            logdata = logdata.dropna()
+        except (pd.errors.EmptyDataError,ValueError):
+            logdata = pd.DataFrame()
+    nrows = len(logdata)
+    ndata = None
+    if len(counts) and not None in counts:
+        ndata = int(np.sum(counts))
+    nvalid = nrows if ndata is None else min(nrows,ndata)
+    report['log_rows'] = nrows
+    report['data_frames'] = ndata
+    report['valid_frames'] = nvalid
+    report['rows_without_frames'] = nrows - nvalid
+    report['frames_without_rows'] = 0 if ndata is None else ndata - nvalid
+    if dry_run:
+        return report
+    if len(report['unreadable']):
+        # the counts of these files are unknown, do not drop rows of frames on disk
+        return report
+    camrec = os.path.splitext(fname)[0] + '.camrec'
+    if os.path.isfile(camrec):
+        with open(camrec,'rb') as fd:
+            fd.read(len(_CAMREC_MAGIC))
+            nheader, = struct.unpack('<Q',fd.read(8))
+        itemsize = read_camrec(camrec).dtype.itemsize
+        os.truncate(camrec,len(_CAMREC_MAGIC) + 8 + nheader + nvalid*itemsize)
+        ntext = 0
+    else:
+        ntext = nvalid
+    # rewrite the camlog with the comments and the valid rows (in order)
+    if not os.path.isfile(fname + '.bak'):
+        shutil.copy2(fname,fname + '.bak')
+    with open(fname,'r') as fd, open(fname + '.tmp','w') as out:
+        for line in fd:
+            if not line.endswith('\n'):
+                continue # partial line
+            if line.startswith('#'):
+                out.write(line)
+            elif ntext > 0:
+                out.write(line)
+                ntext -= 1
+        out.write('# [' + datetime.today().strftime('%y-%m-%d %H:%M:%S') +
+                  '] - Recovered {0} frames ({1} rows without frames, {2} frames without rows, {3} bytes truncated)'.format(
+                      nvalid,report['rows_without_frames'],
+                      report['frames_without_rows'],report['truncated_bytes']) + '\n')
+    os.replace(fname + '.tmp',fname)
+    # rebuild the frame index
+    hosttime = None
+    if os.path.isfile(camidx):
+        old = FrameIndex(camidx)
+        hosttime = np.array(old.records['host_time'][:nvalid])
+        del old
+    records = np.zeros(nvalid,dtype = CAMIDX_DTYPE)
+    if nvalid:
+        records['frame_id'] = logdata['frame_id'].values[:nvalid]
+        records['timestamp'] = logdata['timestamp'].values[:nvalid]
+        records['host_time'] = np.nan
+        if not hosttime is None:
+            records['host_time'][:len(hosttime)] = hosttime
+        if len(counts) and not None in counts:
+            filenum = np.repeat(np.arange(len(counts)),counts)[:nvalid]
+            records['file'] = filenum
+            starts = np.hstack([0,np.cumsum(counts)[:-1]])
+            records['index'] = np.arange(nvalid) - starts[filenum]
+            records['offset'] = -1
+            for i,f in enumerate(files):
+                if os.path.splitext(f)[1] in ['.dat','.bin']:
+                    dat = mmap_dat(f)
+                    framesize = int(np.prod(dat.shape[1:])*dat.dtype.itemsize)
+                    del dat
+                    sel = filenum == i
+                    records['offset'][sel] = records['index'][sel]*framesize
+        else:
+            records['index'] = np.arange(nvalid)
+            records['offset'] = -1
+    index = FrameIndexFile(camidx)
+    index.add(records)
+    index.close()
+    with open(statefile,'w') as fd:
+        json.dump(dict(time = time.time(),frames = int(nvalid),
+                       files = len(files),closed = True,recovered = True),fd)
+    return report
+
+def recover_folder(folder, dry_run = False):
+    '''
+    Runs recover_run on all camlogs in a folder (recursively) and displays what was lost.
+
+    Example:
+        labcams --recover FOLDER
+    '''
+    reports = []
+    for fname in sorted(glob(pjoin(folder,'**','*.camlog'),recursive = True)):
+        report = recover_run(fname,dry_run = dry_run)
+        reports.append(report)
+        state = {True:'closed',False:'not closed',None:'no checkpoints'}[report['closed']]
+        display('[recover] {0} ({1}): {2} valid frames; {3} rows without frames, {4} frames without rows, {5} bytes truncated'.format(
+            fname,state,report['valid_frames'],report['rows_without_frames'],
+            report['frames_without_rows'],report['truncated_bytes']))
+        for f in report['files']:
+            if len(f['note']):
+                display('[recover]    {0} {1}'.format(f['filename'],f['note']))
+        if len(report['unreadable']) and not dry_run:
+            display('[recover]    {0} was not changed (data files could not be read).'.format(fname))
+    return reports
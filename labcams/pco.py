@@ -504,6 +504,7 @@ class PCOCam(GenericCam):
         assert bytes_per_pixel.value == 2 # uint16
         self.out = np.zeros((self.wYResAct.value, self.wXResAct.value),
                             dtype=np.uint16)
+        self._init_frame_pool(self.out.shape,self.out.dtype)
         self.acquisitionstart()
                 
     def _cam_stopacquisition(self):
@@ -598,7 +599,9 @@ class PCOCam(GenericCam):
                 #print("Record to memory result:")
                 #print(hex(dwStatusDll.value), hex(dwStatusDrv.value))
                 buffer_ptr = ctypes.cast(self.buffer_pointers[which_buf], ctypes.POINTER(self.ArrayType))
-                self.out[:, :] = np.frombuffer(buffer_ptr.contents, dtype=np.uint16).reshape(self.out.shape)
+                # copy straight from the driver buffer to the frame pool
+                out = self._get_pool_buffer()
+                out[:, :] = np.frombuffer(buffer_ptr.contents, dtype=np.uint16).reshape(out.shape)
                 num_acquired += 1
             finally:
                 self._dll.PCO_AddBufferEx(  # Put the buffer back in the queue
@@ -608,21 +611,22 @@ class PCOCam(GenericCam):
                 self.added_buffers.append(which_buf)
             frameID = 0
             timestamp = 0
-            frameID = int(''.join([hex(((a >> 8*0) & 0xFF))[-2:] for a in self.out[0,:4]]).replace('x','0'))
+            frameID = int(''.join([hex(((a >> 8*0) & 0xFF))[-2:] for a in out[0,:4]]).replace('x','0'))
             try:
                 datestr = ('{0}{1}-{2}-{3} {4}:{5}:{6}.{7}{8}{9}'.format(
                     *[hex(((a >> 8*0) & 0xFF)
-                          )[-2:] for a in self.out[0,4:14]]).replace('x','0'))
+                          )[-2:] for a in out[0,4:14]]).replace('x','0'))
                 timestam = datetime.strptime(datestr,'%Y-%m-%d %H:%M:%S.%f')
             except:
                 timestam = datetime.now()
             timestamp = (timestam - self.datestart).total_seconds()
             # Handle failed string decoding.
             self.nframes.value = frameID
-            return self.out.copy(),(frameID,timestamp)
+            return out,(frameID,timestamp)
         return None,(None,None)
 
     def _update_buffer(self,frame,frameID):
+        # the channels are combined in self.img and then published
         if not self.acquisition_stim_trigger is None:
             if self.nchan > 1:
                 tmpid = np.mod(frameID,self.nchan)
@@ -632,6 +636,7 @@ class PCOCam(GenericCam):
                 self.img[:,:,0] = frame[:]
         else:
             self.img[:] = np.reshape(frame,self.img.shape)[:]
+        self._publish_img(self.img,frameID)
     
     def _cam_close(self):
         display('PCO [{0}] - Stopping acquisition.'.format(self.camId))
@@ -642,6 +647,6 @@ class PCOCam(GenericCam):
         self.saving.clear()
         if self.was_saving:
             self.was_saving = False
-            self.queue.put(['STOP'])
+            self._send_stop()
         display('PCO {0} - Close event: {1}'.format(self.camId,
                                                     self.close_event.is_set()))
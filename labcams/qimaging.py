@@ -79,6 +79,7 @@ class QImagingCam(GenericCam):
         #                    dtype = self.dtype).reshape([
         #                        self.w,self.h,self.nchan])
         ReleaseDriver()
+        self._init_preview_views()
         self.close_event.clear()
         while not self.close_event.is_set():
             self.nframes.value = 0
@@ -115,34 +116,33 @@ class QImagingCam(GenericCam):
                 del queue
                 del cam
                 break
+            self._init_frame_pool((self.w,self.h),self.dtype)
             queue.start()
             #tstart = time.time()
             display('QImaging - Started acquisition.')
             self.camera_ready.clear()
+            self.lastframeid = -1
             while not self.stop_trigger.is_set():
                 # run and acquire frames
                 try:
                     f = queue.get(True, 1)
                 except queue.Empty:
                     continue
+                self._tsdk = time.time()
                 self.nframes.value += 1
-                frame = np.ndarray(buffer = f.stringBuffer,
-                                   dtype = self.dtype,
-                                   shape = (self.w,
-                                            self.h)).copy()
+                frame = self._get_pool_buffer()
+                frame[:] = np.ndarray(buffer = f.stringBuffer,
+                                      dtype = self.dtype,
+                                      shape = (self.w,
+                                               self.h))
                     
                 #display("Time {0} - {1}:".format(str(1./(time.time()-tstart)),self.nframes.value))
                 #tstart = time.time()
                 timestamp = f.timeStamp
                 frameID = f.frameNumber
-                if self.saving.is_set():
-                    self.was_saving = True
-                    self.queue.put((frame.reshape([self.h,self.w]),
-                                    (frameID,timestamp)))
-                elif self.was_saving:
-                    self.was_saving = False
-                    self.queue.put(['STOP'])
-                self.img[:] = np.reshape(frame,self.img.shape)[:]
+                # checks for dropped frames, queues the frame when saving
+                self._handle_frame(frame.reshape([self.h,self.w]),
+                                   (frameID,timestamp))
 
                 queue.put(f)
 
@@ -45,10 +45,46 @@ def display(msg):
 preferencepath = pjoin(os.path.expanduser('~'), 'labcams')
 
 # This has the cameras and properties
-_RECORDER_SETTINGS = {'recorder':['tiff','ffmpeg','binary'],
+_RECORDER_SETTINGS = {'recorder':['tiff','ffmpeg','binary','hdf5','lossless'],
                       'recorder_help':'Different recorders allow saving data in different formats or using compresssion. Note that the realtime compression enabled by the ffmpeg video recorder can require specific hardware.',
                       'recording_queue':True,
-                      'recording_queue_help':'Whether to use an intermediate queue for copying data from the camera, can assure that all data are stored regardless of disk usage; do not use this when recording at very high rates (1kHz) because it may introduce an overhead)'}
+                      'recording_queue_help':'Whether to use an intermediate queue for copying data from the camera, can assure that all data are stored regardless of disk usage; do not use this when recording at very high rates (1kHz) because it may introduce an overhead)',
+                      'recording_buffer':['queue','ring'],
+                      'recording_buffer_help':'How frames are passed to the recorder: queue (frames are pickled and copied) or ring (frames are copied once to a shared memory ring of preallocated frames)',
+                      'recording_buffer_size':64,
+                      'recording_buffer_size_help':'Number of frames in the shared memory ring (when recording_buffer is ring)',
+                      'recording_queue_size':0,
+                      'recording_queue_size_help':'Maximum number of frames (or blocks) in the recording queue (0 is unbounded)',
+                      'recording_queue_policy':['block','drop','spill'],
+                      'recording_queue_policy_help':'What to do when the recording queue (or ring) is full: block (wait for the recorder), drop (drop frames and log it) or spill (write to a scratch file in recording_spill_path and send the frames to the recorder later)',
+                      'recording_spill_path':'',
+                      'recording_spill_path_help':'Folder for the spill scratch files (default is the temporary folder); use a fast disk',
+                      'recording_batch_size':1,
+                      'recording_batch_size_help':'Number of frames sent to the recorder at once (when recording_buffer is queue); larger blocks reduce the overhead at high frame rates',
+                      'recording_batch_latency':0.05,
+                      'recording_batch_latency_help':'Maximum time (s) a frame waits for the block to fill before it is sent to the recorder',
+                      'compress_threads':0,
+                      'compress_threads_help':'Threads used by the tiff recorders to compress frames (when compress > 0); 0 is one per core (up to 8), 1 compresses one frame at a time',
+                      'hdf5_codec':['lz4','zstd','none'],
+                      'hdf5_codec_help':'Blosc codec of the hdf5 recorder (with bitshuffle); compress sets the level (default 5)',
+                      'hdf5_chunk_frames':0,
+                      'hdf5_chunk_frames_help':'Frames per chunk in the hdf5 files (0 is about 4MB per chunk)',
+                      'lossless_codec':['jp2','png','zlib'],
+                      'lossless_codec_help':'Codec of the lossless recorder: jp2 (JPEG-2000), png or zlib; compress sets the level of png and zlib',
+                      'lossless_workers':0,
+                      'lossless_workers_help':'Processes encoding frames for the lossless recorder (0 is one per core)',
+                      'binary_blocksize':8388608,
+                      'binary_blocksize_help':'Bytes written at once by the binary recorder (multiple of 4096)',
+                      'binary_preallocate':0,
+                      'binary_preallocate_help':'Number of frames to preallocate on disk when opening a binary file (recorder_frames_per_file is used when set)',
+                      'binary_direct':False,
+                      'binary_direct_help':'Open binary files with O_DIRECT to bypass the page cache (linux only)',
+                      'recording_log_format':['text','binary'],
+                      'recording_log_format_help':'Where the frame rows of the camlog are written: text (in the .camlog) or binary (columnar records in a .camrec next to the .camlog, the comments stay in the .camlog); parseCamLog reads both',
+                      'recording_checkpoint_interval':10,
+                      'recording_checkpoint_interval_help':'Seconds between checkpoints of the recording (data, log and frame index are synced to disk so a crash loses at most this much); 0 is off. Use labcams --recover FOLDER after a crash',
+                      'recording_latency':False,
+                      'recording_latency_help':'Measure the latency of each stage (camera, queue, write) of the recording; printed when the recording stops'}
 
 _SERVER_SETTINGS = {'server':['udp','zmq','none'],
                     'server_help':'These option allow setting servers to enable controlling the cameras and adding information to the log during recording. ',
@@ -57,9 +93,15 @@ _SERVER_SETTINGS = {'server':['udp','zmq','none'],
                     'server_port':9999}
 
 _OTHER_SETTINGS = dict(recorder_path = 'I:\\data',
+                       recorder_path_help = 'folder to record to; a list of folders (on different disks) spreads the files over the folders (see recorder_stripe)',
+                       recorder_stripe = 'files',
+                       recorder_stripe_help = 'how files are spread when recorder_path is a list: files (round-robin, with recorder_frames_per_file), cameras (one folder per camera) or space (the folder with the most free space)',
+                       recording_bandwidth_check = 'warn',
+                       recording_bandwidth_check_help = 'compare the bandwidth needed by the cameras with a quick write test of recorder_path before starting: warn, refuse (do not start) or off',
                        recorder_frames_per_file = 0,
                        recorder_frames_per_file_help = 'number of frames per file (0 is for a single large file)',
                        recorder_sleep_time = 0.03,
+                       recorder_sleep_time_help = 'timeout (s) for the recorder to check if it should stop; frames are written as soon as they arrive',
                        recorder_path_format = pjoin('{datafolder}',
                                                     '{dataname}',
                                                     '{filename}',
@@ -70,7 +112,8 @@ _CAMERAS = dict(avt='Allied Vision Technology (AVT Mako,Manta... - pymba/Vimba)'
                 opencv = 'OpenCV camera (Webcam, ...)',
                 pco = 'PCO imaging - PCO Edge (PCO SDK)',
                 ximea = 'Ximea (python sdk)',
-                pointgrey = 'FLIR PointGrey - Chameleon 3 (PySpin/FLIR Spinnaker SDK)')
+                pointgrey = 'FLIR PointGrey - Chameleon 3 (PySpin/FLIR Spinnaker SDK)',
+                simulated = 'Simulated camera (no hardware - for testing and benchmarks)')
 # description and id are mandatory
 _CAMERA_SETTINGS = dict(avt = dict(name='camera serial number',
                                    TriggerSource = 'Line1',
@@ -99,7 +142,13 @@ _CAMERA_SETTINGS = dict(avt = dict(name='camera serial number',
                                          pxformat='Mono8',
                                          binning = 1,
                                          gamma = 1.0,
-                                         hardware_trigger = 'out_line3'))
+                                         hardware_trigger = 'out_line3'),
+                        simulated = dict(height = 480,
+                                         width = 640,
+                                         nchan = 1,
+                                         dtype = 'uint8',
+                                         frameRate = 30.,
+                                         pattern = 'noise or gratings or frameid'))
 
 
 DEFAULTS = dict(cams = [{'description':'facecam',
@@ -172,6 +221,154 @@ def getPreferences(preffile = None,create = True):
     return pref
 
 
+class LatencyHistogram(object):
+    '''
+    Histogram of latencies (in seconds) in shared memory.
+
+    Bins are log spaced between tmin and tmax. There is no lock: each 
+    histogram should be filled by a single process, any process can read it.
+
+    Example:
+        hist = LatencyHistogram()
+        hist.add(time.time() - timestamp)
+        p50,p99 = hist.percentile([50,99])
+    '''
+    def __init__(self, nbins = 240, tmin = 1e-6, tmax = 1e2):
+        from multiprocessing import RawArray,RawValue
+        import ctypes
+        self.nbins = int(nbins)
+        self.tmin = float(tmin)
+        self.tmax = float(tmax)
+        self._counts = RawArray(ctypes.c_uint64,self.nbins)
+        self._sum = RawValue(ctypes.c_double,0)
+        self._max = RawValue(ctypes.c_double,0)
+        self._init_views()
+
+    def _init_views(self):
+        self.counts = np.frombuffer(self._counts,dtype = np.uint64)
+        self._lmin = np.log10(self.tmin)
+        self._lstep = (np.log10(self.tmax) - self._lmin)/self.nbins
+        self.edges = 10**(self._lmin + self._lstep*np.arange(self.nbins+1))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('counts',None)
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._init_views()
+
+    def add(self,dt):
+        if dt <= self.tmin:
+            ibin = 0
+        else:
+            ibin = min(int((np.log10(dt) - self._lmin)/self._lstep),self.nbins-1)
+        self.counts[ibin] += 1
+        self._sum.value += dt
+        if dt > self._max.value:
+            self._max.value = dt
+
+    def reset(self):
+        self.counts[:] = 0
+        self._sum.value = 0
+        self._max.value = 0
+
+    @property
+    def count(self):
+        return int(np.sum(self.counts))
+
+    @property
+    def mean(self):
+        n = self.count
+        if n == 0:
+            return np.nan
+        return self._sum.value/n
+
+    @property
+    def max(self):
+        return self._max.value
+
+    def percentile(self,p):
+        '''Percentile (0-100) of the latencies; uses the upper edge of the bin (or the max).'''
+        counts = np.array(self.counts,dtype = np.float64)
+        p = np.atleast_1d(np.asarray(p,dtype = np.float64))
+        if counts.sum() == 0:
+            res = np.full(p.shape,np.nan)
+        else:
+            cum = np.cumsum(counts)/counts.sum()
+            idx = np.clip(np.searchsorted(cum,p/100.),0,self.nbins-1)
+            res = np.minimum(self.edges[idx+1],self.max)
+        if res.size == 1:
+            return float(res[0])
+        return res
+
+    def summary(self):
+        p50,p99 = self.percentile([50,99])
+        return dict(count = self.count,
+                    mean = self.mean,
+                    p50 = p50,
+                    p99 = p99,
+                    max = self.max)
+
+
+class PipelineLatency(object):
+    '''
+    Latency histograms for each stage of the acquisition-to-disk pipeline.
+
+    Stages:
+        camera : from the SDK returning the frame to the frame being queued
+        queue  : time spent in the queue (0 for in-process recorders)
+        write  : from the recorder getting the frame to the write returning
+        total  : from the SDK returning the frame to the write returning
+
+    The camera stage is filled by the camera process, the others by the
+    recorder; each histogram has a single writer so no lock is needed.
+    Frames carry the stamps (t_sdk, t_enqueue[, t_dequeue]) to the recorder.
+
+    Example:
+        lat = PipelineLatency()
+        cam.stage_latency = lat
+        writer.stage_latency = lat
+        ...
+        display(lat.describe())
+    '''
+    stages = ['camera','queue','write','total']
+    def __init__(self, **kwargs):
+        self.histograms = dict([(s,LatencyHistogram(**kwargs))
+                                for s in self.stages])
+
+    def __getitem__(self,stage):
+        return self.histograms[stage]
+
+    def add(self,stage,dt):
+        self.histograms[stage].add(dt)
+
+    def add_written(self,stamps,twritten):
+        '''Adds the recorder stages for a frame written at twritten.'''
+        if len(stamps) > 2:
+            self.add('queue',stamps[2] - stamps[1])
+        self.add('write',twritten - stamps[-1])
+        self.add('total',twritten - stamps[0])
+
+    def reset(self):
+        for s in self.stages:
+            self.histograms[s].reset()
+
+    def summary(self):
+        return dict([(s,self.histograms[s].summary()) for s in self.stages])
+
+    def describe(self):
+        res = []
+        for s in self.stages:
+            h = self.histograms[s]
+            if h.count:
+                p50,p99 = h.percentile([50,99])
+                res.append('{0} p50 {1:.4f}s p99 {2:.4f}s max {3:.4f}s'.format(
+                    s,p50,p99,h.max))
+        return ' - '.join(res)
+
+
 def chunk_indices(nframes, chunksize = 512, min_chunk_size = 16):
     '''
     Gets chunk indices for iterating over an array in evenly sized chunks
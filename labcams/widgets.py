@@ -280,7 +280,7 @@ If the camera is saving this stops the camera.'''
                     display('[Controller] Sending start saving command to camera [{0}].'.format(c))
                     cam.saving.set()
                     if not writer is None:
-                        writer.write.set()
+                        writer.start_write()
                     self.experimentNameEdit.setDisabled(True)
                 else:
                     display('[Controller] Sending stop command to camera [{0}].'.format(c))
@@ -596,7 +596,7 @@ class CamWidget(QWidget):
         self.etrackercheck.checkbox.setChecked(self.parameters['TrackEye'])
 
     def saveImageFromCamera(self,filename=None):
-        frame = self.parent.cams[self.iCam].get_img()
+        frame = self.parent.cams[self.iCam].get_img(new_only = False)
         if filename is None:
             self.parent.timer.stop()
             filename = QFileDialog.getSaveFileName(self,
@@ -665,7 +665,7 @@ class CamWidget(QWidget):
                 else:
                     writer.trackerFlag.clear()
 
-    def image(self,image,nframe):
+    def image(self,image,nframe,ndropped = 0):
         if self.lastnFrame != nframe:
             tmp = image.copy()
             if self.parameters['Equalize']:
@@ -695,7 +695,11 @@ class CamWidget(QWidget):
                 else:
                     frame = self.eyeTracker.img
 
-            self.text.setText(self.string.format(nframe))
+            if ndropped > 0:
+                self.text.setText(self.string.format(nframe) +
+                                  ' - dropped {0}'.format(ndropped))
+            else:
+                self.text.setText(self.string.format(nframe))
             if not self.displaychannel == -1:
                 frame = frame[:,:,self.displaychannel]
 
@@ -30,6 +30,7 @@ setup(
     entry_points = {
         'console_scripts': [
             'labcams = labcams.gui:main',
+            'labcams-bench = labcams.bench:main',
         ]
     },
 )
@@ -0,0 +1,81 @@
+'''
+Recovery of runs with truncated data files (labcams.io.recover_run).
+
+    python -m pytest tests
+'''
+import os
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from labcams.io import LosslessWriter, LosslessStack, HDF5Writer, recover_run
+
+NFRAMES = 100
+
+def _record(writer, folder):
+    writer.nchannels = 1
+    for i in range(NFRAMES):
+        frame = np.random.randint(0,1000,(32,32)).astype(np.uint16)
+        writer._handle_frame((frame,(i,0.01*i)))
+    writer.close_run()
+    camlog = glob(os.path.join(folder,'**','*.camlog'),recursive = True)[0]
+    data = [f for f in glob(os.path.join(folder,'**','*'),recursive = True)
+            if os.path.splitext(f)[1] in ['.lossless','.h5']][0]
+    return camlog,data
+
+def _lossless_run(folder):
+    writer = LosslessWriter(datafolder = folder,dataname = 'cam',codec = 'zlib')
+    # the recorder process creates the pool, record in this process
+    writer._pool = ThreadPoolExecutor(max_workers = 2)
+    writer._nworkers = 2
+    try:
+        return _record(writer,folder)
+    finally:
+        writer._pool.shutdown()
+
+def _hdf5_run(folder):
+    pytest.importorskip('h5py')
+    pytest.importorskip('hdf5plugin')
+    return _record(HDF5Writer(datafolder = folder,dataname = 'cam'),folder)
+
+@pytest.mark.parametrize('record',[_lossless_run,_hdf5_run])
+def test_recover_truncated_run_keeps_the_log(record, tmp_path):
+    camlog,data = record(str(tmp_path))
+    os.truncate(data,int(os.path.getsize(data)*0.7))
+    with open(camlog,'r') as fd:
+        log = fd.read()
+    report = recover_run(camlog,dry_run = True)
+    assert 0 < report['valid_frames'] <= NFRAMES
+    assert report['rows_without_frames'] == NFRAMES - report['valid_frames']
+    report = recover_run(camlog)
+    if len(report['unreadable']):
+        # frames that may be on disk are not dropped from the log
+        assert report['valid_frames'] == NFRAMES
+        with open(camlog,'r') as fd:
+            assert fd.read() == log
+
+def test_lossless_checkpoint_is_recoverable(tmp_path):
+    folder = str(tmp_path)
+    writer = LosslessWriter(datafolder = folder,dataname = 'cam',codec = 'zlib')
+    writer._pool = ThreadPoolExecutor(max_workers = 2)
+    writer._nworkers = 2
+    writer.nchannels = 1
+    frames = np.random.randint(0,1000,(NFRAMES,32,32)).astype(np.uint16)
+    try:
+        for i,frame in enumerate(frames):
+            writer._handle_frame((frame,(i,0.01*i)))
+            if i == 49:
+                writer.checkpoint()
+        # the recorder stops without closing the file
+        stack = LosslessStack(writer.fd.fd.name)
+        assert len(stack) >= 50
+        assert np.array_equal(stack[:50],frames[:50])
+        stack.close()
+        camlog = glob(os.path.join(folder,'**','*.camlog'),recursive = True)[0]
+        report = recover_run(camlog,dry_run = True)
+        assert report['valid_frames'] >= 50
+    finally:
+        writer.close_run()
+        writer._pool.shutdown()